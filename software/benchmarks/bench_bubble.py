@@ -0,0 +1,115 @@
+"""
+Benchmark of the bubble-plot table builder.
+
+Compares enrichment._create_bubble_data with the previous row-by-row
+implementation (kept below as legacy_create_bubble_data) on a synthetic
+enrichment table, across top-N sizes and numbers of rounds, and checks that
+both produce the same table.
+
+Usage:
+    python benchmarks/bench_bubble.py [--clonotypes 100000] [--repeats 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import polars as pl
+from polars.testing import assert_frame_equal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import enrichment  # noqa: E402
+
+TOP_N = [10, 100, 1000, 10000]
+ROUNDS = [4, 10, 15]
+
+
+def synthetic_enrichment_results(n_clonotypes, n_rounds, seed=0):
+    """Enrichment table as produced by hybrid_enrichment_analysis, without controls."""
+    rng = np.random.default_rng(seed)
+    conditions = [f"R{i}" for i in range(1, n_rounds + 1)]
+    abundance = rng.zipf(1.8, size=(n_clonotypes, n_rounds)).clip(max=10**6)
+    abundance[rng.random(abundance.shape) < 0.3] = 0
+    pivot_df = pl.DataFrame({
+        "elementId": np.arange(n_clonotypes, dtype=np.uint32),
+        **{f"freq_{c}": abundance[:, i] / abundance[:, i].sum() for i, c in enumerate(conditions)},
+    })
+    results = enrichment._calculate_enrichments_vectorized(pivot_df, conditions)
+    return results.with_columns(
+        pl.format("C{}", pl.col("elementId") + 1).alias("Label"),
+        pl.lit("Weak Binder").alias("EnrichmentQuality"),
+    )
+
+
+def legacy_create_bubble_data(enrichment_results, top_n_bubble, min_enrichment):
+    """Row-by-row implementation replaced by the columnar one."""
+    max_col = 'MaxPositiveEnrichment'
+    filtered_data = enrichment_results.filter(pl.col(max_col) >= min_enrichment)
+    top_clonotypes = (
+        filtered_data
+        .sort([max_col, 'elementId'], descending=[True, False])
+        .head(top_n_bubble)
+        .select('elementId')
+    )
+    bubble_data = filtered_data.join(top_clonotypes, on='elementId', how='inner')
+    enrichment_cols = [
+        col for col in bubble_data.collect_schema().names() if col.startswith('Enrichment ')]
+    extra_cols = [
+        col for col in ['Binding Specificity', 'MaxNegControlEnrichment', 'PresentInNegControl', 'EnrichmentQuality']
+        if col in bubble_data.columns]
+
+    bubble_rows = []
+    for row in bubble_data.iter_rows(named=True):
+        extra_data = {col: row[col] for col in extra_cols}
+        for col in enrichment_cols:
+            enrich_val = row[col]
+            if enrich_val is not None and enrich_val > 0:
+                numerator, denominator = col.replace('Enrichment ', '').split(' vs ')
+                row_data = {
+                    'elementId': row['elementId'],
+                    'Label': row['Label'],
+                    'Numerator': numerator,
+                    'Denominator': denominator,
+                    'Enrichment': enrich_val,
+                    'Frequency_Numerator': row.get(f'Frequency {numerator}', None),
+                    max_col: row[max_col],
+                }
+                row_data.update(extra_data)
+                bubble_rows.append(row_data)
+    return pl.DataFrame(bubble_rows)
+
+
+def best_time(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bubble-plot table builder")
+    parser.add_argument("--clonotypes", type=int, default=100000,
+                        help="Number of clonotypes in the synthetic enrichment table")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Repetitions per case; the best time is reported")
+    args = parser.parse_args()
+
+    print(f"{'rounds':>6} {'top N':>7} {'rows':>9} {'legacy, s':>10} {'columnar, s':>12} {'speedup':>8}")
+    for n_rounds in ROUNDS:
+        results = synthetic_enrichment_results(args.clonotypes, n_rounds)
+        for top_n in TOP_N:
+            legacy_time, expected = best_time(
+                lambda: legacy_create_bubble_data(results, top_n, 0), args.repeats)
+            columnar_time, actual = best_time(
+                lambda: enrichment._create_bubble_data(results, top_n, 0), args.repeats)
+            assert_frame_equal(actual, expected, check_dtypes=False)
+            print(f"{n_rounds:>6} {top_n:>7} {actual.height:>9} {legacy_time:>10.3f} "
+                  f"{columnar_time:>12.3f} {legacy_time / columnar_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
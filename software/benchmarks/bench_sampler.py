@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of the downsampling sampler engines.
+
+Draws one multivariate hypergeometric sample per engine from power-law
+(Zipf-like) abundance vectors of different sizes and depths and reports wall
+time and the peak memory the draw adds on top of the input vector. Every
+measurement runs in a fresh process so peak RSS is not polluted by earlier
+cases.
+
+Usage:
+    python benchmarks/bench_sampler.py [--depth-fraction 0.1] [--alpha 1.1]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import downsampling  # noqa: E402
+
+# (number of clonotypes, total reads)
+CASES = [
+    (10**4, 10**6),
+    (10**4, 10**8),
+    (10**5, 10**6),
+    (10**5, 10**7),
+    (10**6, 10**7),
+    (10**6, 10**8),
+]
+
+
+def power_law_abundance(n_clonotypes, total_reads, alpha, seed=0):
+    """Abundances proportional to rank**-alpha, every clonotype seen at least once."""
+    weights = 1.0 / np.arange(1, n_clonotypes + 1) ** alpha
+    abundance = np.floor(weights / weights.sum() * total_reads).astype(np.int64) + 1
+    return np.random.default_rng(seed).permutation(abundance)
+
+
+def _measure(n_clonotypes, total_reads, depth_fraction, alpha, engine, queue):
+    abundance = power_law_abundance(n_clonotypes, total_reads, alpha)
+    depth = int(abundance.sum() * depth_fraction)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    downsampling.downsample_sample(abundance, depth, downsampling.sample_seed("bench"), engine)
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    resolved = engine
+    if engine == "auto":
+        resolved = downsampling.choose_sampler_engine(abundance.sum(), n_clonotypes, depth)
+    queue.put((elapsed, (rss_after - rss_before) / 1024, resolved))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark downsampling sampler engines")
+    parser.add_argument("--depth-fraction", type=float, default=0.1,
+                        help="Downsampling depth as a fraction of the sample total")
+    parser.add_argument("--alpha", type=float, default=1.1,
+                        help="Power-law exponent of the abundance distribution")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'clonotypes':>10} {'reads':>11} {'engine':>16} {'time, s':>9} {'peak, MB':>9}")
+    for n_clonotypes, total_reads in CASES:
+        for engine in downsampling.sampler_engines:
+            queue = context.Queue()
+            process = context.Process(
+                target=_measure,
+                args=(n_clonotypes, total_reads, args.depth_fraction, args.alpha, engine, queue))
+            process.start()
+            elapsed, peak_mb, resolved = queue.get()
+            process.join()
+            label = f"{engine}->{resolved}" if engine == "auto" else engine
+            print(f"{n_clonotypes:>10} {total_reads:>11} {label:>16} {elapsed:>9.3f} {peak_mb:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
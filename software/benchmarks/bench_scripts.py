@@ -0,0 +1,199 @@
+"""
+End-to-end benchmark of the software entry points on synthetic data.
+
+For every scale a seeded synthetic selection experiment (see synthetic.py) is
+generated, and then the scripts run as the workflow chains them:
+
+  downsampling.py               clonotype table -> downsampled clonotypes + clusters
+  enrichment.py                 cluster-level enrichment with negative controls
+                                and a sequenced library, all outputs
+  enrichment_annotations.py     annotation values of the highest enrichment table
+  filter.py                     top enriched table split by condition
+  clonotype_max_frequency.py    clonotype-level max frequency for the target
+
+Each script runs in its own process; wall time and its peak RSS (from the
+child's resource usage) are recorded. Results are compared against stored
+baselines of the same scale: a script regresses when its time or peak memory
+exceeds the baseline by more than the threshold ratio and by more than an
+absolute floor (so noise on sub-second runs does not count). The exit status
+is 1 when any script regresses.
+
+Baselines are machine-specific; record them on the machine that runs the
+comparison with --update-baselines.
+
+Usage:
+    python benchmarks/bench_scripts.py [--scales small medium] [--update-baselines]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import synthetic  # noqa: E402
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+DEFAULT_BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+# name -> (number of clonotypes, selection rounds, negative antigens)
+SCALES = {
+    "small": (10**4, 3, 2),
+    "medium": (10**5, 6, 2),
+    "large": (10**6, 10, 3),
+    "xlarge": (10**7, 20, 3),
+}
+DEFAULT_SCALES = ["small", "medium"]
+
+# Differences below these floors are never regressions
+TIME_FLOOR_S = 0.5
+MEMORY_FLOOR_MB = 50.0
+
+
+def script_commands(rounds, n_negative):
+    """(name, argv) of the benchmarked steps, run in the data directory."""
+    conditions = json.dumps(synthetic.round_conditions(rounds))
+    controls = json.dumps(synthetic.negative_antigens(n_negative) + [synthetic.LIBRARY_ANTIGEN])
+    return [
+        ("downsampling", [
+            "downsampling.py", "--input", "clones.parquet", "--output", "clonotypes_ds.parquet",
+            "--cluster_mapping", "cluster_mapping.csv", "--cluster_output", "clusters_ds.parquet"]),
+        ("enrichment", [
+            "enrichment.py", "--input_data", "clusters_ds.parquet", "--conditions", conditions,
+            "--enrichment", "enrichment.csv", "--bubble", "bubble.csv",
+            "--top_enriched", "top_enriched.csv", "--top_10", "top_10.csv",
+            "--highest_enrichment_clonotype", "highest.csv", "--filtered_too_much", "filtered_too_much.txt",
+            "--annotation_stats", "annotation_stats.json",
+            "--control_enabled", "--current_target", synthetic.TARGET_ANTIGEN,
+            "--negative_antigens", controls,
+            "--sequenced_library_enabled", "--sequenced_library_antigen", synthetic.LIBRARY_ANTIGEN]),
+        ("enrichment_annotations", [
+            "enrichment_annotations.py", "highest.csv", "--enrichment-column", "Enrichment",
+            "--output-dir", "annotations"]),
+        ("filter", [
+            "filter.py", "--enrichment_file", "top_enriched.csv", "--all_conditions",
+            "--output_pattern", "filtered_{condition}.csv"]),
+        ("clonotype_max_frequency", [
+            "clonotype_max_frequency.py", "--input_data", "clonotypes_ds.parquet",
+            "--conditions", conditions, "--current_target", synthetic.TARGET_ANTIGEN,
+            "--output", "max_frequency.csv"]),
+    ]
+
+
+def run_script(argv, workdir):
+    """Run a script of src/ in workdir; returns (wall time in s, peak RSS in MB)."""
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(SRC_DIR, argv[0])] + argv[1:], cwd=workdir,
+            stdout=subprocess.DEVNULL, stderr=stderr)
+        # Reap the child directly to get its own resource usage
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"{argv[0]} failed with exit code {process.returncode}:\n"
+                               f"{stderr.read().decode(errors='replace')}")
+    return elapsed, usage.ru_maxrss / 1024
+
+
+def run_scale(name, workdir, seed=0):
+    n_clonotypes, rounds, n_negative = SCALES[name]
+    # Generated in a separate process: a child's peak RSS starts from the
+    # parent's RSS at fork, so the benchmark process must stay small (it
+    # imports synthetic.py only for the antigen and condition names)
+    generated = subprocess.run(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "synthetic.py"),
+         "--clonotypes", str(n_clonotypes), "--rounds", str(rounds),
+         "--negative-antigens", str(n_negative), "--seed", str(seed), "--output-dir", workdir],
+        check=True, capture_output=True, text=True)
+    n_rows = int(generated.stdout.split()[0])
+    with open(os.path.join(workdir, "downsampling.json"), "w") as f:
+        json.dump({"type": "hypergeometric", "valueChooser": "min"}, f)
+
+    results = {}
+    for script, argv in script_commands(rounds, n_negative):
+        elapsed, peak_mb = run_script(argv, workdir)
+        results[script] = {"time_s": round(elapsed, 3), "peak_mb": round(peak_mb, 1)}
+    return n_rows, results
+
+
+def is_regression(value, baseline, threshold, floor):
+    return value > baseline * threshold and value - baseline > floor
+
+
+def machine_info():
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the software entry points on synthetic data")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=DEFAULT_SCALES)
+    parser.add_argument("--baselines", default=DEFAULT_BASELINES,
+                        help="JSON file of baseline results per scale")
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="Store the results of the run scales as the new baselines")
+    parser.add_argument("--time-threshold", type=float, default=1.3,
+                        help="Allowed ratio of the time to its baseline")
+    parser.add_argument("--memory-threshold", type=float, default=1.2,
+                        help="Allowed ratio of the peak memory to its baseline")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", required=False,
+                        help="Directory for the generated data and outputs (default: a temporary one)")
+    args = parser.parse_args()
+
+    baselines = {"machine": machine_info(), "scales": {}}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    print(f"{'scale':>7} {'script':>24} {'time, s':>9} {'base, s':>9} {'peak, MB':>9} {'base, MB':>9}")
+    for name in args.scales:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+            n_rows, results = run_scale(name, workdir, args.seed)
+        baseline = baselines["scales"].get(name, {}).get("scripts", {})
+        for script, result in results.items():
+            base = baseline.get(script)
+            flags = ""
+            if base is not None and not args.update_baselines:
+                if is_regression(result["time_s"], base["time_s"], args.time_threshold, TIME_FLOOR_S):
+                    flags += " TIME"
+                if is_regression(result["peak_mb"], base["peak_mb"], args.memory_threshold, MEMORY_FLOOR_MB):
+                    flags += " MEMORY"
+                if flags:
+                    regressions.append((name, script, flags.strip()))
+            base_time = f"{base['time_s']:>9.2f}" if base else f"{'-':>9}"
+            base_peak = f"{base['peak_mb']:>9.1f}" if base else f"{'-':>9}"
+            print(f"{name:>7} {script:>24} {result['time_s']:>9.2f} {base_time} "
+                  f"{result['peak_mb']:>9.1f} {base_peak}{flags}")
+        if args.update_baselines:
+            n_clonotypes, rounds, n_negative = SCALES[name]
+            baselines["scales"][name] = {
+                "clonotypes": n_clonotypes, "rounds": rounds, "negative_antigens": n_negative,
+                "rows": n_rows, "seed": args.seed, "scripts": results,
+            }
+
+    if args.update_baselines:
+        baselines["machine"] = machine_info()
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2)
+            f.write("\n")
+        print(f"Baselines written to {args.baselines}")
+    elif regressions:
+        for name, script, kind in regressions:
+            print(f"Regression: {script} at scale {name} ({kind})")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Calibration of the sizing advisor's cost model (src/sizing.py).
+
+Runs downsampling, enrichment and clonotype max frequency, with the
+arguments their workflow templates pass (see step_commands), on a grid of
+synthetic experiments (see synthetic.py) of different sizes and shapes,
+records each script's peak RSS next to the table counts the advisor computes
+(sizing.py itself runs on the same clone table), and fits, per step, the
+non-negative linear model of sizing.COST_MODEL by least squares. The fitted
+coefficients are scaled up so that no measured run is above its estimate,
+then by --margin for inputs beyond the measured ones, and printed in the form
+of COST_MODEL. The fit uses the features COST_MODEL lists; a feature whose
+coefficient comes out 0 is better removed from it than kept as a dead term.
+
+The shapes of VALIDATION are measured too but left out of the fit: they are
+larger, have more antigens or are sequenced deeper than any shape of GRID, and the ratio of their
+estimate to their measured peak shows whether the margin covers inputs
+outside the grid.
+
+Downsampling runs with one worker: the memory of worker processes and the
+worst case of the samplers are modelled separately (see
+sizing.sampler_peak_mb) and added to the fitted model. The synthetic samples
+are small, so the sampler memory the measured runs include is small too.
+
+Usage:
+    python benchmarks/calibrate_sizing.py [--measurements points.json] [--refit]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import synthetic  # noqa: E402
+from bench_scripts import run_script  # noqa: E402
+
+# (clonotypes, rounds, samples per round, negative antigens, reads per sample
+# per clonotype); deeper samples see more of the clonotypes, so the depth sets
+# the clone rows per element, and without negative antigens most of the rows
+# are the target's (the only ones clonotype max frequency reads)
+GRID = [
+    (10**4, 3, 2, 2, 1),
+    (10**5, 3, 2, 2, 1),
+    (10**5, 6, 2, 2, 1),
+    (10**5, 12, 1, 1, 1),
+    (3 * 10**5, 4, 3, 2, 1),
+    (3 * 10**5, 8, 2, 0, 1),
+    (10**6, 3, 2, 2, 1),
+    (10**6, 6, 2, 1, 1),
+    (10**5, 4, 2, 8, 1),
+    (3 * 10**5, 3, 1, 12, 1),
+    (10**5, 3, 2, 2, 16),
+    (10**5, 6, 1, 4, 8),
+    (3 * 10**5, 4, 1, 4, 4),
+    (10**5, 4, 2, 0, 16),
+    (3 * 10**5, 3, 2, 0, 8),
+]
+
+# Held-out shapes beyond the grid: more clonotypes, more antigens, deeper
+VALIDATION = [
+    (2 * 10**6, 4, 2, 2, 1),
+    (4 * 10**5, 8, 2, 2, 1),
+    (5 * 10**5, 4, 1, 16, 1),
+    (2 * 10**5, 4, 1, 5, 16),
+]
+
+# Steps of the cost model, fitted to the peak RSS of their scripts
+STEPS = ["downsampling", "enrichment", "clonotype_max_frequency"]
+
+
+def step_commands(rounds, n_negative):
+    """
+    Commands of the steps with the arguments their workflow templates pass,
+    for the block's default settings (pseudocount 1, default thresholds)
+    without clonotype filters, which only make the tables smaller.
+    """
+    conditions = json.dumps(synthetic.round_conditions(rounds))
+    controls = synthetic.negative_antigens(n_negative)
+    control_args = []
+    if controls:
+        control_args = [
+            "--control_enabled", "--negative_antigens", json.dumps(controls),
+            "--control_conditions_order", conditions,
+            "--control_threshold", "1.0", "--single_control_frequency_threshold", "0.01",
+        ]
+    return {
+        "downsampling": [
+            "downsampling.py", "--input", "clones.csv", "--workers", "1", "--output", "downsampled.parquet",
+            "--profile", "profile.json"],
+        "enrichment": [
+            "enrichment.py", "--input_data", "downsampled.parquet", "--conditions", conditions,
+            "--enrichment_threshold", "2.0",
+            "--enrichment", "enrichment.csv", "--bubble", "bubble.csv",
+            "--top_enriched", "top_enriched.csv", "--top_10", "top_10.csv", "--pseudo_count", "1",
+            "--highest_enrichment_clonotype", "highest.csv", "--filtered_too_much", "filtered_too_much.txt",
+            "--annotation_stats", "annotation_stats.json", "--profile", "profile.json",
+            "--current_target", synthetic.TARGET_ANTIGEN,
+            "--sequenced_library_enabled", "--sequenced_library_antigen", synthetic.LIBRARY_ANTIGEN,
+        ] + control_args,
+        "clonotype_max_frequency": [
+            "clonotype_max_frequency.py", "--input_data", "downsampled.parquet",
+            "--conditions", conditions, "--output", "max_frequency.csv", "--profile", "profile.json",
+            "--current_target", synthetic.TARGET_ANTIGEN],
+    }
+
+
+def measure(shape, workdir):
+    """Table counts (from sizing.py) and the peak RSS in MB of each step."""
+    n_clonotypes, rounds, samples_per_round, n_negative, depth = shape
+    subprocess.run(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "synthetic.py"),
+         "--clonotypes", str(n_clonotypes), "--rounds", str(rounds),
+         "--samples-per-round", str(samples_per_round), "--negative-antigens", str(n_negative),
+         "--reads-per-sample", str(depth * n_clonotypes), "--format", "csv", "--output-dir", workdir],
+        check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(workdir, "downsampling.json"), "w") as f:
+        json.dump({"type": "hypergeometric", "valueChooser": "min"}, f)
+
+    _, sizing_peak_mb = run_script(
+        ["sizing.py", "--input", "clones.csv", "--output", "sizing.json"], workdir)
+    with open(os.path.join(workdir, "sizing.json")) as f:
+        stats = json.load(f)["table"]
+
+    peaks = {"sizing": round(sizing_peak_mb, 1)}
+    for step, argv in step_commands(rounds, n_negative).items():
+        _, peak_mb = run_script(argv, workdir)
+        peaks[step] = round(peak_mb, 1)
+    return {"shape": list(shape), "table": stats, "peak_mb": peaks}
+
+
+def fit(points, step, margin=1.0, validation=()):
+    """
+    Non-negative coefficients of COST_MODEL[step], covering every measured
+    point times margin; returns the model, the envelope scale and the ratio
+    of estimate to measured peak of each point and validation point.
+    """
+    # Imported only for the fit: a child's peak RSS starts from the parent's,
+    # so the measuring process stays small
+    import numpy as np
+    from scipy.optimize import nnls
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+    import sizing
+
+    names = [name for name in sizing.COST_MODEL[step] if name != "base_mb"]
+
+    def design_and_measured(step_points):
+        design = np.array([
+            [1.0] + [sizing.step_features(point["table"])[name] / 2**20 for name in names]
+            for point in step_points
+        ]).reshape(len(step_points), len(names) + 1)
+        measured = np.array([point["peak_mb"][step] for point in step_points])
+        return design, measured
+
+    design, measured = design_and_measured(points)
+    coefficients, _ = nnls(design, measured)
+    # Scale so that the model is an upper envelope of the measurements
+    scale = max(1.0, float(np.max(measured / (design @ coefficients)))) * margin
+    coefficients *= scale
+    model = {"base_mb": round(float(coefficients[0]), 1)}
+    model.update({name: round(float(value), 1) for name, value in zip(names, coefficients[1:])})
+    validation_design, validation_measured = design_and_measured(list(validation))
+    return (model, scale, (design @ coefficients) / measured,
+            (validation_design @ coefficients) / validation_measured)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the cost model of the sizing advisor")
+    parser.add_argument("--measurements", default=None,
+                        help="JSON file to store the measurements in (or read them from, with --refit)")
+    parser.add_argument("--refit", action="store_true",
+                        help="Fit the stored --measurements without running the scripts")
+    parser.add_argument("--workdir", required=False,
+                        help="Directory for the generated data and outputs (default: a temporary one)")
+    parser.add_argument("--margin", type=float, default=1.15,
+                        help="Factor on the envelope of the grid, for inputs beyond the measured ones")
+    args = parser.parse_args()
+
+    if args.refit:
+        with open(args.measurements) as f:
+            points = json.load(f)
+    else:
+        points = []
+        for shape in GRID + VALIDATION:
+            with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+                point = measure(shape, workdir)
+            print(f"{str(shape):>28} rows={point['table']['rows']:>9} {point['peak_mb']}")
+            points.append(point)
+        if args.measurements:
+            with open(args.measurements, "w") as f:
+                json.dump(points, f, indent=2)
+
+    held_out = [list(shape) for shape in VALIDATION]
+    grid_points = [point for point in points if point["shape"] not in held_out]
+    validation_points = [point for point in points if point["shape"] in held_out]
+    print("COST_MODEL = {")
+    for step in STEPS:
+        model, scale, ratios, validation_ratios = fit(grid_points, step, args.margin, validation_points)
+        print(f"    # envelope scale {scale:.2f}, estimate / measured {min(ratios):.2f}x to {max(ratios):.2f}x"
+              + (f", held out {min(validation_ratios):.2f}x to {max(validation_ratios):.2f}x"
+                 if len(validation_ratios) else ""))
+        print(f"    {step!r}: {model},")
+    print("}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Regression check of the streaming mode of enrichment.py against the
+in-memory mode.
+
+A seeded synthetic experiment (see synthetic.py) is analyzed with the
+arguments the workflow passes (pseudocount, negative controls without the
+library, a sequenced library) once in memory and once with --streaming, and
+every output must be byte-identical. The streaming budget is chosen so that
+the last clonotype slice holds a single element: polars computes some
+operations differently on one-row frames, so a slice size must never show
+in the results.
+
+The exit status is 1 when any output differs.
+
+Usage:
+    python benchmarks/check_streaming.py [--clonotypes 2000] [--rounds 4]
+"""
+import argparse
+import filecmp
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import polars as pl  # noqa: E402
+
+import enrichment  # noqa: E402
+import synthetic  # noqa: E402
+from bench_scripts import run_script  # noqa: E402
+
+OUTPUTS = {
+    "--enrichment": "enrichment.csv",
+    "--bubble": "bubble.csv",
+    "--top_enriched": "top_enriched.csv",
+    "--top_10": "top_10.csv",
+    "--highest_enrichment_clonotype": "highest.csv",
+    "--filtered_too_much": "filtered_too_much.txt",
+    "--annotation_stats": "annotation_stats.json",
+}
+
+
+def enrichment_command(rounds, n_negative, outdir):
+    conditions = synthetic.round_conditions(rounds)
+    argv = [
+        "enrichment.py", "--input_data", "clones.parquet", "--conditions", json.dumps(conditions),
+        "--pseudo_count", "1", "--current_target", synthetic.TARGET_ANTIGEN,
+        "--sequenced_library_enabled", "--sequenced_library_antigen", synthetic.LIBRARY_ANTIGEN,
+        "--filter_clonotypes", "--min_frequency", "1e-5",
+    ]
+    if n_negative:
+        argv += [
+            "--control_enabled", "--negative_antigens", json.dumps(synthetic.negative_antigens(n_negative)),
+            "--control_conditions_order", json.dumps(conditions),
+            "--control_threshold", "1.0", "--single_control_frequency_threshold", "0.01",
+        ]
+    for flag, name in OUTPUTS.items():
+        argv += [flag, os.path.join(outdir, name)]
+    return argv
+
+
+def last_slice_budget(clones, rounds):
+    """
+    --streaming_memory_mb for which the last element slice holds one element
+    and every other slice more than one; returns (budget, elements per slice).
+    """
+    rows = clones.filter(pl.col("elementId").is_not_null() & (pl.col("elementId") != "")).height
+    n_elements = clones.get_column("elementId").drop_nulls().n_unique()
+    # The sequenced library is the first condition of the analysis
+    conditions = ["0 - Library"] + synthetic.round_conditions(rounds)
+    row_bytes = enrichment._streaming_row_bytes(
+        len(conditions), len(enrichment._comparison_pairs(conditions, None)))
+    for batch_rows in range(rows, 0, -1):
+        ids_per_slice = enrichment._streaming_ids_per_slice(n_elements, rows, batch_rows)
+        if ids_per_slice > 1 and n_elements % ids_per_slice == 1:
+            budget_mb = (batch_rows + 0.5) * row_bytes * 4 / 2**20
+            assert enrichment._streaming_batch_rows(budget_mb, row_bytes) == batch_rows
+            return budget_mb, ids_per_slice
+    raise ValueError(f"no slice budget leaves a one-element slice for {n_elements} elements")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare streaming and in-memory enrichment outputs")
+    parser.add_argument("--clonotypes", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--negative-antigens", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", required=False,
+                        help="Directory for the generated data and outputs (default: a temporary one)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        clones, _ = synthetic.selection_data(
+            args.clonotypes, args.rounds, n_negative=args.negative_antigens, seed=args.seed)
+        clones = clones.with_columns(pl.col("abundance").alias("downsampledAbundance"))
+        clones.write_parquet(os.path.join(workdir, "clones.parquet"))
+        budget_mb, ids_per_slice = last_slice_budget(clones, args.rounds)
+        print(f"streaming budget {budget_mb!r} MB: {ids_per_slice} elements per slice, one in the last")
+
+        modes = {"memory": [], "streaming": ["--streaming", "--streaming_memory_mb", repr(budget_mb)]}
+        for mode, extra in modes.items():
+            os.makedirs(os.path.join(workdir, mode))
+            run_script(enrichment_command(args.rounds, args.negative_antigens, mode) + extra, workdir)
+
+        differing = [
+            name for name in OUTPUTS.values()
+            if not filecmp.cmp(os.path.join(workdir, "memory", name),
+                               os.path.join(workdir, "streaming", name), shallow=False)
+        ]
+    for name in differing:
+        print(f"DIFFERS  {name}")
+    if not differing:
+        print(f"all {len(OUTPUTS)} outputs identical")
+    sys.exit(1 if differing else 0)
+
+
+if __name__ == "__main__":
+    main()
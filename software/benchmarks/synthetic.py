@@ -0,0 +1,130 @@
+"""
+Seeded generator of synthetic selection data for the benchmarks.
+
+Builds a clone table in the shape the workflow hands to `downsampling`
+(sampleId, elementId, abundance, condition, antigen) for a panning-like
+experiment:
+
+  - clonotype base frequencies follow a power law (weights ~ rank**-alpha,
+    randomly permuted over clonotype keys);
+  - every antigen (the target and each negative control) has `rounds`
+    selection rounds R1..R<rounds> with `samples_per_round` replicate samples;
+  - a small fraction of clonotypes are binders that grow by `growth` per round
+    on the target, and a smaller fraction are sticky (grow on every antigen,
+    negative controls included);
+  - an optional library antigen has one sample of the unselected repertoire;
+  - clonotypes are grouped into clusters of geometric size, giving the
+    clonotype -> cluster mapping of cluster mode (elementId, clusterId).
+
+Reads of a sample are a multinomial draw of `reads_per_sample` over the
+round's frequencies, and only observed clonotypes become rows, so the table
+is sparse like real data.
+
+Usage:
+    python benchmarks/synthetic.py --clonotypes 100000 --rounds 4 --output-dir data/
+"""
+import argparse
+import os
+
+import numpy as np
+import polars as pl
+
+TARGET_ANTIGEN = "Target"
+LIBRARY_ANTIGEN = "Library"
+
+
+def negative_antigens(n_negative):
+    return [f"Neg{i}" for i in range(1, n_negative + 1)]
+
+
+def round_conditions(rounds):
+    return [f"R{i}" for i in range(1, rounds + 1)]
+
+
+def _keys(prefix, numbers):
+    """String keys <prefix>_<8-digit number>, built as one Arrow column."""
+    return pl.select(
+        pl.format(f"{prefix}_{{}}", pl.Series(numbers).cast(pl.Utf8).str.zfill(8))
+    ).to_series()
+
+
+def selection_data(n_clonotypes, rounds, samples_per_round=2, n_negative=2, library=True,
+                   reads_per_sample=None, alpha=1.1, binder_fraction=0.01, sticky_fraction=0.002,
+                   growth=3.0, mean_cluster_size=3.0, seed=0):
+    """
+    Synthetic clone table and clonotype -> cluster mapping (see module docstring).
+    Returns (clones, mapping) frames; the same arguments give the same data.
+    """
+    rng = np.random.default_rng(seed)
+    reads_per_sample = reads_per_sample or n_clonotypes
+
+    weights = rng.permutation(1.0 / np.arange(1, n_clonotypes + 1) ** alpha)
+    binder = rng.random(n_clonotypes) < binder_fraction
+    sticky = rng.random(n_clonotypes) < sticky_fraction
+    element_ids = _keys("clonotype", np.arange(n_clonotypes))
+
+    def sample_rows(sample_id, condition, antigen, round_weights):
+        counts = rng.multinomial(reads_per_sample, round_weights / round_weights.sum())
+        observed = np.flatnonzero(counts)
+        return pl.DataFrame({
+            "sampleId": sample_id,
+            "elementId": element_ids.gather(observed),
+            "abundance": counts[observed].astype(np.int64),
+            "condition": condition,
+            "antigen": antigen,
+        })
+
+    samples = []
+    if library:
+        samples.append(sample_rows("S_Library_R0", "R0", LIBRARY_ANTIGEN, weights))
+    for antigen in [TARGET_ANTIGEN] + negative_antigens(n_negative):
+        growing = binder | sticky if antigen == TARGET_ANTIGEN else sticky
+        for round_index, condition in enumerate(round_conditions(rounds), start=1):
+            round_weights = np.where(growing, weights * growth ** round_index, weights)
+            for replicate in range(1, samples_per_round + 1):
+                samples.append(sample_rows(
+                    f"S_{antigen}_{condition}_{replicate}", condition, antigen, round_weights))
+
+    # Clusters of geometric size: a new cluster starts after each clonotype
+    # with probability 1 / mean_cluster_size (in a random clonotype order)
+    starts = rng.random(n_clonotypes) < 1.0 / mean_cluster_size
+    starts[0] = True
+    cluster_of_rank = np.cumsum(starts) - 1
+    mapping = pl.DataFrame({
+        "elementId": element_ids.gather(rng.permutation(n_clonotypes)),
+        "clusterId": _keys("cluster", cluster_of_rank),
+    })
+    return pl.concat(samples), mapping
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic selection data")
+    parser.add_argument("--clonotypes", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--samples-per-round", type=int, default=2)
+    parser.add_argument("--negative-antigens", type=int, default=2)
+    parser.add_argument("--no-library", action="store_true")
+    parser.add_argument("--reads-per-sample", type=int, default=None,
+                        help="Reads per sample (default: one per clonotype)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet",
+                        help="Format of the clone table (the workflow hands CSV to downsampling)")
+    parser.add_argument("--output-dir", default=".",
+                        help="Directory for clones.<format> and cluster_mapping.csv")
+    args = parser.parse_args()
+
+    clones, mapping = selection_data(
+        args.clonotypes, args.rounds, args.samples_per_round, args.negative_antigens,
+        library=not args.no_library, reads_per_sample=args.reads_per_sample, seed=args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    clones_path = os.path.join(args.output_dir, f"clones.{args.format}")
+    if args.format == "csv":
+        clones.write_csv(clones_path)
+    else:
+        clones.write_parquet(clones_path)
+    mapping.write_csv(os.path.join(args.output_dir, "cluster_mapping.csv"))
+    print(f"{clones.height} clone rows, {mapping.get_column('clusterId').n_unique()} clusters")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,35 +20,60 @@ antigen column is present we keep only rows of the current target antigen
 (library and negative-control samples carry different antigen values). The max
 is taken over the target condition order only.
 
-Input CSV (the downsampling output) columns:
+Input table (the downsampling output; CSV, Parquet or Arrow IPC) columns:
     sampleId, elementId, abundance, downsampledAbundance, condition, [antigen]
-Output CSV columns:
+Output table columns (format follows the --output extension):
     elementId, MaxFrequency
+
+The long engine (default) never widens the table: it sums abundance per
+(elementId, condition), divides by the round total and takes a grouped max
+per clonotype, all as one query on the polars streaming engine, so memory is
+bounded by the group-by state rather than the input. The dense engine pivots
+to a clonotype x condition frame; the sparse engine keeps the observed
+(clonotype, condition) counts in a scipy.sparse matrix and takes the max over
+its stored frequencies (absent rounds count as 0). Every engine divides each
+abundance by its round total as one IEEE division (a polars column divided by
+a scalar is computed as a product with the reciprocal, which can differ in the
+last bit, so no engine divides that way); all give the same values.
+
+With --targets the table is read once for several target antigens, and
+--output must contain '{target}', which is replaced with the target name.
 """
 import argparse
 import json
 
+import numpy as np
 import polars as pl
+from scipy import sparse
 
+from profiling import StageProfiler, add_profile_argument
+from table_io import read_table, scan_table, write_table
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Per-clonotype max frequency across target rounds")
-    parser.add_argument("--input_data", required=True,
-                        help="Downsampling output CSV (clonotype resolution).")
-    parser.add_argument("--conditions", type=str, required=True,
-                        help="JSON list of target conditions (rounds), ordered.")
-    parser.add_argument("--current_target", type=str, default=None,
-                        help="Target antigen value; when set, only its rows are "
-                             "used (excludes library and negative controls).")
-    parser.add_argument("--output", required=True)
-    args = parser.parse_args()
 
-    condition_order = [str(c) for c in json.loads(args.conditions)]
+max_frequency_engines = ["long", "dense", "sparse"]
 
-    empty = pl.DataFrame(schema={"elementId": pl.Utf8, "MaxFrequency": pl.Float64})
 
-    df = pl.read_csv(args.input_data, schema_overrides={"condition": pl.Utf8})
+def max_frequency(df, condition_order, current_target=None, engine="long", targets=None):
+    """
+    Per-clonotype MaxFrequency over the target rounds of a downsampling output
+    frame (a LazyFrame is streamed by the long engine). Returns a frame with
+    columns elementId, MaxFrequency or, with targets, one such frame per
+    target antigen in place of current_target.
+    """
+    if engine not in max_frequency_engines:
+        raise ValueError(f"Invalid max frequency engine: {engine}")
+    if targets is not None:
+        targets = [str(target) for target in targets]
+        if engine == "long":
+            return _long_max_frequency(df.lazy(), condition_order, targets)
+        # The other engines take the frame in memory: read it once for all targets
+        df = df.collect() if isinstance(df, pl.LazyFrame) else df
+        return {target: max_frequency(df, condition_order, target, engine) for target in targets}
+    if engine == "long":
+        return _long_max_frequency(df.lazy(), condition_order, current_target)
+    if isinstance(df, pl.LazyFrame):
+        df = df.collect()
+    empty = pl.DataFrame(schema={"elementId": pl.Utf8, "MaxFrequency": pl.Float64})
 
     # Use the downsampled abundance, matching the main enrichment script
     # (enrichment.py renames downsampledAbundance -> abundance before use).
@@ -58,8 +83,7 @@ def main():
         df = df.rename({"downsampledAbundance": "abundance"})
 
     if df.height == 0:
-        empty.write_csv(args.output)
-        return
+        return empty
 
     df = df.with_columns(
         pl.col("abundance").cast(pl.Float64),
@@ -69,12 +93,11 @@ def main():
     # Restrict to the target track: keep only the current target antigen's rows.
     # Library and negative-control samples carry other antigen values and are
     # dropped here, so they never contribute to the max frequency.
-    if args.current_target is not None and "antigen" in df.columns:
-        df = df.filter(pl.col("antigen").cast(pl.Utf8) == str(args.current_target))
+    if current_target is not None and "antigen" in df.columns:
+        df = df.filter(pl.col("antigen").cast(pl.Utf8) == str(current_target))
 
     if df.height == 0:
-        empty.write_csv(args.output)
-        return
+        return empty
 
     # Sum (downsampled) abundance per clonotype per condition across samples.
     agg = (
@@ -86,6 +109,9 @@ def main():
     totals_df = agg.group_by("condition").agg(pl.col("abundance").sum().alias("total"))
     totals = dict(zip(totals_df["condition"].to_list(), totals_df["total"].to_list()))
 
+    if engine == "sparse":
+        return _sparse_max_frequency(agg, condition_order, totals)
+
     pivot = (
         agg.pivot(values="abundance", index="elementId", on="condition",
                   aggregate_function="sum")
@@ -101,17 +127,158 @@ def main():
         total = totals.get(c, 0)
         freq_name = f"freq_{c}"
         if total > 0:
-            pivot = pivot.with_columns((pl.col(c) / total).alias(freq_name))
+            pivot = pivot.with_columns(
+                pl.Series(freq_name, pivot.get_column(c).cast(pl.Float64).to_numpy() / total))
         else:
             pivot = pivot.with_columns(pl.lit(0.0).alias(freq_name))
         freq_cols.append(freq_name)
 
-    out = (
+    return (
         pivot.with_columns(pl.concat_list(freq_cols).list.max().alias("MaxFrequency"))
         .select(["elementId", "MaxFrequency"])
         .sort("elementId")
     )
-    out.write_csv(args.output)
+
+
+def _long_max_frequency(lf, condition_order, targets):
+    """
+    MaxFrequency in long format: per (elementId, condition) abundance sums
+    divided by their round total, then the max per clonotype. targets is
+    the current target (or None) or, for several targets at once, a list;
+    the antigen is then a group-by key and a frame is returned per target.
+    """
+    several = isinstance(targets, list)
+    names = lf.collect_schema().names()
+    empty = pl.DataFrame(schema={"elementId": pl.Utf8, "MaxFrequency": pl.Float64})
+
+    # Use the downsampled abundance, as the other engines do
+    if "downsampledAbundance" in names:
+        if "abundance" in names:
+            lf = lf.drop("abundance")
+        lf = lf.rename({"downsampledAbundance": "abundance"})
+    lf = lf.with_columns(
+        pl.col("abundance").cast(pl.Float64),
+        pl.col("condition").cast(pl.Utf8),
+    )
+
+    # Restrict to the target track(s); without an antigen column every row is used
+    keys = []
+    if several:
+        if "antigen" in names:
+            lf = lf.with_columns(pl.col("antigen").cast(pl.Utf8).alias("target"))
+            lf = lf.filter(pl.col("target").is_in(targets))
+            keys = ["target"]
+    elif targets is not None and "antigen" in names:
+        lf = lf.filter(pl.col("antigen").cast(pl.Utf8) == str(targets))
+
+    # Total reads per target round; rounds with no reads have frequency 0
+    totals = (
+        lf.filter(pl.col("condition").is_in(condition_order))
+        .group_by(keys + ["condition"])
+        .agg(pl.col("abundance").sum().alias("total"))
+        .filter(pl.col("total") > 0)
+    )
+    # Observed per-condition frequency, then the max per clonotype. Clonotypes
+    # only seen outside the target rounds keep a MaxFrequency of 0.
+    result = (
+        lf.group_by(keys + ["elementId", "condition"])
+        .agg(pl.col("abundance").sum())
+        .join(totals, on=keys + ["condition"], how="left")
+        .select(keys + ["elementId", (pl.col("abundance") / pl.col("total")).fill_null(0.0).alias("frequency")])
+        .group_by(keys + ["elementId"])
+        .agg(pl.col("frequency").max().alias("MaxFrequency"))
+        .sort(keys + ["elementId"])
+        .collect(engine="streaming")
+    )
+    if result.height == 0:
+        result = empty.with_columns(pl.lit(None, dtype=pl.Utf8).alias("target")) if keys else empty
+    if not several:
+        return result
+    if not keys:
+        return {target: result for target in targets}
+    return {target: result.filter(pl.col("target") == target).drop("target") for target in targets}
+
+
+def _sparse_max_frequency(agg, condition_order, totals):
+    """
+    MaxFrequency from the per-(elementId, condition) abundance sums, via a
+    sparse clonotype x condition matrix of the target rounds.
+    """
+    ids = agg.select(pl.col("elementId").unique().sort()).with_row_index("row")
+    # Rounds with no reads have frequency 0 everywhere: leave their columns empty
+    rounds = [c for c in condition_order if totals.get(c, 0) > 0]
+    observed = (
+        agg.filter(pl.col("condition").is_in(rounds))
+        .join(ids, on="elementId", how="left", nulls_equal=True)
+        .select(
+            "row",
+            pl.col("condition").replace_strict(rounds, list(range(len(rounds))),
+                                               return_dtype=pl.UInt32),
+            "abundance",
+        )
+    )
+    counts = sparse.coo_matrix(
+        (observed["abundance"].to_numpy(),
+         (observed["row"].to_numpy(), observed["condition"].to_numpy())),
+        shape=(ids.height, len(condition_order)),
+    ).tocsc()
+
+    # Divide each column's stored counts by its round total, as the dense engine does
+    for i, c in enumerate(rounds):
+        start, end = counts.indptr[i], counts.indptr[i + 1]
+        counts.data[start:end] /= totals[c]
+
+    max_freq = np.zeros(ids.height) if counts.shape[1] == 0 else counts.max(axis=1).toarray().ravel()
+    return ids.select(
+        "elementId",
+        pl.Series("MaxFrequency", max_freq, dtype=pl.Float64),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per-clonotype max frequency across target rounds")
+    parser.add_argument("--input_data", required=True,
+                        help="Downsampling output table (clonotype resolution).")
+    parser.add_argument("--conditions", type=str, required=True,
+                        help="JSON list of target conditions (rounds), ordered.")
+    parser.add_argument("--current_target", type=str, default=None,
+                        help="Target antigen value; when set, only its rows are "
+                             "used (excludes library and negative controls).")
+    parser.add_argument("--targets", type=str, required=False,
+                        help="JSON list of target antigens to compute in one pass, in place of "
+                             "--current_target; --output must then contain '{target}'")
+    parser.add_argument("--engine", choices=max_frequency_engines, default="long",
+                        help="Streamed grouped max over the long table, dense clonotype x condition "
+                             "pivot, or sparse matrix of observed counts")
+    parser.add_argument("--output", required=True)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    condition_order = [str(c) for c in json.loads(args.conditions)]
+    targets = json.loads(args.targets) if args.targets else None
+    if targets is not None and '{target}' not in args.output:
+        parser.error(f"with --targets, --output must contain '{{target}}': {args.output}")
+
+    profiler = StageProfiler("clonotype_max_frequency", args.profile)
+    if args.engine == "long":
+        # Lazy: the table is read by the max frequency stage
+        df = scan_table(args.input_data, schema_overrides={"condition": pl.Utf8})
+    else:
+        with profiler.stage("ingestion") as stage:
+            df = read_table(args.input_data, schema_overrides={"condition": pl.Utf8})
+            stage["rows"] = df.height
+    with profiler.stage("max_frequency") as stage:
+        if targets is None:
+            results = {None: max_frequency(df, condition_order, args.current_target, args.engine)}
+        else:
+            results = max_frequency(df, condition_order, engine=args.engine, targets=targets)
+        stage["rows"] = sum(result.height for result in results.values())
+    del df
+    with profiler.stage("write_output"):
+        for target, result in results.items():
+            write_table(result, args.output if target is None else args.output.replace('{target}', target))
+    profiler.finish()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,62 @@
 import polars as pl
 import numpy as np
-from numpy.random import default_rng
+from numpy.random import default_rng, SeedSequence
+import argparse
+import hashlib
 import json
-from scipy.special import binom
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from profiling import NULL_PROFILER, StageProfiler, add_profile_argument
+from table_io import read_table, scan_table, sink_table, table_format, write_table
 
 
 # sample cloneKey count
 
 input_file = "input.csv"
+output_file = "result.csv"
 downsampling_file = "downsampling.json"
 
+# Base seed; every sample gets its own stream derived from this and its sampleId
+downsampling_seed = 31415
+
+# Multivariate hypergeometric sampler engines (all exact):
+#   count     - draws reads from an expanded urn; time ~ total reads, with a
+#               temporary array of 8 bytes per read
+#   marginals - chain of univariate hypergeometric draws, one per clonotype;
+#               time ~ number of clonotypes, requires total reads < 10**9
+#   subset    - draws a uniform subset of read positions (Floyd's algorithm)
+#               and counts them per clonotype; time and memory ~ the smaller
+#               of the depth and the reads left out, any total reads
+#   auto      - picks the cheaper of count and marginals per sample, and
+#               subset beyond the marginals limit
+sampler_engines = ["auto", "count", "marginals", "subset"]
+
+# Measured on power-law abundance vectors: "count" costs ~13 ns per read and
+# "marginals" ~250 ns per clonotype, so "count" wins below ~20 reads/clonotype
+count_reads_per_clonotype = 20
+# Cap on the temporary urn of the "count" engine (8 bytes per read, 256 MiB)
+count_max_reads = 2**25
+# Precision limit of numpy's "marginals" method
+marginals_max_reads = 10**9
+# Cap on the draws of the "subset" engine: ~40 bytes per draw (positions, the
+# hash set of Floyd's algorithm and their clonotype indices), ~160 MiB
+subset_bytes_per_draw = 40
+subset_max_draws = 2**22
+
+# Part of the result cache key: bump whenever a change to the sampling code
+# alters downsampled values, so stale cache entries are never served
+sampler_version = 2
+# Default size bound of the result cache, least recently used entries go first
+cache_max_mb = 10 * 1024
+
 
 # Parse the parameters from the JSON file
-def parse_params():
+def parse_params(downsampling_file=downsampling_file):
     try:
         with open(downsampling_file, 'r') as f:
             downsampling_params = json.load(f)
@@ -25,85 +69,498 @@ def parse_params():
         return {}
 
 
-def downsample_sample(sample_df, downsampling):
+def resolve_downsampling_value(downsampling, totals_values):
     """
-    Downsample a dataframe representing a single sample using polars.
+    Resolve the target depth for hypergeometric downsampling from the
+    per-sample totals. Returns None when no downsampling is requested.
     """
     if downsampling['type'] == "none":
-        return sample_df.with_columns(pl.col('abundance').alias('downsampledAbundance'))
+        return None
 
     elif downsampling['type'] == "hypergeometric":
         if downsampling['valueChooser'] == "min":
-            value = np.min(totals_values)
+            return np.min(totals_values)
         elif downsampling['valueChooser'] == "fixed":
-            value = downsampling['n']
+            return downsampling['n']
         elif downsampling['valueChooser'] == "auto":
-            value = fixed_auto_downsampling_value
+            # Calculate 20th percentile across all totals
+            q20 = np.percentile(totals_values, 20)
+
+            # Find the minimum value that is above 0.5*q20
+            above_threshold = totals_values[totals_values > 0.5 * q20]
+            return np.min(above_threshold) if len(above_threshold) > 0 else q20
+
+    else:
+        raise ValueError(f"Invalid downsampling type: {downsampling['type']}")
 
-        total_abundance = sample_df.select(pl.col('abundance').sum()).item()
-        if total_abundance < value:
-            return sample_df.with_columns(pl.col('abundance').alias('downsampledAbundance'))
 
-        rng = default_rng(31415)  # always fix seed for reproducibility
+def sample_seed(sample_id):
+    """
+    Seed sequence for a sample, derived from the base seed and the sampleId
+    only, so a sample gets the same independent random stream regardless of
+    which worker processes it or in which order.
+    """
+    digest = hashlib.sha256(str(sample_id).encode('utf-8')).digest()
+    words = np.frombuffer(digest[:16], dtype=np.uint32)
+    return SeedSequence([downsampling_seed] + [int(w) for w in words])
+
+
+def choose_sampler_engine(total_reads, n_clonotypes, depth):
+    """
+    Pick the cheaper exact sampler for a sample from its total reads, its
+    number of nonzero clonotypes and the depth it is downsampled to. Samples
+    beyond the limits of every engine's temporary memory raise ValueError.
+    """
+    if total_reads >= marginals_max_reads:
+        if min(depth, total_reads - depth) > subset_max_draws:
+            raise ValueError(
+                f"Cannot downsample a sample of {total_reads} reads to {depth} reads: the exact samplers "
+                f"need total reads below {marginals_max_reads}, or a depth within {subset_max_draws} reads "
+                f"of 0 or of the total (see --sampler to force an engine)")
+        return "subset"
+    if total_reads <= count_max_reads and total_reads <= count_reads_per_clonotype * n_clonotypes:
+        return "count"
+    return "marginals"
+
+
+def sampler_max_bytes(n_clonotypes):
+    """
+    Largest temporary memory the "auto" engine choice allocates for a sample
+    of n_clonotypes nonzero clonotypes, whatever its reads and depth.
+    """
+    count_bytes = 8 * min(count_reads_per_clonotype * n_clonotypes, count_max_reads)
+    return max(count_bytes, subset_bytes_per_draw * subset_max_draws)
+
+
+def subset_hypergeometric(colors, nsample, rng):
+    """
+    Multivariate hypergeometric draw as a uniform subset of read positions:
+    reads [0, total) are laid out clonotype after clonotype and each drawn
+    position is counted for the clonotype it falls in. When more than half
+    of the reads are drawn, the reads left out are drawn instead.
+    """
+    total = int(colors.sum())
+    complement = nsample > total - nsample
+    draws = total - nsample if complement else nsample
+    # Without shuffling, numpy picks a small subset of a large range by
+    # Floyd's algorithm, in memory ~ draws
+    positions = rng.choice(total, draws, replace=False, shuffle=False)
+    drawn = np.bincount(
+        np.searchsorted(np.cumsum(colors), positions, side='right'), minlength=len(colors))
+    return colors - drawn if complement else drawn
+
+
+def downsample_sample(abundance_values, value, seed, engine="auto"):
+    """
+    Downsample the abundance vector of a single sample to the given depth.
+    Samples with fewer reads than the depth are returned unchanged.
+    """
+    total_reads = abundance_values.sum()
+    if value is None or total_reads < value:
+        return abundance_values
 
-        # Convert to numpy for hypergeometric sampling
-        abundance_values = sample_df.select('abundance').to_numpy().flatten().astype(np.int64)
-        downsampled_values = rng.multivariate_hypergeometric(abundance_values, int(value))
-        
-        # Create new dataframe with downsampled values
-        result_df = sample_df.with_columns(pl.lit(downsampled_values).alias('downsampledAbundance'))
-        
-        return result_df
+    # Zero-abundance clonotypes can never be drawn; sample only the rest
+    nonzero = np.flatnonzero(abundance_values)
+    if engine == "auto":
+        engine = choose_sampler_engine(total_reads, len(nonzero), int(value))
 
+    rng = default_rng(seed)  # always fix seed for reproducibility
+    downsampled_values = np.zeros_like(abundance_values)
+    if engine == "subset":
+        downsampled_values[nonzero] = subset_hypergeometric(abundance_values[nonzero], int(value), rng)
     else:
-        raise ValueError(f"Invalid downsampling type: {downsampling['type']}")
+        downsampled_values[nonzero] = rng.multivariate_hypergeometric(
+            abundance_values[nonzero], int(value), method=engine)
+    return downsampled_values
+
+
+def downsample_nested(abundance_values, depths, seed, engine="auto"):
+    """
+    Nested (rarefaction) downsampling of a single sample: going from the
+    largest depth to the smallest, each depth is a hypergeometric subsample
+    of the previous one. Returns one vector per depth, in the given order.
+    """
+    order = sorted(range(len(depths)), key=lambda i: depths[i], reverse=True)
+    nested_values = [None] * len(depths)
+    current_values = abundance_values
+    for child_seed, i in zip(seed.spawn(len(depths)), order):
+        current_values = downsample_sample(current_values, depths[i], child_seed, engine)
+        nested_values[i] = current_values
+    return nested_values
+
+
+def depth_column(depth):
+    return f'downsampledAbundance_{depth}'
+
+
+def _downsample_task(task):
+    """
+    Downsampled columns of one sample: downsampledAbundance plus one column
+    per nested depth.
+    """
+    abundance_values, sample_id, value, engine, depths = task
+    columns = {
+        'downsampledAbundance': downsample_sample(
+            abundance_values, value, sample_seed(sample_id), engine)
+    }
+    if depths:
+        # Children of the sample seed, independent of the main stream above
+        nested_values = downsample_nested(
+            abundance_values, depths, sample_seed(sample_id), engine)
+        for depth, values in zip(depths, nested_values):
+            columns[depth_column(depth)] = values
+    return columns
+
+
+def _downsample_partition_task(task):
+    paths, sample_id, value, engine, depths = task
+    sample_df = pl.read_parquet(paths)
+    abundance_values = sample_df.get_column('abundance').to_numpy().astype(np.int64)
+    columns = _downsample_task((abundance_values, sample_id, value, engine, depths))
+    return sample_df.with_columns(
+        [pl.Series(name, values) for name, values in columns.items()])
+
+
+def clean_abundance(frame, schema):
+    """
+    Drop empty abundance strings and cast abundance to integers. Works on both
+    DataFrame and LazyFrame inputs.
+    """
+    # Check if abundance column is string type and filter empty strings before casting
+    if schema['abundance'] in [pl.Utf8, pl.String]:
+        frame = frame.filter(pl.col('abundance').ne(""))
+    return frame.with_columns(pl.col("abundance").cast(pl.Int64))
+
+
+def downsample(data, downsampling, workers=1, engine="auto", depths=None):
+    """
+    Add a downsampledAbundance column to the table.
+
+    The table is sorted by sampleId once (stable, so rows keep their input
+    order within a sample) and every sample is then processed as a contiguous
+    slice of the abundance column, writing into a single preallocated output
+    array instead of filtering and concatenating per sample.
+
+    With workers > 1 samples are downsampled concurrently in a process pool.
+    Results do not depend on the number of workers (see sample_seed).
+    `engine` selects the hypergeometric sampler (see sampler_engines).
+    With `depths`, a downsampledAbundance_<depth> column is added per depth
+    (see downsample_nested).
+    """
+    depths = depths or []
+    data = data.sort('sampleId', maintain_order=True)
+
+    # Sample boundaries as offsets into the sorted table
+    sample_runs = data.select(pl.col('sampleId').rle()).unnest('sampleId')
+    sample_ids = sample_runs.get_column('value').to_list()
+    sample_sizes = sample_runs.get_column('len').to_numpy().astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(sample_sizes)))
+
+    abundance_values = data.get_column('abundance').to_numpy().astype(np.int64)
+    totals_values = np.add.reduceat(abundance_values, offsets[:-1])
+
+    value = resolve_downsampling_value(downsampling, totals_values)
+
+    column_names = ['downsampledAbundance'] + [depth_column(depth) for depth in depths]
+    downsampled_columns = {name: np.empty_like(abundance_values) for name in column_names}
+    bounds = list(zip(offsets[:-1], offsets[1:]))
+    tasks = (
+        (abundance_values[start:end], sample_id, value, engine, depths)
+        for sample_id, (start, end) in zip(sample_ids, bounds)
+    )
+
+    if workers > 1 and len(bounds) > 1:
+        # spawn rather than fork: polars' thread pool is not fork-safe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            results = executor.map(_downsample_task, tasks)
+            for (start, end), sampled in zip(bounds, results):
+                for name in column_names:
+                    downsampled_columns[name][start:end] = sampled[name]
+    else:
+        for (start, end), task in zip(bounds, tasks):
+            sampled = _downsample_task(task)
+            for name in column_names:
+                downsampled_columns[name][start:end] = sampled[name]
+
+    return data.with_columns(
+        [pl.Series(name, values) for name, values in downsampled_columns.items()])
+
+
+def downsample_table(data, downsampling, workers=1, engine="auto", depths=None):
+    """
+    Clean the abundance column of a freshly read clone table and downsample it.
+    """
+    data = clean_abundance(data, data.schema)
+
+    # If there are no clonotypes, return empty dataframe
+    if data.count()["elementId"].item() == 0:
+        empty_columns = ['downsampledAbundance'] + [depth_column(depth) for depth in depths or []]
+        return data.with_columns([pl.lit(0).alias(name) for name in empty_columns])
+
+    return downsample(data, downsampling, workers=workers, engine=engine, depths=depths)
+
+
+def rollup_to_clusters(data, mapping):
+    """
+    Cluster-level clone table from a (downsampled) clonotype-level one.
+
+    `mapping` holds elementId (clonotype) and clusterId columns. The abundance
+    and downsampled abundance columns of each clonotype are summed into its
+    cluster per sample, so cluster and clonotype numbers come from the same
+    draw; clonotypes without a cluster are dropped. Sample-level columns
+    (condition, antigen) are carried over and elementId then holds the
+    clusterId. Rows keep the input order of each cluster's first clonotype
+    (so samples stay contiguous). Works on both DataFrame and LazyFrame
+    inputs.
+    """
+    names = data.collect_schema().names()
+    summed = [name for name in names
+              if name == 'abundance' or name.startswith('downsampledAbundance')]
+    carried = [name for name in names if name not in summed and name not in ('sampleId', 'elementId')]
+
+    clusters = (
+        mapping.lazy()
+        .select(pl.col('elementId').cast(pl.Utf8), pl.col('clusterId').cast(pl.Utf8))
+        .unique()
+    )
+    rolled_up = (
+        data.lazy()
+        .with_columns(pl.col('elementId').cast(pl.Utf8))
+        .join(clusters, on='elementId', how='inner', maintain_order='left')
+        .group_by(['sampleId', 'clusterId'], maintain_order=True)
+        .agg([pl.col(name).sum() for name in summed] + [pl.col(name).first() for name in carried])
+        .rename({'clusterId': 'elementId'})
+        .select(names)
+    )
+    return rolled_up.collect() if isinstance(data, pl.DataFrame) else rolled_up
+
+
+def downsample_streaming(input_path, output_path, downsampling, workers=1, engine="auto",
+                         depths=None):
+    """
+    Out-of-core variant of downsample() that never holds the whole table.
+
+    The first pass streams the input to compute per-sample totals, which is
+    all the depth choice needs. The second pass spills the input into one
+    Parquet partition per sample; samples are then read back, downsampled and
+    appended to the output one at a time (or `workers` at a time), so peak
+    memory is bounded by the largest sample(s) rather than the dataset.
+    Output is identical to the in-memory mode.
+    """
+    lf = scan_table(input_path)
+    lf = clean_abundance(lf, lf.collect_schema())
+
+    totals = (
+        lf.group_by('sampleId')
+        .agg(pl.col('abundance').sum())
+        .collect(engine='streaming')
+    )
+
+    # If there are no clonotypes, return empty dataframe
+    if totals.height == 0:
+        empty_columns = ['downsampledAbundance'] + [depth_column(depth) for depth in depths or []]
+        write_table(lf.with_columns([pl.lit(0).alias(name) for name in empty_columns]).collect(),
+                    output_path)
+        return
+
+    totals_values = totals.get_column('abundance').to_numpy()
+    value = resolve_downsampling_value(downsampling, totals_values)
+
+    # Spill next to the output rather than into /tmp, which may be memory-backed
+    with tempfile.TemporaryDirectory(prefix='downsampling-', dir='.') as spill_dir:
+        partitions = []
+        lf.sink_parquet(
+            pl.PartitionByKey(spill_dir, by='sampleId', include_key=True,
+                              finish_callback=partitions.append),
+            mkdir=True,
+        )
+        sample_paths = (
+            partitions[0]
+            .select(pl.col('keys').struct.field('sampleId'), 'path')
+            .group_by('sampleId', maintain_order=True)
+            .agg('path')
+            .sort('sampleId')
+        )
+        tasks = [
+            (paths, sample_id, value, engine, depths or [])
+            for sample_id, paths in sample_paths.iter_rows()
+        ]
+
+        parts = _run_partition_tasks(tasks, workers)
+        if table_format(output_path) == 'csv':
+            with open(output_path, 'w') as output:
+                for i, part_df in enumerate(parts):
+                    part_df.write_csv(output, include_header=(i == 0))
+        else:
+            # Binary formats cannot be appended to: stage the downsampled
+            # samples and stream them into the output in order
+            part_paths = []
+            for i, part_df in enumerate(parts):
+                part_paths.append(os.path.join(spill_dir, f'downsampled-{i}.parquet'))
+                part_df.write_parquet(part_paths[-1])
+            sink_table(pl.scan_parquet(part_paths), output_path)
+
+
+def _run_partition_tasks(tasks, workers):
+    """Yield downsampled sample frames in task order."""
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _downsample_partition_task(task)
+        return
+
+    # Keep at most `workers` samples in flight to bound memory
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(_downsample_partition_task, task))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def cache_entry(input_path, downsampling, engine, depths, output_path):
+    """
+    Cache entry name of a downsampling result: a hash of the input content,
+    the downsampling parameters and everything else that determines the
+    sampled values, with the extension of the output format.
+    """
+    digest = hashlib.sha256()
+    with open(input_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    settings = {
+        'downsampling': downsampling,
+        'seed': downsampling_seed,
+        'samplerVersion': sampler_version,
+        'numpy': np.__version__,
+        'engine': engine,
+        'depths': depths,
+    }
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest() + os.path.splitext(output_path)[1].lower()
+
+
+def cache_lookup(cache_dir, entry, output_path):
+    """Copy a cached result to output_path; returns False on a miss."""
+    cached_path = os.path.join(cache_dir, entry)
+    try:
+        shutil.copyfile(cached_path, output_path)
+        # Mark as recently used for eviction
+        os.utime(cached_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def cache_store(cache_dir, entry, output_path, max_bytes):
+    """Add a result to the cache, then evict down to max_bytes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    # Copy under a temporary name first so readers never see a partial entry
+    fd, staging_path = tempfile.mkstemp(prefix='.staging-', dir=cache_dir)
+    os.close(fd)
+    shutil.copyfile(output_path, staging_path)
+    os.replace(staging_path, os.path.join(cache_dir, entry))
+    cache_evict(cache_dir, max_bytes)
+
+
+def cache_evict(cache_dir, max_bytes):
+    """Remove least recently used entries until the cache fits in max_bytes."""
+    entries = []
+    for dir_entry in os.scandir(cache_dir):
+        if dir_entry.is_file() and not dir_entry.name.startswith('.'):
+            stat = dir_entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+
+    total_bytes = 0
+    for _, size, path in sorted(entries, reverse=True):
+        total_bytes += size
+        if total_bytes > max_bytes:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already evicted by a concurrent run
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hypergeometric downsampling of clone abundances")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes used to downsample samples in parallel")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Process the input out of core, holding one sample at a time in memory")
+    parser.add_argument("--sampler", choices=sampler_engines, default="auto",
+                        help="Hypergeometric sampler engine (default: chosen per sample)")
+    parser.add_argument("--depths", type=str, required=False,
+                        help="JSON list of depths for nested (rarefaction) downsampling; adds a "
+                             "downsampledAbundance_<depth> column per depth")
+    parser.add_argument("--input", default=input_file,
+                        help="Input clone table (.csv, .parquet or .arrow)")
+    parser.add_argument("--output", default=output_file,
+                        help="Output table; the format follows the extension (.csv, .parquet or .arrow)")
+    parser.add_argument("--cache_dir", required=False,
+                        help="Directory of a local result cache; a run with the same input content, "
+                             "parameters and sampler settings reuses the stored result")
+    parser.add_argument("--cache_max_mb", type=int, default=cache_max_mb,
+                        help="Size bound of the result cache in MiB (least recently used entries are evicted)")
+    parser.add_argument("--cluster_mapping", required=False,
+                        help="Clonotype to cluster table (elementId, clusterId) of a clonotype-level input; "
+                             "the downsampled clonotypes are also rolled up to clusters in --cluster_output")
+    parser.add_argument("--cluster_output", required=False,
+                        help="Output cluster-level table with --cluster_mapping")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if (args.cluster_mapping is None) != (args.cluster_output is None):
+        parser.error("--cluster_mapping and --cluster_output must be given together")
+
+    profiler = StageProfiler("downsampling", args.profile)
+    downsampling_params = parse_params()
+    depths = sorted({int(depth) for depth in json.loads(args.depths)}, reverse=True) if args.depths else []
+
+    if args.cache_dir:
+        with profiler.stage("cache_lookup"):
+            entry = cache_entry(args.input, downsampling_params, args.sampler, depths, args.output)
+            cached = cache_lookup(args.cache_dir, entry, args.output)
+        if cached:
+            write_clusters(args, profiler)
+            profiler.finish()
+            return
+
+    if args.streaming:
+        # Reading, sampling and writing are interleaved per sample
+        with profiler.stage("downsampling"):
+            downsample_streaming(args.input, args.output, downsampling_params,
+                                 workers=args.workers, engine=args.sampler, depths=depths)
+    else:
+        with profiler.stage("ingestion") as stage:
+            input_data = read_table(args.input)
+            stage["rows"] = input_data.height
+        with profiler.stage("downsampling") as stage:
+            result_data = downsample_table(input_data, downsampling_params,
+                                           workers=args.workers, engine=args.sampler, depths=depths)
+            stage["rows"] = result_data.height
+        del input_data
+
+        # Write the result (CSV unless a binary format is requested)
+        with profiler.stage("write_output"):
+            write_table(result_data, args.output)
+
+    if args.cache_dir:
+        with profiler.stage("cache_store"):
+            cache_store(args.cache_dir, entry, args.output, args.cache_max_mb * 2**20)
+    write_clusters(args, profiler)
+    profiler.finish()
+
+
+def write_clusters(args, profiler: StageProfiler = NULL_PROFILER):
+    """Roll the downsampled clonotype output up to clusters (--cluster_mapping)."""
+    if args.cluster_mapping:
+        with profiler.stage("cluster_rollup"):
+            sink_table(rollup_to_clusters(scan_table(args.output), scan_table(args.cluster_mapping)),
+                       args.cluster_output)
+
 
-downsampling_params = parse_params()
-data = pl.read_csv(input_file)
-# Check if abundance column is string type and filter empty strings before casting
-if data.schema['abundance'] in [pl.Utf8, pl.String]:
-    data = data.filter(pl.col('abundance').ne(""))
-data = data.with_columns(pl.col("abundance").cast(pl.Int64))
-
-# If there are no clonotypes, return empty dataframe
-if data.count()["elementId"].item() == 0:
-    data = data.with_columns(pl.lit(0).alias('downsampledAbundance'))
-    data.write_csv('result.csv')
-    exit()
-
-# Calculate sample totals efficiently
-totals = data.group_by('sampleId').agg(pl.col('abundance').sum())
-totals_values = totals.select('abundance').to_numpy().flatten()
-
-# Calculate 20th percentile across all totals
-q20 = np.percentile(totals_values, 20)
-
-# Find the minimum value that is above 0.5*q20
-above_threshold = totals_values[totals_values > 0.5 * q20]
-min_above_threshold = np.min(above_threshold) if len(above_threshold) > 0 else q20
-fixed_auto_downsampling_value = min_above_threshold
-
-# Process each sample group efficiently
-downsampled_parts = []
-
-# Get unique sample IDs in sorted order for deterministic processing
-sample_ids = data.select('sampleId').unique().sort('sampleId').to_series()
-
-for sample_id in sample_ids:
-    # Filter data for this sample
-    sample_data = data.filter(pl.col('sampleId') == sample_id)
-    
-    # Downsample this sample
-    downsampled_sample = downsample_sample(sample_data, downsampling_params)
-    
-    # Add to results
-    downsampled_parts.append(downsampled_sample)
-
-# Combine all parts
-if downsampled_parts:
-    result_data = pl.concat(downsampled_parts)
-else:
-    result_data = data.with_columns(pl.col('abundance').alias('downsampledAbundance'))
-
-# Write the result to CSV
-result_data.write_csv('result.csv')
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,28 @@
 import polars as pl
 import numpy as np
+import argparse
+import contextlib
 import json
-from typing import List, Dict, Optional, Tuple
+import os
+import tempfile
+from typing import Iterable, List, Dict, Optional, Tuple
+
+from scipy import sparse
+
+from enrichment_annotations import annotation_stats
+from profiling import NULL_PROFILER, StageProfiler, add_profile_argument
+from table_io import scan_table, sink_table, write_table
+
+# Engines computing the pairwise enrichment columns (see _calculate_enrichments_vectorized);
+# "sparse" also keeps the clonotype x condition counts in a scipy.sparse matrix
+enrichment_engines = ["polars", "numpy", "sparse"]
+# Which comparison columns are materialized: every pair, or only the consumed
+# ones (vs baseline, exports); see hybrid_enrichment_analysis
+comparison_modes = ["all", "consumed"]
 
 
 def filter_clonotypes_by_criteria(
-    aggregated_df: pl.DataFrame,
+    pivot_df: pl.DataFrame,
     condition_order: List[str],
     filter_single_sample: bool = False,
     filter_any_zero: bool = False,
@@ -22,8 +39,12 @@ def filter_clonotypes_by_criteria(
     """
     Filter clonotypes based on specified criteria.
 
+    All enabled criteria are combined into a single boolean mask evaluated in
+    one pass over the pivot table.
+
     Args:
-        aggregated_df: DataFrame with columns [elementId, condition, abundance]
+        pivot_df: DataFrame with elementId and one abundance column per condition
+                  (every condition of condition_order must be present)
         condition_order: List of conditions in order
         filter_single_sample: If True, remove clonotypes present in only one sample
         filter_any_zero: If True, remove clonotypes with zero abundance in any sample
@@ -38,48 +59,17 @@ def filter_clonotypes_by_criteria(
         exclude_sequenced_library: If True, exclude library from filter_any_zero requirement
 
     Returns:
-        Filtered DataFrame with same structure as input
+        Rows of pivot_df that pass all criteria
     """
-    if not (filter_single_sample or filter_any_zero or min_abundance > 0 or 
-            (min_frequency > 0 and total_reads_dict) or present_in_rounds):
-        return aggregated_df
-
-    # Create pivot table to analyze abundance patterns
-    pivot_for_filtering = (
-        aggregated_df
-        .pivot(values='abundance', index='elementId', on='condition', aggregate_function='sum')
-        .fill_null(0)
-    )
-
-    # Ensure all conditions are present
-    for condition in condition_order:
-        if condition not in pivot_for_filtering.collect_schema().names():
-            pivot_for_filtering = pivot_for_filtering.with_columns(
-                pl.lit(0).alias(condition))
-
-    # Select condition columns in the specified order
-    condition_cols = [
-        col for col in condition_order if col in pivot_for_filtering.collect_schema().names()]
-    pivot_for_filtering = pivot_for_filtering.select(
-        ['elementId'] + condition_cols)
+    condition_cols = list(condition_order)
+    criteria: List[pl.Expr] = []
 
-    elements_to_keep = None
+    def non_zero_count(cols: List[str]) -> pl.Expr:
+        return pl.sum_horizontal([(pl.col(col) > 0).cast(pl.Int32) for col in cols])
 
-    if filter_single_sample:
+    if filter_single_sample and condition_cols:
         # Filter out clonotypes present in only one sample (zero abundance in all but one)
-        # Count non-zero abundances per clonotype
-        non_zero_counts = pivot_for_filtering.with_columns(
-            pl.concat_list([pl.when(pl.col(col) > 0).then(
-                1).otherwise(0) for col in condition_cols])
-            .list.sum()
-            .alias('non_zero_count')
-        )
-
-        # Keep clonotypes present in more than one sample
-        single_sample_filter = non_zero_counts.filter(
-            pl.col('non_zero_count') > 1).select('elementId')
-        elements_to_keep = single_sample_filter if elements_to_keep is None else elements_to_keep.join(
-            single_sample_filter, on='elementId', how='inner')
+        criteria.append(non_zero_count(condition_cols) > 1)
 
     if filter_any_zero:
         # Filter out clonotypes with zero abundance in any sample
@@ -90,28 +80,14 @@ def filter_clonotypes_by_criteria(
             target_cols = [c for c in condition_cols if c != library_condition]
         else:
             target_cols = condition_cols
-        
+
         if target_cols:
             # Keep only clonotypes with non-zero abundance in ALL target samples
-            all_non_zero = pivot_for_filtering.with_columns(
-                pl.concat_list([pl.when(pl.col(col) > 0).then(1).otherwise(0) for col in target_cols])
-                .list.sum()
-                .alias('non_zero_count')
-            )
+            criteria.append(non_zero_count(target_cols) == len(target_cols))
 
-            # Keep clonotypes present in ALL target samples
-            any_zero_filter = all_non_zero.filter(
-                pl.col('non_zero_count') == len(target_cols)).select('elementId')
-            elements_to_keep = any_zero_filter if elements_to_keep is None else elements_to_keep.join(
-                any_zero_filter, on='elementId', how='inner')
-
-    if min_abundance > 0:
+    if min_abundance > 0 and condition_cols:
         # Filter out clonotypes with maximum abundance below threshold
-        min_abundance_filter = pivot_for_filtering.filter(
-            pl.any_horizontal([pl.col(col) >= min_abundance for col in condition_cols])
-        ).select('elementId')
-        elements_to_keep = min_abundance_filter if elements_to_keep is None else elements_to_keep.join(
-            min_abundance_filter, on='elementId', how='inner')
+        criteria.append(pl.any_horizontal([pl.col(col) >= min_abundance for col in condition_cols]))
 
     if min_frequency > 0 and total_reads_dict:
         # Filter out clonotypes with maximum frequency below threshold
@@ -122,41 +98,27 @@ def filter_clonotypes_by_criteria(
             if total >= 1:
                 # Use same frequency formula with pseudocount as in enrichment calculation
                 # Denominator must include n_clonotypes * pseudo_count to ensure frequencies sum to 1
-                freq_filters.append((pl.col(col) + pseudo_count) / (total + (n_clonotypes * pseudo_count)) >= min_frequency)
-        
+                freq_filters.append(_frequency_expr(col, total, n_clonotypes, pseudo_count) >= min_frequency)
+
         if freq_filters:
-            min_frequency_filter = pivot_for_filtering.filter(
-                pl.any_horizontal(freq_filters)
-            ).select('elementId')
-            elements_to_keep = min_frequency_filter if elements_to_keep is None else elements_to_keep.join(
-                min_frequency_filter, on='elementId', how='inner')
+            criteria.append(pl.any_horizontal(freq_filters))
 
     if present_in_rounds and len(present_in_rounds) > 0:
         # Filter by presence in specific rounds
         # Ensure selected rounds exist in data
-        existing_rounds = [r for r in present_in_rounds if r in pivot_for_filtering.collect_schema().names() and r in condition_order]
-        
+        existing_rounds = [r for r in present_in_rounds if r in condition_order]
+
         if existing_rounds:
             logic = present_in_rounds_logic.upper()
             if logic == "AND":
-                presence_filter = pivot_for_filtering.filter(
-                    pl.all_horizontal([pl.col(col) > 0 for col in existing_rounds])
-                ).select('elementId')
+                criteria.append(pl.all_horizontal([pl.col(col) > 0 for col in existing_rounds]))
             else:  # Default to OR
-                presence_filter = pivot_for_filtering.filter(
-                    pl.any_horizontal([pl.col(col) > 0 for col in existing_rounds])
-                ).select('elementId')
-                
-            elements_to_keep = presence_filter if elements_to_keep is None else elements_to_keep.join(
-                presence_filter, on='elementId', how='inner')
-
-    if elements_to_keep is not None:
-        # Filter the original aggregated data
-        filtered_df = aggregated_df.join(
-            elements_to_keep, on='elementId', how='inner')
-        return filtered_df
+                criteria.append(pl.any_horizontal([pl.col(col) > 0 for col in existing_rounds]))
+
+    if criteria:
+        return pivot_df.filter(pl.all_horizontal(criteria))
     else:
-        return aggregated_df
+        return pivot_df
 
 
 def create_empty_outputs(
@@ -167,9 +129,10 @@ def create_empty_outputs(
     top_10_csv: Optional[str] = None,
     highest_enrichment_csv: Optional[str] = None,
     filtered_too_much_txt: Optional[str] = None
-) -> None:
+) -> Dict[str, pl.DataFrame]:
     """
     Create empty output files when input data is empty.
+    Returns the written frames keyed as in hybrid_enrichment_analysis.
     """
     # Create empty enrichment results with all expected columns
     enrichment_schema = {
@@ -195,7 +158,7 @@ def create_empty_outputs(
     enrichment_schema['EnrichmentQuality'] = pl.Utf8
     
     empty_enrichment = pl.DataFrame(schema=enrichment_schema)
-    empty_enrichment.write_csv(enrichment_csv)
+    write_table(empty_enrichment, enrichment_csv)
     
     # Create empty bubble data with proper schema
     empty_bubble = pl.DataFrame(schema={
@@ -205,7 +168,7 @@ def create_empty_outputs(
         'Binding Specificity': pl.Utf8, 'MaxNegControlEnrichment': pl.Float64, 'PresentInNegControl': pl.Boolean,
         'EnrichmentQuality': pl.Utf8
     })
-    empty_bubble.write_csv(bubble_csv)
+    write_table(empty_bubble, bubble_csv)
     
     # Create empty top enriched data with proper schema
     empty_top_enriched = pl.DataFrame(schema={
@@ -214,11 +177,17 @@ def create_empty_outputs(
         'Binding Specificity': pl.Utf8, 'MaxNegControlEnrichment': pl.Float64, 'PresentInNegControl': pl.Boolean,
         'EnrichmentQuality': pl.Utf8, 'MaxPositiveEnrichment': pl.Float64
     })
-    empty_top_enriched.write_csv(top_enriched_csv)
+    write_table(empty_top_enriched, top_enriched_csv)
+    outputs = {
+        'enrichment': empty_enrichment,
+        'bubble': empty_bubble,
+        'top_enriched': empty_top_enriched,
+    }
     
     # Create empty top 20 data if requested
     if top_10_csv:
-        empty_top_enriched.write_csv(top_10_csv)
+        write_table(empty_top_enriched, top_10_csv)
+        outputs['top_10'] = empty_top_enriched
     
     # Create empty highest enrichment data with proper schema
     if highest_enrichment_csv:
@@ -231,13 +200,670 @@ def create_empty_outputs(
             'Binding Specificity': pl.Utf8, 'MaxNegControlEnrichment': pl.Float64, 'PresentInNegControl': pl.Boolean,
             'EnrichmentQuality': pl.Utf8
         })
-        empty_highest.write_csv(highest_enrichment_csv)
+        write_table(empty_highest, highest_enrichment_csv)
+        outputs['highest_enrichment'] = empty_highest
 
     # Create filter check file
     if filtered_too_much_txt:
         with open(filtered_too_much_txt, 'w') as f:
             f.write("false")
 
+    return outputs
+
+
+def _encode_element_ids(aggregated_df: pl.DataFrame) -> Tuple[pl.DataFrame, pl.Series]:
+    """
+    Dictionary-encode elementId to a UInt32 id (0-based) assigned in sorted
+    elementId order, so sorting by id gives the same order as sorting by
+    elementId. Returns the encoded frame and the id -> elementId dictionary.
+    """
+    element_ids = aggregated_df.get_column('elementId').drop_nulls().unique().sort()
+    encoded_df = aggregated_df.with_columns(
+        (pl.col('elementId').rank('dense') - 1).alias('elementId'))
+    return encoded_df, element_ids
+
+
+def _redefine_clonotypes(input_df: pl.LazyFrame, clonotype_def_df: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Lazy clonotype redefinition stage: the downsampled abundance of every
+    input row becomes the summed abundance of all rows (any sample) whose
+    elementId has the same clonotypeDefinition_* values, in the same
+    condition. Rows with a null definition value or condition get a null
+    abundance, and an elementId missing from the definition table counts as
+    all-null.
+
+    The definition columns are reduced once, on the definition table, to an
+    integer key per distinct definition, so the input only gains that key
+    column: the sums are grouped and joined back on (key, condition) rather
+    than on the string definition columns.
+    """
+    def_cols = [col for col in clonotype_def_df.collect_schema().names()
+                if col.startswith('clonotypeDefinition_')]
+    if not def_cols:
+        return input_df.join(clonotype_def_df, on='elementId', how='left')
+
+    # One key per distinct definition; a null value matches no key (as a null
+    # never matches in a join on the columns themselves)
+    definitions = clonotype_def_df.select(['elementId'] + def_cols)
+    definition_keys = definitions.select(def_cols).unique().with_row_index('definitionKey')
+    element_keys = (
+        definitions.join(definition_keys, on=def_cols, how='left')
+        .select('elementId', 'definitionKey')
+    )
+
+    keyed_df = input_df.join(element_keys, on='elementId', how='left')
+    definition_sums = (
+        keyed_df.group_by(['definitionKey', 'condition'])
+        .agg(pl.col('downsampledAbundance').sum().alias('definitionAbundance'))
+    )
+    return (
+        keyed_df.join(definition_sums, on=['definitionKey', 'condition'], how='left')
+        .with_columns(pl.col('definitionAbundance').alias('downsampledAbundance'))
+        .drop('definitionKey', 'definitionAbundance')
+    )
+
+
+def _decode_element_ids(df, element_ids: pl.Series):
+    """Replace elementId ids with the original elementId values (eager or lazy frame)."""
+    if not df.collect_schema()['elementId'].is_integer():
+        # Empty placeholder frames are built with a string elementId already
+        return df
+    return df.with_columns(pl.lit(element_ids).gather(pl.col('elementId')).alias('elementId'))
+
+
+def _track_abundance_matrix(
+    long_df: pl.DataFrame,
+    n_tracks: int,
+    n_conditions: int,
+    sparse_output: bool = False
+) -> Tuple[np.ndarray, pl.Series, np.ndarray, np.ndarray]:
+    """
+    Pivot several tracks in one pass. long_df holds integer 'track' and
+    'condition' codes, elementId and abundance; the result is a matrix with
+    one row per (track, elementId) present and one column per condition,
+    holding the summed abundance (float64; absent combinations are 0). Rows
+    with a null condition code only add their elementId to the track.
+
+    The matrix is dense, or a scipy.sparse CSR matrix with sparse_output,
+    which stores only the observed (clonotype, condition) pairs.
+
+    Returns the track code and the elementId of every row (ordered by track,
+    then elementId with null last), the matrix, and a tracks x conditions
+    mask of the conditions each track has rows in.
+    """
+    null_id = int(long_df.get_column('elementId').max() or 0) + 1
+    track_codes = long_df.get_column('track').cast(pl.Int64).to_numpy()
+    # A null condition goes to an extra column, dropped below
+    condition_codes = long_df.get_column('condition').fill_null(n_conditions).cast(pl.Int64).to_numpy()
+    weights = long_df.get_column('abundance').cast(pl.Float64).to_numpy()
+
+    keys = track_codes * (null_id + 1)
+    keys += long_df.get_column('elementId').fill_null(null_id).cast(pl.Int64).to_numpy()
+    keys, rows = np.unique(keys, return_inverse=True)
+    if sparse_output:
+        # Duplicate (row, condition) entries are summed by the conversion
+        matrix = sparse.coo_matrix(
+            (weights, (rows, condition_codes)), shape=(len(keys), n_conditions + 1)
+        ).tocsr()[:, :n_conditions]
+    else:
+        rows *= n_conditions + 1
+        rows += condition_codes
+        matrix = np.bincount(
+            rows, weights=weights, minlength=len(keys) * (n_conditions + 1)
+        ).reshape(len(keys), n_conditions + 1)[:, :n_conditions]
+    present = np.bincount(
+        track_codes * (n_conditions + 1) + condition_codes, minlength=n_tracks * (n_conditions + 1)
+    ).reshape(n_tracks, n_conditions + 1)[:, :n_conditions] > 0
+
+    row_ids = pl.Series('elementId', keys % (null_id + 1))
+    row_ids = (
+        pl.select(pl.when(row_ids != null_id).then(row_ids))
+        .to_series()
+        .cast(long_df.schema['elementId'])
+        .alias('elementId')
+    )
+    return keys // (null_id + 1), row_ids, matrix, present
+
+
+def _matrix_column(matrix, i: int) -> np.ndarray:
+    """Column i of a dense or scipy.sparse matrix as a 1-D array."""
+    if sparse.issparse(matrix):
+        return matrix[:, i].toarray().ravel()
+    return matrix[:, i]
+
+
+def _frequency_denominator(total: float, n_clonotypes: int, pseudo_count: float) -> float:
+    """Denominator of the frequencies: Σ[(abundance + p) / (total + N*p)] = 1."""
+    return total + (n_clonotypes * pseudo_count)
+
+
+def _column_frequency(
+    counts,
+    i: int,
+    total: float,
+    n_clonotypes: int,
+    pseudo_count: float
+) -> pl.Series:
+    """
+    Frequencies of count column i, with the same formula and division as
+    the frequency expressions on the pivot tables (see _frequency_expr).
+    """
+    return pl.Series(np.divide(
+        _matrix_column(counts, i) + pseudo_count, _frequency_denominator(total, n_clonotypes, pseudo_count)))
+
+
+def _frequency_expr(column: str, total: float, n_clonotypes: int, pseudo_count: float) -> pl.Expr:
+    """
+    Frequencies of a count column as a polars expression. Polars divides a
+    column by a scalar as a product with its reciprocal on frames of more
+    than one row but exactly on a single row, so the division is done
+    against a column of the denominator instead: the same IEEE division
+    whatever the frame (or streaming slice) size.
+    """
+    denominator = _frequency_denominator(total, n_clonotypes, pseudo_count)
+    return (pl.col(column) + pseudo_count).map_batches(
+        lambda values: values / pl.Series(np.full(len(values), denominator)),
+        return_dtype=pl.Float64
+    )
+
+
+def _sparse_filter_mask(
+    counts: sparse.csc_matrix,
+    condition_order: List[str],
+    filter_single_sample: bool = False,
+    filter_any_zero: bool = False,
+    min_abundance: int = 0,
+    min_frequency: float = 0.0,
+    total_reads_dict: Optional[Dict[str, int]] = None,
+    present_in_rounds: Optional[List[str]] = None,
+    present_in_rounds_logic: str = "OR",
+    pseudo_count: float = 0.0,
+    n_clonotypes: Optional[int] = None,
+    library_condition: Optional[str] = None,
+    exclude_sequenced_library: bool = False
+) -> np.ndarray:
+    """
+    Row mask of the clonotypes passing filter_clonotypes_by_criteria, for a
+    sparse count matrix with one column per condition of condition_order.
+    Presence counts come from the stored entries; abundance and frequency
+    thresholds are checked one condition column at a time.
+    """
+    column_index = {c: i for i, c in enumerate(condition_order)}
+    keep = np.ones(counts.shape[0], dtype=bool)
+
+    def non_zero_count(cols: List[str]) -> np.ndarray:
+        present = counts[:, [column_index[c] for c in cols]] > 0
+        return np.asarray(present.sum(axis=1)).ravel()
+
+    if filter_single_sample and condition_order:
+        keep &= non_zero_count(condition_order) > 1
+
+    if filter_any_zero:
+        if exclude_sequenced_library:
+            target_cols = [c for c in condition_order if c != library_condition]
+        else:
+            target_cols = list(condition_order)
+        if target_cols:
+            keep &= non_zero_count(target_cols) == len(target_cols)
+
+    if min_abundance > 0 and condition_order:
+        any_abundant = np.zeros(counts.shape[0], dtype=bool)
+        for i in range(len(condition_order)):
+            any_abundant |= _matrix_column(counts, i) >= min_abundance
+        keep &= any_abundant
+
+    if min_frequency > 0 and total_reads_dict:
+        any_frequent = None
+        for i, col in enumerate(condition_order):
+            total = total_reads_dict.get(col, 0)
+            if total >= 1:
+                frequent = (
+                    _column_frequency(counts, i, total, n_clonotypes, pseudo_count) >= min_frequency
+                ).to_numpy()
+                any_frequent = frequent if any_frequent is None else any_frequent | frequent
+        if any_frequent is not None:
+            keep &= any_frequent
+
+    if present_in_rounds and len(present_in_rounds) > 0:
+        existing_rounds = [r for r in present_in_rounds if r in condition_order]
+        if existing_rounds:
+            if present_in_rounds_logic.upper() == "AND":
+                keep &= non_zero_count(existing_rounds) == len(existing_rounds)
+            else:  # Default to OR
+                keep &= non_zero_count(existing_rounds) > 0
+
+    return keep
+
+
+def _negative_control_enrichment(
+    aggregated_df: pl.DataFrame,
+    total_reads_df: pl.DataFrame,
+    negative_antigens: List[str],
+    base_order: List[str],
+    include_library: bool,
+    sequenced_library_antigen: Optional[str],
+    library_condition: Optional[str],
+    pseudo_count: float,
+    single_control_frequency_threshold: float,
+    engine: str,
+    float32: bool,
+    consumed_comparisons: Optional[List[Tuple[str, str]]],
+    track_layout: Optional[Tuple[List[str], List[str], np.ndarray, np.ndarray]] = None
+) -> Tuple[Optional[pl.DataFrame], List[str]]:
+    """
+    Negative control columns per elementId: MaxNegControlEnrichment from the
+    multi-condition control tracks and PresentInNegControl from the
+    single-condition ones. Control tracks do not depend on the target, so one
+    result serves every target of a run.
+
+    aggregated_df may hold only a slice of the elementIds (streaming mode);
+    track_layout then gives the control tracks of the whole input: the
+    negative antigens present, the control conditions, the n_clonotypes of
+    each track and the tracks x conditions presence mask (see
+    _control_track_layout). The rows of the slice get the values they get
+    from the whole input.
+
+    Returns the table (None when no control track is present) and the names
+    of the columns it holds.
+    """
+    neg_control_columns: List[str] = []
+    max_neg_enrichment_df = None
+
+    # All negative antigen tracks in one long table keyed by antigen (only the
+    # antigens which were provided and are present in the data). Rows with a
+    # null condition stay in: they add their elementId to the track, and so
+    # count in its n_clonotypes, without adding to any condition
+    neg_track_filter = pl.col('antigen').is_in(negative_antigens)
+    library_filter = pl.lit(False)
+    if include_library:
+        library_filter = pl.col('antigen') == sequenced_library_antigen
+    if track_layout is None:
+        track_values = aggregated_df.filter(neg_track_filter | library_filter).select(
+            pl.col('antigen').filter(neg_track_filter).unique().sort().implode(),
+            pl.col('condition').unique().sort().implode()
+        )
+        unique_neg_antigens = track_values.get_column('antigen').explode().drop_nulls().to_list()
+        neg_conditions = track_values.get_column('condition').explode().drop_nulls().to_list()
+    else:
+        unique_neg_antigens, neg_conditions = track_layout[0], track_layout[1]
+
+    if unique_neg_antigens:
+        # Antigens and conditions are coded as integers (their index in
+        # unique_neg_antigens / neg_conditions)
+        def track_codes(column: str, values: List) -> pl.Expr:
+            return pl.col(column).replace_strict(values, list(range(len(values))), return_dtype=pl.UInt32)
+
+        neg_rows = aggregated_df.filter(neg_track_filter).select(
+            track_codes('antigen', unique_neg_antigens).alias('track'),
+            'elementId',
+            track_codes('condition', neg_conditions),
+            'abundance'
+        )
+        if include_library:
+            # Aggregate the library samples once and add them to every other
+            # negative antigen's track
+            library_long = (
+                aggregated_df
+                .filter(library_filter)
+                .group_by(['elementId', 'condition'])
+                .agg(pl.col('abundance').sum().alias('abundance'))
+                .with_columns(track_codes('condition', neg_conditions))
+            )
+            library_tracks = pl.DataFrame(pl.Series('track', [
+                i for i, a in enumerate(unique_neg_antigens) if a != sequenced_library_antigen
+            ], dtype=pl.UInt32))
+            neg_rows = pl.concat([
+                neg_rows,
+                library_tracks.join(library_long, how='cross').select(neg_rows.columns)
+            ], how='vertical_relaxed')
+
+        # Pivot all tracks at once: one row per (antigen, elementId)
+        track_antigen, track_ids, track_abundance, track_has_condition = _track_abundance_matrix(
+            neg_rows, len(unique_neg_antigens), len(neg_conditions), sparse_output=(engine == "sparse"))
+        del neg_rows
+        condition_index = {c: i for i, c in enumerate(neg_conditions)}
+
+        # Track-specific n_clonotypes for each negative antigen; rows are
+        # ordered by antigen, so each antigen's track is a slice
+        track_n_clonotypes = np.bincount(track_antigen, minlength=len(unique_neg_antigens))
+        track_offsets = np.concatenate([[0], np.cumsum(track_n_clonotypes)])
+        if track_layout is not None:
+            track_n_clonotypes, track_has_condition = track_layout[2], track_layout[3]
+
+        # Total reads per negative antigen, in one pass; include library condition
+        # counts in every track when the library is enabled
+        neg_total_reads = {antigen: {} for antigen in unique_neg_antigens}
+        for antigen, condition, total in total_reads_df.select(['antigen', 'condition', 'total_reads']).iter_rows():
+            if library_condition is not None and condition == library_condition:
+                for reads in neg_total_reads.values():
+                    reads[condition] = total
+            elif antigen in neg_total_reads:
+                neg_total_reads[antigen][condition] = total
+
+        neg_enrichments_max: List[pl.DataFrame] = []   # multi-condition: elementId + MaxPositiveEnrichment
+        neg_enrichments_present: List[pl.DataFrame] = []  # single-condition: elementId + PresentInNegControl
+
+        for antigen_i, neg_antigen in enumerate(unique_neg_antigens):
+            # Only use conditions that are actually present for this antigen
+            # to avoid spurious enrichments from missing/synthetic conditions
+            pivot_names = [c for c, present in zip(neg_conditions, track_has_condition[antigen_i]) if present]
+            available_conditions = [c for c in base_order if c in pivot_names]
+            # If the antigen has one experimental condition not in base_order, use it as a fallback
+            experimental_pivot = [c for c in pivot_names if c != library_condition]
+            if len(experimental_pivot) == 1 and experimental_pivot[0] not in available_conditions:
+                available_conditions = ([library_condition] if library_condition in pivot_names else []) + experimental_pivot
+
+            start, end = track_offsets[antigen_i], track_offsets[antigen_i + 1]
+            antigen_ids = track_ids.slice(start, end - start)
+            antigen_abundance = track_abundance[start:end]
+
+            neg_total_reads_dict = neg_total_reads[neg_antigen]
+            neg_n_clonotypes = int(track_n_clonotypes[antigen_i])
+
+            if len(available_conditions) > 1 and engine == "sparse":
+                # Only MaxPositiveEnrichment is used from control tracks: scan the
+                # frequency columns straight from the sparse counts
+                antigen_abundance = antigen_abundance.tocsc()
+                antigen_max = pl.DataFrame([antigen_ids, _max_positive_enrichment(
+                    _frequency_values(_column_frequency(
+                        antigen_abundance, condition_index[c], neg_total_reads_dict.get(c, 1),
+                        neg_n_clonotypes, pseudo_count
+                    ))
+                    for c in available_conditions
+                )])
+                neg_enrichments_max.append(antigen_max)
+                continue
+
+            # Pivot for this specific negative antigen
+            antigen_pivot = pl.DataFrame([antigen_ids] + [
+                pl.Series(c, _matrix_column(antigen_abundance, condition_index[c])) for c in available_conditions
+            ])
+
+            if len(available_conditions) > 1:
+                # Multiple conditions: compute frequencies and enrichments
+                neg_freq_exprs = []
+                for condition in available_conditions:
+                    total = neg_total_reads_dict.get(condition, 1)
+                    neg_freq_exprs.append(
+                        _frequency_expr(condition, total, neg_n_clonotypes, pseudo_count).alias(f'freq_{condition}')
+                    )
+                antigen_pivot = antigen_pivot.with_columns(neg_freq_exprs)
+                # Only MaxPositiveEnrichment is used from control tracks
+                antigen_enrichment = _calculate_enrichments_vectorized(
+                    antigen_pivot, available_conditions, engine, float32,
+                    None if consumed_comparisons is None else []
+                )
+                # If no pairwise comparisons were possible, create a 0-filled max column
+                if 'MaxPositiveEnrichment' not in antigen_enrichment.collect_schema().names():
+                    antigen_enrichment = antigen_enrichment.with_columns(
+                        pl.lit(0.0).alias('MaxPositiveEnrichment')
+                    )
+                # Store new columns
+                antigen_max = antigen_enrichment.select(['elementId', 'MaxPositiveEnrichment'])
+                neg_enrichments_max.append(antigen_max)
+            elif len(available_conditions) == 1:
+                # Single condition: calculate FC against target last condition
+                cond = available_conditions[0]
+
+                # Calculate frequency in control
+                total = neg_total_reads_dict.get(cond, 1)
+                freq_expr = _frequency_expr(cond, total, neg_n_clonotypes, pseudo_count)
+
+                antigen_pivot = antigen_pivot.with_columns(
+                    freq_expr.alias('_freq_control')
+                )
+
+                # Get target frequency from enrichment_results
+                # if enrichment_results.height == 0:
+                # If no target results, we can't calculate FC. (comment specific for enrichment FC usecase)
+                present_df = antigen_pivot.filter(
+                    pl.col('_freq_control') >= single_control_frequency_threshold
+                ).select(pl.col('elementId')).with_columns(
+                    pl.lit(True).alias('PresentInNegControl')
+                )
+
+                # Leave enrichment FC calculation in case we want to re-enable it in the future
+                # else:
+                #     target_last_cond = effective_condition_order[-1]
+                #     target_freq_col = f'Frequency {target_last_cond}'
+                        
+                #     # Join to get target frequency
+                #     # We use left join on antigen_pivot to keep all control clonotypes
+                #     antigen_pivot = antigen_pivot.join(
+                #         enrichment_results.select(['elementId', target_freq_col]),
+                #         on='elementId',
+                #         how='left'
+                #     )
+                        
+                #     # Calculate Fold Change: Target / Control
+                #     # Handle nulls (not in target) as 0 frequency
+                #     antigen_pivot = antigen_pivot.with_columns(
+                #         pl.col(target_freq_col).fill_null(0.0).alias('_freq_target')
+                #     )
+                        
+                #     # FC = Target / Control
+                #     antigen_pivot = antigen_pivot.with_columns(
+                #         (pl.col('_freq_target') / pl.col('_freq_control')).alias('_fc_target_control')
+                #     )
+                        
+                #     # Filter logic:
+                #     # We keep (don't flag as PresentInNegControl) if:
+                #     # 1. FC >= threshold (Specific enrichment in target)
+                #     # 2. AND Frequency in control < threshold (Low abundance in control)
+                #     present_df = antigen_pivot.filter(
+                #         (pl.col('_fc_target_control') < single_control_fc_threshold) |
+                #         (pl.col('_freq_control') >= single_control_frequency_threshold)
+                #     ).select(pl.col('elementId')).with_columns(
+                #         pl.lit(True).alias('PresentInNegControl')
+                #     )
+                        
+                        
+                neg_enrichments_present.append(present_df)                    
+
+        # Combine per-antigen results into one table; track which columns we produced
+        if neg_enrichments_max:
+            max_neg_enrichment_df = (
+                pl.concat(neg_enrichments_max)
+                .group_by('elementId')
+                .agg(pl.col('MaxPositiveEnrichment').max().alias('MaxNegControlEnrichment'))
+            )
+            neg_control_columns.append('MaxNegControlEnrichment')
+        if neg_enrichments_present:
+            present_df = (
+                pl.concat(neg_enrichments_present)
+                .group_by('elementId')
+                .agg(pl.col('PresentInNegControl').any().alias('PresentInNegControl'))
+            )
+            if max_neg_enrichment_df is not None:
+                max_neg_enrichment_df = max_neg_enrichment_df.join(present_df, on='elementId', how='outer')
+                    
+                # Coalesce elementId columns if they split during outer join
+                if 'elementId_right' in max_neg_enrichment_df.columns:
+                    max_neg_enrichment_df = max_neg_enrichment_df.with_columns(
+                        pl.coalesce([pl.col('elementId'), pl.col('elementId_right')]).alias('elementId')
+                    ).drop('elementId_right')
+            else:
+                max_neg_enrichment_df = present_df
+            neg_control_columns.append('PresentInNegControl')
+
+    return max_neg_enrichment_df, neg_control_columns
+
+
+def _control_track_layout(
+    total_reads_df: pl.DataFrame,
+    negative_antigens: List[str],
+    include_library: bool,
+    sequenced_library_antigen: Optional[str]
+) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    The negative antigens present, the control conditions and the tracks x
+    conditions presence mask that _negative_control_enrichment derives from
+    the aggregated rows, taken from the total reads table instead (it has a
+    row for every condition and antigen of the input). The library's
+    conditions are present in every track but the library antigen's own.
+    """
+    neg_track_filter = pl.col('antigen').is_in(negative_antigens)
+    library_filter = pl.lit(False)
+    if include_library:
+        library_filter = pl.col('antigen') == sequenced_library_antigen
+    track_rows = total_reads_df.filter(neg_track_filter | library_filter)
+    unique_neg_antigens = (
+        track_rows.filter(neg_track_filter).get_column('antigen').unique().sort().drop_nulls().to_list()
+    )
+    neg_conditions = track_rows.get_column('condition').unique().sort().drop_nulls().to_list()
+
+    antigen_index = {a: i for i, a in enumerate(unique_neg_antigens)}
+    condition_index = {c: i for i, c in enumerate(neg_conditions)}
+    library_tracks = [i for i, a in enumerate(unique_neg_antigens) if a != sequenced_library_antigen]
+    track_has_condition = np.zeros((len(unique_neg_antigens), len(neg_conditions)), dtype=bool)
+    for antigen, condition in track_rows.drop_nulls('condition').select(['antigen', 'condition']).iter_rows():
+        if antigen in antigen_index:
+            track_has_condition[antigen_index[antigen], condition_index[condition]] = True
+        if include_library and antigen == sequenced_library_antigen:
+            track_has_condition[library_tracks, condition_index[condition]] = True
+    return unique_neg_antigens, neg_conditions, track_has_condition
+
+
+def _target_frequency_table(
+    target_track_df: pl.DataFrame,
+    condition_order: List[str],
+    engine: str,
+    total_reads_dict: Dict[str, int],
+    n_clonotypes: int,
+    pseudo_count: float,
+    filter_clonotypes: bool = False,
+    filter_single_sample: bool = False,
+    filter_any_zero: bool = False,
+    min_abundance: int = 0,
+    min_frequency: float = 0.0,
+    present_in_rounds: Optional[List[str]] = None,
+    present_in_rounds_logic: str = "OR",
+    library_condition: Optional[str] = None,
+    exclude_sequenced_library: bool = False,
+    profiler: StageProfiler = NULL_PROFILER,
+    stage_details: Optional[Dict] = None
+) -> pl.DataFrame:
+    """
+    Pivot of a target track's rows with one frequency column per condition of
+    condition_order (freq_<condition>) and Overall Log2FC, after the
+    clonotype filters, sorted by elementId. Frequencies and filters use the
+    totals and n_clonotypes of the whole track, and every row only depends on
+    the rows of its own elementId, so the rows of a slice of the elementIds
+    give the same slice of the table. The target_pivot, filtering and
+    frequencies stages are recorded with stage_details (e.g. the slice).
+    """
+    stage_details = stage_details or {}
+    with profiler.stage("target_pivot", **stage_details) as stage:
+        if engine == "sparse":
+            # Clonotype x condition counts of the target track as a sparse matrix, with
+            # one column per condition of the order (other conditions only add rows)
+            _, track_ids, counts, _ = _track_abundance_matrix(
+                target_track_df.select(
+                    pl.lit(0, dtype=pl.UInt32).alias('track'),
+                    'elementId',
+                    pl.col('condition').replace_strict(
+                        condition_order, list(range(len(condition_order))),
+                        default=None, return_dtype=pl.UInt32),
+                    'abundance'
+                ),
+                1, len(condition_order), sparse_output=True
+            )
+            counts = counts.tocsc()
+            stage['rows'] = counts.shape[0]
+        else:
+            # Create pivot table for target track; filtering and enrichment share it
+            pivot_df = (
+                target_track_df
+                .group_by(['elementId', 'condition'])
+                .agg(pl.col('abundance').sum().alias('abundance'))
+                .pivot(values='abundance', index='elementId', on='condition', aggregate_function='sum')
+                .fill_null(0)
+            )
+
+            # Ensure all conditions are present in pivot
+            pivot_df_schema = pivot_df.collect_schema().names()
+            for condition in condition_order:
+                if condition not in pivot_df_schema:
+                    pivot_df = pivot_df.with_columns(pl.lit(0).alias(condition))
+            pivot_df_schema = pivot_df.collect_schema().names()
+            stage['rows'] = pivot_df.height
+
+    # Apply clonotype filtering if requested on the target track
+    if filter_clonotypes:
+        with profiler.stage("filtering", **stage_details) as stage:
+            if engine == "sparse":
+                keep = _sparse_filter_mask(
+                    counts, condition_order,
+                    filter_single_sample, filter_any_zero, min_abundance,
+                    min_frequency, total_reads_dict,
+                    present_in_rounds, present_in_rounds_logic,
+                    pseudo_count, n_clonotypes,
+                    library_condition,
+                    exclude_sequenced_library
+                )
+                counts = counts[keep]
+                track_ids = track_ids.filter(pl.Series(keep))
+                stage['rows'] = counts.shape[0]
+            else:
+                pivot_df = filter_clonotypes_by_criteria(
+                    pivot_df, condition_order,
+                    filter_single_sample, filter_any_zero, min_abundance,
+                    min_frequency, total_reads_dict,
+                    present_in_rounds, present_in_rounds_logic,
+                    pseudo_count, n_clonotypes,
+                    library_condition,
+                    exclude_sequenced_library
+                )
+                stage['rows'] = pivot_df.height
+
+    with profiler.stage("frequencies", **stage_details) as stage:
+        if engine == "sparse":
+            # Frequencies for target track, built one condition column at a time
+            pivot_df = pl.DataFrame([track_ids] + [
+                _column_frequency(
+                    counts, i, total_reads_dict.get(condition, 1), n_clonotypes, pseudo_count
+                ).alias(f'freq_{condition}')
+                for i, condition in enumerate(condition_order)
+            ])
+            del counts
+        else:
+            # Convert elementId to index by setting it aside
+            pivot_df = pivot_df.sort('elementId')
+
+            # Sort columns alphabetically but keep elementId
+            condition_cols = sorted([col for col in pivot_df_schema if col != 'elementId'])
+            pivot_df = pivot_df.select(['elementId'] + condition_cols)
+
+            # Pre-calculate frequencies for target track
+            freq_expressions = []
+            for condition in condition_order:
+                total = total_reads_dict.get(condition, 1)
+                # This ensures frequencies sum to 1: Σ[(abundance + p) / (total + N*p)] = 1
+                freq_expressions.append(
+                    _frequency_expr(condition, total, n_clonotypes, pseudo_count).alias(f'freq_{condition}')
+                )
+
+            # Add frequency columns
+            pivot_df = pivot_df.with_columns(freq_expressions)
+
+        # Calculate Overall Log2FC (last vs first)
+        if len(condition_order) >= 2 and engine != "numpy":
+            first_cond = condition_order[0]
+            last_cond = condition_order[-1]
+
+            # Formula: log2((last_freq) / (first_freq))
+            # Since freq_last = (abundance_last + p) / (total_last + N*p)
+            # This matches the pairwise enrichment logic
+            overall_expr = (
+                pl.when((pl.col(f'freq_{last_cond}') > 0) & (pl.col(f'freq_{first_cond}') > 0))
+                .then((pl.col(f'freq_{last_cond}') / pl.col(f'freq_{first_cond}')).log(2))
+                .otherwise(None)
+                .alias('Overall Log2FC')
+            )
+            pivot_df = pivot_df.with_columns(overall_expr)
+        stage['rows'] = pivot_df.height
+    return pivot_df
+
 
 def hybrid_enrichment_analysis(
     input_data_csv: str,
@@ -271,10 +897,29 @@ def hybrid_enrichment_analysis(
     sequenced_library_enabled: bool = False,
     sequenced_library_antigen: Optional[str] = None,
     exclude_sequenced_library: bool = False,
-) -> None:
+    engine: str = "polars",
+    float32: bool = False,
+    materialize_comparisons: str = "all",
+    export_comparisons: Optional[List[List[str]]] = None,
+    targets: Optional[List[str]] = None,
+    streaming: bool = False,
+    streaming_memory_mb: float = 2048,
+    annotation_stats_json: Optional[str] = None,
+    profiler: StageProfiler = NULL_PROFILER,
+) -> Dict:
     """
     Optimized hybrid enrichment analysis using polars for better performance and memory efficiency.
 
+    input_data_csv may also be an in-memory DataFrame/LazyFrame. The written
+    outputs are also returned as frames keyed 'enrichment', 'bubble',
+    'top_enriched' and, when requested, 'top_10' and 'highest_enrichment'.
+
+    With targets, the analysis runs for each target antigen in place of
+    current_target: the input is read and aggregated once and the negative
+    control tracks are computed once, then each target only processes its
+    own track. Every output path must then contain '{target}', which is
+    replaced with the target name, and the outputs are returned per target.
+
     New filtering options:
     - filter_clonotypes: Enable clonotype filtering before enrichment calculation
     - filter_single_sample: Remove clonotypes present in only one sample (zero abundance in all but one)
@@ -291,10 +936,60 @@ def hybrid_enrichment_analysis(
     - current_target: The current target antigen for this iteration
     - sequenced_library_enabled: Use the selected sequenced library antigen's samples as base condition for enrichment
     - sequenced_library_antigen: Antigen column value identifying library samples (used as base condition when enabled)
+    - engine: Enrichment engine, 'polars', 'numpy' (see _calculate_enrichments_numpy) or 'sparse'
+      (polars expressions over counts pivoted into a sparse clonotype x condition matrix)
+    - float32: Store the numpy engine's log2 frequencies and enrichments as float32
+    - materialize_comparisons: 'all' writes every pairwise comparison column; 'consumed' writes
+      only the ones used downstream (each condition vs the baseline, plus export_comparisons) and
+      derives MaxPositiveEnrichment, the bubble data and the highest enrichment per clonotype
+      with a prefix-minimum scan instead of from all K*(K-1)/2 columns
+    - export_comparisons: Comparisons to materialize in 'consumed' mode, as [numerator, denominator]
+      condition pairs; the numerator must come after the denominator in the condition order (see
+      _export_comparison_pairs)
+    - targets: Target antigens to analyze in one run (see above)
+    - streaming: Spill the input to disk in slices of the elementIds and run the aggregation,
+      control tracks, pivots and enrichment table one slice at a time (see _spill_element_batches
+      and _stream_enrichment_outputs), so that no whole-input table is held in memory; the
+      enrichment and highest enrichment tables are then returned as lazy scans of their files
+    - streaming_memory_mb: Memory budget (MiB) of one elementId slice in streaming mode
+    - annotation_stats_json: Optional JSON output with the annotation values of every enrichment
+      column (see _write_annotation_stats), in place of one calculate-annotations run per column
+    - profiler: Records the stages of the run (see profiling.StageProfiler); the caller writes the report
     """
+    if engine not in enrichment_engines:
+        raise ValueError(f"Invalid enrichment engine: {engine}")
+    if float32 and engine != "numpy":
+        raise ValueError("float32 storage is only supported by the numpy engine")
+    if materialize_comparisons not in comparison_modes:
+        raise ValueError(f"Invalid comparison materialization mode: {materialize_comparisons}")
+    if streaming and streaming_memory_mb <= 0:
+        raise ValueError("The streaming memory budget must be positive")
+    collect_engine = "streaming" if streaming else "auto"
+    if targets is not None:
+        targets = [str(target) for target in targets]
+        if not targets:
+            raise ValueError("No target antigens given")
+        for path in (enrichment_csv, bubble_csv, top_enriched_csv, top_10_csv,
+                     highest_enrichment_csv, filtered_too_much_txt, annotation_stats_json):
+            if path is not None and '{target}' not in str(path):
+                raise ValueError(f"Output path must contain '{{target}}' with several targets: {path}")
+
+    def target_path(path: Optional[str], target: Optional[str]) -> Optional[str]:
+        """Output path of one target ('{target}' replaced with its name when running several)."""
+        if path is None or targets is None:
+            return path
+        return str(path).replace('{target}', target)
+
+    def output_paths(target: Optional[str]) -> Tuple[Optional[str], ...]:
+        """Output paths of one target, in create_empty_outputs argument order."""
+        return tuple(target_path(path, target) for path in (
+            enrichment_csv, bubble_csv, top_enriched_csv, top_10_csv,
+            highest_enrichment_csv, filtered_too_much_txt))
+
     # Read data with polars lazy evaluation
     # Force condition to be string to avoid type errors during comparison
-    input_df = pl.scan_csv(input_data_csv, schema_overrides={"condition": pl.Utf8})
+    profiler.start("ingestion")
+    input_df = scan_table(input_data_csv, schema_overrides={"condition": pl.Utf8})
     schema = input_df.collect_schema()
 
     # Normalize condition order and resolve sequenced library as base condition
@@ -326,50 +1021,39 @@ def hybrid_enrichment_analysis(
         if library_condition is not None
         else condition_order
     )
+    export_pairs = _export_comparison_pairs(export_comparisons, effective_condition_order)
 
     # Check if input data is empty (no clonotypes)
     ## Check if there are any non-null, non-empty elementId value in lazy frame
     element_count = input_df.filter(
         pl.col('elementId').is_not_null() & 
         (pl.col('elementId') != "")
-    ).select(pl.len()).collect().item()
+    ).select(pl.len()).collect(engine=collect_engine).item()
+    profiler.stop(rows=element_count)
     if element_count == 0:
         # Create empty outputs and exit (use effective order so schema matches non-empty case)
-        create_empty_outputs(effective_condition_order, enrichment_csv, bubble_csv,
-                                top_enriched_csv, top_10_csv, highest_enrichment_csv,
-                                filtered_too_much_txt)
-        return
+        results: Dict[Optional[str], Dict[str, pl.DataFrame]] = {}
+        for target in (targets if targets is not None else [current_target]):
+            profiler.start("empty_outputs", target=target)
+            results[target] = create_empty_outputs(effective_condition_order, *output_paths(target))
+            if annotation_stats_json:
+                _write_annotation_stats(results[target], target_path(annotation_stats_json, target))
+            profiler.stop()
+        return results if targets is not None else results[current_target]
 
     if clonotype_definition_csv:
-        clonotype_def_df = pl.scan_csv(clonotype_definition_csv)
-
-        # Eagerly collect to perform join
-        input_df = input_df.collect()
-        clonotype_def_df = clonotype_def_df.collect()
-
-        # Join with main data
-        input_df = input_df.join(clonotype_def_df, on='elementId', how='left')
-
-        clonotype_def_cols = [
-            col for col in input_df.collect_schema().names() if col.startswith('clonotypeDefinition_')]
-
-        if clonotype_def_cols:
-            # Calculate new abundance
-            grouped_abundance = input_df.group_by(clonotype_def_cols + ['condition']).agg(
-                pl.col('downsampledAbundance').sum().alias('new_abundance')
-            )
-
-            # Join back to get the new abundance for each row
-            input_df = input_df.join(
-                grouped_abundance, on=clonotype_def_cols + ['condition'], how='left')
-
-            # Replace original abundance
-            input_df = input_df.with_columns(
-                pl.col('new_abundance').alias('downsampledAbundance')
-            ).drop('new_abundance')
-
-        # Continue with lazy evaluation
-        input_df = input_df.lazy()
+        profiler.start("clonotype_definition")
+        input_df = _redefine_clonotypes(input_df, scan_table(clonotype_definition_csv))
+        if not streaming:
+            # Run the stage once for the totals and the aggregation below; the
+            # raw abundance is replaced by downsampledAbundance, so it is not kept
+            defined_df = input_df.select(pl.exclude('abundance')).collect()
+            profiler.stop(rows=defined_df.height)
+            input_df = defined_df.lazy()
+            del defined_df
+        else:
+            # Lazy: the stage runs as part of the aggregation
+            profiler.stop()
 
     # Rename and validate columns
     if "abundance" in input_df.collect_schema().names():
@@ -397,12 +1081,14 @@ def hybrid_enrichment_analysis(
     if has_antigen:
         group_total_reads.append('antigen')
 
+    profiler.start("total_reads")
     total_reads_df = (
         input_df
         .group_by(group_total_reads)
         .agg(pl.col('abundance').sum().alias('total_reads'))
-        .collect()
+        .collect(engine=collect_engine)
     )
+    profiler.stop(rows=total_reads_df.height)
 
     # Create aggregated data first, then pivot (pivot requires DataFrame, not LazyFrame)
     # We need to keep sampleId and antigen if we want to use them in filtering
@@ -410,298 +1096,335 @@ def hybrid_enrichment_analysis(
     if has_antigen:
         group_cols.append("antigen")
 
-    aggregated_df = (
-        input_df
-        .group_by(group_cols)
-        .agg(pl.col('abundance').sum().alias('abundance'))
-        .collect()
-    )
-
-    # Generate consistent labels BEFORE filtering based on alphabetical elementId order
-    # This ensures each clonotype gets the same label regardless of filtering
-    all_element_ids = aggregated_df.select(
-        'elementId').unique().sort('elementId')
-    label_mapping = all_element_ids.with_row_index("_row_index").with_columns(
-        (pl.col('_row_index') +
-         1).map_elements(lambda x: f"C{int(x)}", return_dtype=pl.Utf8).alias('Label')
-    ).select(['elementId', 'Label'])
+    profiler.start("aggregation")
+    if streaming:
+        # The input is aggregated one slice of the elementIds at a time (see
+        # _spill_element_batches); only the elementId dictionary is held here
+        element_ids = (
+            input_df.select(pl.col('elementId').unique())
+            .collect(engine=collect_engine)
+            .get_column('elementId')
+        )
+        has_null_element = element_ids.null_count() > 0
+        element_ids = element_ids.drop_nulls().sort()
+        profiler.stop(rows=len(element_ids))
+    else:
+        aggregated_df = (
+            input_df
+            .group_by(group_cols)
+            .agg(pl.col('abundance').sum().alias('abundance'))
+            .collect(engine=collect_engine)
+        )
 
-    # --- Target Track Processing ---
-    # Get total reads for target track frequencies and filtering and define target_track_df
-    if has_antigen and current_target:
-        target_reads = total_reads_df.filter(pl.col('antigen') == current_target)
-        target_total_reads_dict = dict(zip(target_reads['condition'], target_reads['total_reads']))
-        # When sequenced library is enabled, include the library samples
-        if sequenced_library_enabled and sequenced_library_antigen is not None:
+        # Encode elementId once: all grouping, pivoting, joins and sorting below run
+        # on integer ids, which are decoded back only when outputs are written
+        has_null_element = aggregated_df.get_column('elementId').null_count() > 0
+        aggregated_df, element_ids = _encode_element_ids(aggregated_df)
+        profiler.stop(rows=aggregated_df.height)
+
+    # Consistent labels follow the alphabetical elementId order (that is, the id
+    # order) BEFORE filtering, so each clonotype gets the same label regardless
+    # of filtering. A null elementId sorts first and takes up C1.
+    label_offset = 2 if has_null_element else 1
+    label_expr = pl.format("C{}", pl.col('elementId').cast(pl.Int64) + label_offset).alias('Label')
+
+    # Comparisons to materialize (None: all of them)
+    consumed_comparisons: Optional[List[Tuple[str, str]]] = None
+    if materialize_comparisons == "consumed":
+        baseline_cond = effective_condition_order[0]
+        consumed_comparisons = [(c, baseline_cond) for c in effective_condition_order[1:]]
+        consumed_comparisons.extend(export_pairs)
+
+    # Library sample reads, part of every target track's totals
+    library_sample_reads = None
+    if has_antigen and sequenced_library_enabled and sequenced_library_antigen is not None:
+        if streaming:
+            library_sample_reads = total_reads_df.filter(
+                pl.col('antigen') == sequenced_library_antigen
+            ).get_column('total_reads').sum()
+        else:
             library_sample_reads = aggregated_df.filter(
                 pl.col('antigen') == sequenced_library_antigen
             ).select(pl.col('abundance').sum()).to_series().item()
-            target_total_reads_dict[library_condition] = library_sample_reads
-            target_track_df = aggregated_df.filter(
-                (pl.col('antigen') == current_target) | (pl.col('antigen') == sequenced_library_antigen)
-            )
-        else:
-            target_track_df = aggregated_df.filter(pl.col('antigen') == current_target)
-    else:
-        # Fallback to global totals if no antigen or control disabled
-        global_reads = total_reads_df.group_by('condition').agg(pl.col('total_reads').sum())
-        target_total_reads_dict = dict(zip(global_reads['condition'], global_reads['total_reads']))
-        target_track_df = aggregated_df
-
-    # Calculate track-specific n_clonotypes for normalization
-    target_n_clonotypes = target_track_df.select('elementId').n_unique()
-
-    # Apply clonotype filtering if requested on the target track
-    if filter_clonotypes:
-        target_track_df = filter_clonotypes_by_criteria(
-            target_track_df, effective_condition_order,
-            filter_single_sample, filter_any_zero, min_abundance,
-            min_frequency, target_total_reads_dict,
-            present_in_rounds, present_in_rounds_logic,
-            pseudo_count, target_n_clonotypes,
-            library_condition,
-            exclude_sequenced_library
-        )
-
-    # After filtering, aggregate away sampleId and antigen for the pivot
-    target_track_pivot_ready = (
-        target_track_df
-        .group_by(['elementId', 'condition'])
-        .agg(pl.col('abundance').sum().alias('abundance'))
-    )
-
-    # Check if we have too few clonotypes after filtering
-    if filtered_too_much_txt:
-        unique_clonotypes_count = target_track_pivot_ready.select('elementId').n_unique()
-        too_few = "true" if (unique_clonotypes_count < 1) else "false"
-        with open(filtered_too_much_txt, 'w') as f:
-            f.write(too_few)
-
-    # Create pivot table for target track
-    pivot_df = (
-        target_track_pivot_ready
-        .pivot(values='abundance', index='elementId', on='condition', aggregate_function='sum')
-        .fill_null(0)
-    )
-
-    # Ensure all conditions are present in pivot
-    pivot_df_schema = pivot_df.collect_schema().names()
-    for condition in effective_condition_order:
-        if condition not in pivot_df_schema:
-            pivot_df = pivot_df.with_columns(pl.lit(0).alias(condition))
-    pivot_df_schema = pivot_df.collect_schema().names()
-
-    # Convert elementId to index by setting it aside
-    pivot_df = pivot_df.sort('elementId')
-
-    # Sort columns alphabetically but keep elementId
-    condition_cols = sorted([col for col in pivot_df_schema if col != 'elementId'])
-    pivot_df = pivot_df.select(['elementId'] + condition_cols)
-
-    # Pre-calculate frequencies for target track
-    freq_expressions = []
-    for condition in effective_condition_order:
-        total = target_total_reads_dict.get(condition, 1)
-        # This ensures frequencies sum to 1: Σ[(abundance + p) / (total + N*p)] = 1
-        freq_expressions.append(
-            ((pl.col(condition) + pseudo_count) / (total + (target_n_clonotypes * pseudo_count))).alias(f'freq_{condition}')
-        )
-
-    # Add frequency columns
-    pivot_df = pivot_df.with_columns(freq_expressions)
-
-    # Calculate Overall Log2FC (last vs first)
-    if len(effective_condition_order) >= 2:
-        first_cond = effective_condition_order[0]
-        last_cond = effective_condition_order[-1]
-        
-        # Formula: log2((last_freq) / (first_freq))
-        # Since freq_last = (abundance_last + p) / (total_last + N*p)
-        # This matches the pairwise enrichment logic
-        overall_expr = (
-            pl.when((pl.col(f'freq_{last_cond}') > 0) & (pl.col(f'freq_{first_cond}') > 0))
-            .then((pl.col(f'freq_{last_cond}') / pl.col(f'freq_{first_cond}')).log(2))
-            .otherwise(None)
-            .alias('Overall Log2FC')
-        )
-        pivot_df = pivot_df.with_columns(overall_expr)
-
-    # Calculate pairwise enrichments
-    enrichment_results = _calculate_enrichments_vectorized(
-        pivot_df, effective_condition_order
-    )
 
     # --- Negative Control Track Processing ---
+    # Control tracks do not depend on the target: computed once for all targets
+    # (in streaming mode, once per slice of the elementIds)
     neg_control_columns: List[str] = []
     max_neg_enrichment_df = None
-    if has_antigen and control_enabled and negative_antigens:
-        neg_track_filter = pl.col('antigen').is_in(negative_antigens)
-        if sequenced_library_enabled and sequenced_library_antigen is not None:
-            neg_track_filter = neg_track_filter | (pl.col('antigen') == sequenced_library_antigen)
-            
-        # Filter for all negative antigens; when sequenced library is enabled, include library sample too
-        neg_track_df = aggregated_df.filter(neg_track_filter)
+    control_tracks = bool(has_antigen and control_enabled and negative_antigens)
+    if control_tracks:
+        include_library = sequenced_library_enabled and sequenced_library_antigen is not None
 
         # Use control-specific order if provided, otherwise fallback to effective (target) order
         base_order = control_conditions_order if control_conditions_order is not None else effective_condition_order
         # When sequenced library is enabled, put library condition first as base for controls too
         if library_condition is not None:
             base_order = [library_condition] + [c for c in base_order if c != library_condition]
-        
-        if neg_track_df.height > 0:
-            # We need to calculate enrichment independently for each negative 
-            # antigen (only the ones which where provided and are present in the data)
-            unique_neg_antigens = (
-                neg_track_df.filter(pl.col('antigen').is_in(negative_antigens))
-                .select('antigen').unique().to_series().to_list()
+
+        def negative_controls(
+            aggregated_part: pl.DataFrame,
+            track_layout: Optional[Tuple[List[str], List[str], np.ndarray, np.ndarray]] = None
+        ) -> Tuple[Optional[pl.DataFrame], List[str]]:
+            return _negative_control_enrichment(
+                aggregated_part, total_reads_df, negative_antigens, base_order,
+                include_library, sequenced_library_antigen, library_condition,
+                pseudo_count, single_control_frequency_threshold,
+                engine, float32, consumed_comparisons, track_layout
             )
-            neg_enrichments_max: List[pl.DataFrame] = []   # multi-condition: elementId + MaxPositiveEnrichment
-            neg_enrichments_present: List[pl.DataFrame] = []  # single-condition: elementId + PresentInNegControl
-
-            for neg_antigen in unique_neg_antigens:
-                antigen_filter = pl.col('antigen') == neg_antigen
-                if sequenced_library_enabled and sequenced_library_antigen is not None:
-                    antigen_filter = antigen_filter | (pl.col('antigen') == sequenced_library_antigen)
-                
-                # Include library sample in each negative antigen's track when sequenced library is enabled
-                antigen_df = neg_track_df.filter(antigen_filter)
-
-                # Pivot for this specific negative antigen
-                antigen_pivot = (
-                    antigen_df
-                    .group_by(['elementId', 'condition'])
-                    .agg(pl.col('abundance').sum().alias('abundance'))
-                    .pivot(values='abundance', index='elementId', on='condition', aggregate_function='sum')
-                    .fill_null(0)
+
+        if not streaming:
+            profiler.start("negative_controls")
+            max_neg_enrichment_df, neg_control_columns = negative_controls(aggregated_df)
+            profiler.stop(rows=max_neg_enrichment_df.height if max_neg_enrichment_df is not None else 0)
+
+    # --- Target Track Processing ---
+    # Everything above is shared; each target takes its own track out of the
+    # aggregated rows and writes its own outputs
+    target_list = targets if targets is not None else [current_target]
+
+    def target_track(target: Optional[str]) -> Tuple[Dict[str, int], Optional[pl.Expr]]:
+        """Total reads per condition of a target's track and the filter of its rows (None: all rows)."""
+        if has_antigen and target:
+            target_reads = total_reads_df.filter(pl.col('antigen') == target)
+            total_reads_dict = dict(zip(target_reads['condition'], target_reads['total_reads']))
+            # When sequenced library is enabled, include the library samples
+            if sequenced_library_enabled and sequenced_library_antigen is not None:
+                total_reads_dict[library_condition] = library_sample_reads
+                return total_reads_dict, (
+                    (pl.col('antigen') == target) | (pl.col('antigen') == sequenced_library_antigen)
                 )
+            return total_reads_dict, pl.col('antigen') == target
+        # Fallback to global totals if no antigen or control disabled
+        global_reads = total_reads_df.group_by('condition').agg(pl.col('total_reads').sum())
+        return dict(zip(global_reads['condition'], global_reads['total_reads'])), None
+
+    def frequency_table(
+        target_track_df: pl.DataFrame,
+        total_reads_dict: Dict[str, int],
+        n_clonotypes: int,
+        **stage_details
+    ) -> pl.DataFrame:
+        return _target_frequency_table(
+            target_track_df, effective_condition_order, engine, total_reads_dict,
+            n_clonotypes, pseudo_count, filter_clonotypes,
+            filter_single_sample, filter_any_zero, min_abundance, min_frequency,
+            present_in_rounds, present_in_rounds_logic,
+            library_condition, exclude_sequenced_library, profiler, stage_details
+        )
+
+    # Per-clonotype enrichment table; row-independent, so streaming mode
+    # computes it per slice of the elementIds
+    def enrich(pivot_part: pl.DataFrame, control_df: Optional[pl.DataFrame]) -> pl.DataFrame:
+        return _enrichment_columns(
+            pivot_part, effective_condition_order, engine, float32, consumed_comparisons,
+            control_df, neg_control_columns, control_enabled,
+            enrichment_threshold, control_threshold
+        )
 
-                # Only use conditions that are actually present for this antigen
-                # to avoid spurious enrichments from missing/synthetic conditions
-                pivot_names = antigen_pivot.collect_schema().names()
-                available_conditions = [c for c in base_order if c in pivot_names]
-                # If the antigen has one experimental condition not in base_order, use it as a fallback
-                experimental_pivot = [c for c in pivot_names if c not in ('elementId', library_condition)]
-                if len(experimental_pivot) == 1 and experimental_pivot[0] not in available_conditions:
-                    available_conditions = ([library_condition] if library_condition in pivot_names else []) + experimental_pivot
-
-                antigen_pivot = antigen_pivot.sort('elementId')
-                # Keep elementId in the selection
-                antigen_pivot = antigen_pivot.select(['elementId'] + available_conditions)
-
-                # Get total reads for this negative antigen; include library condition counts when library is enabled
-                neg_reads = total_reads_df.filter(
-                    (pl.col('antigen') == neg_antigen) | 
-                    ((library_condition is not None) & (pl.col('condition') == library_condition))
+    results: Dict[Optional[str], Dict[str, pl.DataFrame]] = {}
+    # Streaming mode spills next to the (first) enrichment output rather than
+    # into /tmp, which may be memory-backed
+    scratch_parent = os.path.dirname(os.path.abspath(target_path(enrichment_csv, target_list[0])))
+    with (tempfile.TemporaryDirectory(prefix='enrichment_', dir=scratch_parent) if streaming
+          else contextlib.nullcontext()) as scratch_dir:
+        # Streaming mode: enrichment table parts of each target, with their
+        # total row count and an empty table of the same schema
+        streamed: Dict[Optional[str], Tuple[List[str], int, Optional[pl.DataFrame]]] = {
+            target: ([], 0, None) for target in target_list
+        }
+        if streaming:
+            n_comparisons = len(_comparison_pairs(effective_condition_order, consumed_comparisons))
+            batch_rows = _streaming_batch_rows(
+                streaming_memory_mb, _streaming_row_bytes(len(effective_condition_order), n_comparisons)
+            )
+            tracks = {target: target_track(target) for target in target_list}
+            track_filters = [tracks[target][1] for target in target_list]
+            if control_tracks:
+                unique_neg_antigens, neg_conditions, track_has_condition = _control_track_layout(
+                    total_reads_df, negative_antigens, include_library, sequenced_library_antigen
                 )
-                neg_total_reads_dict = dict(zip(neg_reads['condition'], neg_reads['total_reads']))
-                
-                # Calculate track-specific n_clonotypes for this negative antigen
-                neg_n_clonotypes = antigen_df.select('elementId').n_unique()
-
-                if len(available_conditions) > 1:
-                    # Multiple conditions: compute frequencies and enrichments
-                    neg_freq_exprs = []
-                    for condition in available_conditions:
-                        total = neg_total_reads_dict.get(condition, 1)
-                        neg_freq_exprs.append(
-                            ((pl.col(condition) + pseudo_count) / (total + (neg_n_clonotypes * pseudo_count))).alias(f'freq_{condition}')
-                        )
-                    antigen_pivot = antigen_pivot.with_columns(neg_freq_exprs)
-                    antigen_enrichment = _calculate_enrichments_vectorized(
-                        antigen_pivot, available_conditions
-                    )
-                    # If no pairwise comparisons were possible, create a 0-filled max column
-                    if 'MaxPositiveEnrichment' not in antigen_enrichment.collect_schema().names():
-                        antigen_enrichment = antigen_enrichment.with_columns(
-                            pl.lit(0.0).alias('MaxPositiveEnrichment')
-                        )
-                    # Store new columns
-                    antigen_max = antigen_enrichment.select(['elementId', 'MaxPositiveEnrichment'])
-                    neg_enrichments_max.append(antigen_max)
-                elif len(available_conditions) == 1:
-                    # Single condition: calculate FC against target last condition
-                    cond = available_conditions[0]
-                    
-                    # Calculate frequency in control
-                    total = neg_total_reads_dict.get(cond, 1)
-                    freq_expr = (pl.col(cond) + pseudo_count) / (total + (neg_n_clonotypes * pseudo_count))
-                    
-                    antigen_pivot = antigen_pivot.with_columns(
-                        freq_expr.alias('_freq_control')
-                    )
-                    
-                    # Get target frequency from enrichment_results
-                    # if enrichment_results.height == 0:
-                    # If no target results, we can't calculate FC. (comment specific for enrichment FC usecase)
-                    present_df = antigen_pivot.filter(
-                        pl.col('_freq_control') >= single_control_frequency_threshold
-                    ).select(pl.col('elementId')).with_columns(
-                        pl.lit(True).alias('PresentInNegControl')
+                for neg_antigen in unique_neg_antigens:
+                    neg_filter = pl.col('antigen') == neg_antigen
+                    if include_library and neg_antigen != sequenced_library_antigen:
+                        neg_filter = neg_filter | (pl.col('antigen') == sequenced_library_antigen)
+                    track_filters.append(neg_filter)
+
+            profiler.start("element_slices")
+            slice_paths, track_n_clonotypes = _spill_element_batches(
+                input_df, group_cols, element_ids, element_count, batch_rows, track_filters, scratch_dir
+            )
+            profiler.stop()
+
+            for slice_i, slice_path in enumerate(slice_paths):
+                aggregated_df = pl.read_ipc(slice_path, memory_map=False)
+                os.remove(slice_path)
+                max_neg_enrichment_df = None
+                if control_tracks:
+                    profiler.tag()
+                    profiler.start("negative_controls", slice=slice_i)
+                    max_neg_enrichment_df, neg_control_columns = negative_controls(aggregated_df, (
+                        unique_neg_antigens, neg_conditions,
+                        np.array(track_n_clonotypes[len(target_list):], dtype=np.int64), track_has_condition
+                    ))
+                    profiler.stop(rows=max_neg_enrichment_df.height if max_neg_enrichment_df is not None else 0)
+
+                for target_i, target in enumerate(target_list):
+                    if target is not None:
+                        profiler.tag(target=target)
+                    total_reads_dict, track_filter = tracks[target]
+                    pivot_df = frequency_table(
+                        aggregated_df if track_filter is None else aggregated_df.filter(track_filter),
+                        total_reads_dict, track_n_clonotypes[target_i], slice=slice_i
                     )
-
-                    # Leave enrichment FC calculation in case we want to re-enable it in the future
-                    # else:
-                    #     target_last_cond = effective_condition_order[-1]
-                    #     target_freq_col = f'Frequency {target_last_cond}'
-                        
-                    #     # Join to get target frequency
-                    #     # We use left join on antigen_pivot to keep all control clonotypes
-                    #     antigen_pivot = antigen_pivot.join(
-                    #         enrichment_results.select(['elementId', target_freq_col]),
-                    #         on='elementId',
-                    #         how='left'
-                    #     )
-                        
-                    #     # Calculate Fold Change: Target / Control
-                    #     # Handle nulls (not in target) as 0 frequency
-                    #     antigen_pivot = antigen_pivot.with_columns(
-                    #         pl.col(target_freq_col).fill_null(0.0).alias('_freq_target')
-                    #     )
-                        
-                    #     # FC = Target / Control
-                    #     antigen_pivot = antigen_pivot.with_columns(
-                    #         (pl.col('_freq_target') / pl.col('_freq_control')).alias('_fc_target_control')
-                    #     )
-                        
-                    #     # Filter logic:
-                    #     # We keep (don't flag as PresentInNegControl) if:
-                    #     # 1. FC >= threshold (Specific enrichment in target)
-                    #     # 2. AND Frequency in control < threshold (Low abundance in control)
-                    #     present_df = antigen_pivot.filter(
-                    #         (pl.col('_fc_target_control') < single_control_fc_threshold) |
-                    #         (pl.col('_freq_control') >= single_control_frequency_threshold)
-                    #     ).select(pl.col('elementId')).with_columns(
-                    #         pl.lit(True).alias('PresentInNegControl')
-                    #     )
-                        
-                        
-                    neg_enrichments_present.append(present_df)                    
-
-            # Combine per-antigen results into one table; track which columns we produced
-            if neg_enrichments_max:
-                max_neg_enrichment_df = (
-                    pl.concat(neg_enrichments_max)
-                    .group_by('elementId')
-                    .agg(pl.col('MaxPositiveEnrichment').max().alias('MaxNegControlEnrichment'))
+                    with profiler.stage("enrichment", slice=slice_i) as stage:
+                        part = enrich(pivot_df, max_neg_enrichment_df)
+                        del pivot_df
+                        parts, n_rows, _ = streamed[target]
+                        if part.height > 0:
+                            # With _max_freq for the EnrichmentQuality thresholds
+                            parts.append(os.path.join(scratch_dir, f'enrichment_{target_i}_{slice_i}.arrow'))
+                            part.with_columns(_max_frequency_expr(effective_condition_order)).write_ipc(parts[-1])
+                        streamed[target] = (parts, n_rows + part.height, part.head(0))
+                        stage['rows'] = part.height
+                    del part
+                del aggregated_df
+
+        for target in target_list:
+            (enrichment_path, bubble_path, top_enriched_path, top_10_path,
+             highest_enrichment_path, filtered_too_much_path) = output_paths(target)
+            if target is not None:
+                profiler.tag(target=target)
+
+            if streaming:
+                enrichment_parts, n_rows, enrichment_results = streamed[target]
+            else:
+                with profiler.stage("target_track") as stage:
+                    total_reads_dict, track_filter = target_track(target)
+                    target_track_df = aggregated_df if track_filter is None else aggregated_df.filter(track_filter)
+                    # Calculate track-specific n_clonotypes for normalization
+                    target_n_clonotypes = target_track_df.select('elementId').n_unique()
+                    stage['rows'] = target_track_df.height
+                pivot_df = frequency_table(target_track_df, total_reads_dict, target_n_clonotypes)
+                del target_track_df
+                n_rows = pivot_df.height
+
+            # Check if we have too few clonotypes after filtering
+            if filtered_too_much_path:
+                too_few = "true" if (n_rows < 1) else "false"
+                with open(filtered_too_much_path, 'w') as f:
+                    f.write(too_few)
+
+            if streaming and n_rows > 0:
+                outputs = _stream_enrichment_outputs(
+                    enrichment_parts, n_rows, effective_condition_order, enrichment_threshold,
+                    control_enabled, label_expr, element_ids, enrichment_path, bubble_path,
+                    top_enriched_path, top_10_path, highest_enrichment_path, top_n_bubble,
+                    top_n_enriched, min_enrichment, engine, float32, consumed_comparisons is None,
+                    profiler
                 )
-                neg_control_columns.append('MaxNegControlEnrichment')
-            if neg_enrichments_present:
-                present_df = (
-                    pl.concat(neg_enrichments_present)
-                    .group_by('elementId')
-                    .agg(pl.col('PresentInNegControl').any().alias('PresentInNegControl'))
+                if annotation_stats_json:
+                    with profiler.stage("annotation_stats"):
+                        _write_annotation_stats(outputs, target_path(annotation_stats_json, target))
+                results[target] = outputs
+                continue
+
+            if not streaming:
+                profiler.start("enrichment")
+                enrichment_results = enrich(pivot_df, max_neg_enrichment_df)
+                del pivot_df
+                profiler.stop(rows=enrichment_results.height)
+
+            # Calculate Enrichment Quality
+            profiler.start("quality_classification")
+            if enrichment_results.height > 0:
+                # Max frequency across all conditions for each clonotype
+                enrichment_results = enrichment_results.with_columns(_max_frequency_expr(effective_condition_order))
+                enrichment_results = _with_enrichment_quality(
+                    enrichment_results, _quality_thresholds(enrichment_results, enrichment_threshold), control_enabled
                 )
-                if max_neg_enrichment_df is not None:
-                    max_neg_enrichment_df = max_neg_enrichment_df.join(present_df, on='elementId', how='outer')
-                    
-                    # Coalesce elementId columns if they split during outer join
-                    if 'elementId_right' in max_neg_enrichment_df.columns:
-                        max_neg_enrichment_df = max_neg_enrichment_df.with_columns(
-                            pl.coalesce([pl.col('elementId'), pl.col('elementId_right')]).alias('elementId')
-                        ).drop('elementId_right')
-                else:
-                    max_neg_enrichment_df = present_df
-                neg_control_columns.append('PresentInNegControl')
+            else:
+                # For empty dataframe, add the column with correct type
+                enrichment_results = enrichment_results.with_columns(
+                    pl.lit(None).cast(pl.Utf8).alias('EnrichmentQuality')
+                )
+
+            # Apply labels, with elementId and Label first and rows sorted by elementId
+            enrichment_results = _label_enrichment_table(enrichment_results, label_expr)
+            profiler.stop(rows=enrichment_results.height)
+
+            # Process outputs efficiently
+            outputs = _process_outputs(
+                enrichment_results, effective_condition_order, bubble_path, top_enriched_path,
+                top_10_path, highest_enrichment_path, top_n_bubble, top_n_enriched, min_enrichment,
+                element_ids, engine, float32, consumed_comparisons is None, profiler
+            )
+
+            # Save main enrichment results
+            profiler.start("write_enrichment")
+            enrichment_results = _decode_element_ids(enrichment_results, element_ids)
+            write_table(enrichment_results, enrichment_path)
+            profiler.stop(rows=enrichment_results.height)
+            outputs['enrichment'] = enrichment_results
+            if annotation_stats_json:
+                with profiler.stage("annotation_stats"):
+                    _write_annotation_stats(outputs, target_path(annotation_stats_json, target))
+            results[target] = outputs
+
+    return results if targets is not None else results[current_target]
+
+
+def _write_annotation_stats(outputs: Dict, path: str) -> None:
+    """
+    Write the annotation values (see enrichment_annotations.annotation_stats) of
+    the highest enrichment 'Enrichment' column and of every comparison column and
+    Overall Log2FC of the enrichment table as JSON keyed by column name. The
+    values of each table are aggregated in one pass over it.
+    """
+    names = outputs['enrichment'].collect_schema().names()
+    columns = [col for col in names if col.startswith('Enrichment ')]
+    if 'Overall Log2FC' in names:
+        columns.append('Overall Log2FC')
+
+    stats = {}
+    if 'highest_enrichment' in outputs:
+        stats.update(annotation_stats(outputs['highest_enrichment'], ['Enrichment']))
+    if columns:
+        stats.update(annotation_stats(outputs['enrichment'], columns))
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=2)
+    print(f"Written annotation values to {path}")
+
+
+def _enrichment_columns(
+    pivot_df: pl.DataFrame,
+    condition_order: List[str],
+    engine: str,
+    float32: bool,
+    comparisons: Optional[List[Tuple[str, str]]],
+    max_neg_enrichment_df: Optional[pl.DataFrame],
+    neg_control_columns: List[str],
+    control_enabled: bool,
+    enrichment_threshold: float,
+    control_threshold: float
+) -> pl.DataFrame:
+    """
+    Per-clonotype enrichment table of a target pivot with frequency columns:
+    frequencies and comparisons, negative control columns, Overall Log2FC and
+    Binding Specificity. Every row only depends on the same pivot row, so a
+    slice of the pivot gives the same slice of the table.
+    """
+    # Calculate pairwise enrichments
+    enrichment_results = _calculate_enrichments_vectorized(
+        pivot_df, condition_order, engine, float32, comparisons
+    )
+    if len(condition_order) >= 2 and engine == "numpy":
+        # Overall Log2FC is the last vs first comparison, already on the matrix
+        first_cond = condition_order[0]
+        last_cond = condition_order[-1]
+        pivot_df = pivot_df.with_columns(
+            enrichment_results.get_column(f'Enrichment {last_cond} vs {first_cond}').alias('Overall Log2FC')
+        )
 
     # Join negative control columns if calculated (right after control processing)
     if max_neg_enrichment_df is not None:
@@ -758,49 +1481,61 @@ def hybrid_enrichment_analysis(
             .alias('Binding Specificity')
         )
 
-    # Calculate Enrichment Quality
-    if enrichment_results.height > 0:
-        # Max frequency across all conditions for each clonotype
-        freq_cols = [f'Frequency {c}' for c in effective_condition_order]
-        
-        # Generate max frequency column
-        enrichment_results = enrichment_results.with_columns(
-            pl.concat_list(freq_cols).list.max().alias('_max_freq')
-        )
-        
-        # Calculate thresholds (percentiles) from the current data
-        # Handle cases where columns might have nulls by using fill_null(0) for percentile calculation if needed
-        high_threshold = max(enrichment_threshold, enrichment_results.select(pl.col('MaxPositiveEnrichment').fill_null(0).quantile(0.75)).item())
-        stable_threshold = max(enrichment_threshold, enrichment_results.select(pl.col('Overall Log2FC').fill_null(0).quantile(0.50)).item())
-        low_threshold = enrichment_results.select(pl.col('MaxPositiveEnrichment').fill_null(0).quantile(0.25)).item()
-        freq_threshold = enrichment_results.select(pl.col('_max_freq').fill_null(0).quantile(0.75)).item()
-        
+    return enrichment_results
+
+
+def _max_frequency_expr(condition_order: List[str]) -> pl.Expr:
+    """Max frequency across all conditions for each clonotype."""
+    freq_cols = [f'Frequency {c}' for c in condition_order]
+    return pl.concat_list(freq_cols).list.max().alias('_max_freq')
+
+
+def _quality_thresholds(enrichment_results, enrichment_threshold: float) -> Tuple[float, float, float, float]:
+    """
+    EnrichmentQuality thresholds (high, stable, low, frequency) from the
+    percentiles of a whole enrichment table (eager or lazy) with _max_freq.
+    """
+    # Handle cases where columns might have nulls by using fill_null(0) for percentile calculation if needed
+    percentiles = enrichment_results.lazy().select(
+        pl.col('MaxPositiveEnrichment').fill_null(0).quantile(0.75).alias('high'),
+        pl.col('Overall Log2FC').fill_null(0).quantile(0.50).alias('stable'),
+        pl.col('MaxPositiveEnrichment').fill_null(0).quantile(0.25).alias('low'),
+        pl.col('_max_freq').fill_null(0).quantile(0.75).alias('freq'),
+    ).collect().row(0)
+    high, stable, low, freq = percentiles
+    return max(enrichment_threshold, high), max(enrichment_threshold, stable), low, freq
+
+
+def _with_enrichment_quality(
+    enrichment_results: pl.DataFrame,
+    thresholds: Tuple[float, float, float, float],
+    control_enabled: bool
+) -> pl.DataFrame:
+    """Add EnrichmentQuality given the thresholds of the whole table (see _quality_thresholds)."""
+    high_threshold, stable_threshold, low_threshold, freq_threshold = thresholds
+    enrichment_results = enrichment_results.with_columns(
+        pl.when((pl.col('MaxPositiveEnrichment') >= high_threshold) & (pl.col('Overall Log2FC') >= stable_threshold))
+        .then(pl.lit("Stable Binder"))
+        .when((pl.col('MaxPositiveEnrichment') >= high_threshold) & (pl.col('Overall Log2FC') < stable_threshold))
+        .then(pl.lit("Rescuer"))
+        .when((pl.col('MaxPositiveEnrichment') < low_threshold) & (pl.col('_max_freq') >= freq_threshold))
+        .then(pl.lit("Parasite"))
+        .otherwise(pl.lit("Weak Binder"))
+        .alias('EnrichmentQuality')
+    )
+    if control_enabled:
         enrichment_results = enrichment_results.with_columns(
-            pl.when((pl.col('MaxPositiveEnrichment') >= high_threshold) & (pl.col('Overall Log2FC') >= stable_threshold))
-            .then(pl.lit("Stable Binder"))
-            .when((pl.col('MaxPositiveEnrichment') >= high_threshold) & (pl.col('Overall Log2FC') < stable_threshold))
-            .then(pl.lit("Rescuer"))
-            .when((pl.col('MaxPositiveEnrichment') < low_threshold) & (pl.col('_max_freq') >= freq_threshold))
-            .then(pl.lit("Parasite"))
-            .otherwise(pl.lit("Weak Binder"))
+            pl.when(pl.col('Binding Specificity').is_in(['Negative-Control', 'Not-Enriched']))
+            .then(pl.lit("Non Binder").cast(pl.Utf8))
+            .otherwise(pl.col('EnrichmentQuality'))
             .alias('EnrichmentQuality')
         )
-        if control_enabled:
-            enrichment_results = enrichment_results.with_columns(
-                pl.when(pl.col('Binding Specificity').is_in(['Negative-Control', 'Not-Enriched']))
-                .then(pl.lit("Non Binder").cast(pl.Utf8))
-                .otherwise(pl.col('EnrichmentQuality'))
-                .alias('EnrichmentQuality')
-            )
-    else:
-        # For empty dataframe, add the column with correct type
-        enrichment_results = enrichment_results.with_columns(
-            pl.lit(None).cast(pl.Utf8).alias('EnrichmentQuality')
-        )
+    return enrichment_results
+
 
-    # Apply label mapping
-    enrichment_results = enrichment_results.join(
-        label_mapping, on='elementId', how='left')
+def _label_enrichment_table(enrichment_results: pl.DataFrame, label_expr: pl.Expr) -> pl.DataFrame:
+    """Apply labels, put elementId and Label first and sort rows by elementId."""
+    enrichment_results = enrichment_results.with_columns(label_expr)
 
     # Reorder columns: elementId, Label, then others
     cols_to_front = ['elementId', 'Label']
@@ -808,25 +1543,278 @@ def hybrid_enrichment_analysis(
     enrichment_results = enrichment_results.select(cols_to_front + other_cols)
 
     # Sort table by elementId
-    enrichment_results = enrichment_results.sort('elementId')
+    return enrichment_results.sort('elementId')
 
-    # Save main enrichment results
-    enrichment_results.write_csv(enrichment_csv)
 
-    # Process outputs efficiently
-    _process_outputs(
-        enrichment_results, effective_condition_order, bubble_csv, top_enriched_csv,
-        top_10_csv, highest_enrichment_csv, top_n_bubble, top_n_enriched, min_enrichment
+def _streaming_row_bytes(n_conditions: int, n_comparisons: int) -> float:
+    """
+    Bytes per input row of a streaming slice: the aggregated row and at most
+    one pivot and one enrichment table row (counts, frequencies and
+    comparisons).
+    """
+    return 96 + 8 * (3 * n_conditions + n_comparisons + 8)
+
+
+def _streaming_batch_rows(memory_limit_mb: float, row_bytes: float) -> int:
+    """
+    Input rows per streaming slice: the slice's aggregated rows and the pivot
+    and enrichment table built from them, plus the copies made while joining
+    and writing them, must fit in memory_limit_mb.
+    """
+    working_copies = 4
+    return max(1, int(memory_limit_mb * 2**20 / (max(row_bytes, 1.0) * working_copies)))
+
+
+def _streaming_ids_per_slice(n_elements: int, n_rows: int, batch_rows: int) -> int:
+    """Consecutive element ids per slice, for about batch_rows of n_rows input rows per slice."""
+    n_slices = max(1, -(-n_rows // batch_rows))
+    return max(1, -(-n_elements // n_slices))
+
+
+def _spill_element_batches(
+    input_df: pl.LazyFrame,
+    group_cols: List[str],
+    element_ids: pl.Series,
+    n_rows: int,
+    batch_rows: int,
+    track_filters: List[Optional[pl.Expr]],
+    scratch_dir: str
+) -> Tuple[List[str], List[int]]:
+    """
+    Streaming counterpart of the input aggregation, which never holds the
+    whole aggregated table. The input rows, with elementId encoded as by
+    _encode_element_ids, are spilled into one Parquet partition per slice of
+    consecutive ids, so that a slice holds about batch_rows of the n_rows
+    input rows (rows with a null elementId go to the first slice). Each
+    partition is then aggregated on its own and written to an Arrow IPC file.
+
+    An elementId is in one slice only, so the number of clonotypes of a track
+    (the distinct elementIds of the rows passing its filter, or of all rows
+    for None) is the sum over the slices. Returns the aggregated slice files,
+    in id order, and the number of clonotypes of each track of track_filters.
+    """
+    ids_per_slice = _streaming_ids_per_slice(len(element_ids), n_rows, batch_rows)
+    element_index = element_ids.to_frame().with_row_index('_id').lazy()
+
+    partitions = []
+    (
+        input_df
+        .join(element_index, on='elementId', how='left')
+        .with_columns(
+            pl.col('_id').alias('elementId'),
+            (pl.col('_id') // ids_per_slice).fill_null(0).alias('_slice')
+        )
+        .drop('_id')
+        .sink_parquet(
+            pl.PartitionByKey(os.path.join(scratch_dir, 'input'), by='_slice', include_key=False,
+                              finish_callback=partitions.append),
+            mkdir=True,
+        )
+    )
+    slice_inputs = (
+        partitions[0]
+        .select(pl.col('keys').struct.field('_slice'), 'path')
+        .group_by('_slice')
+        .agg('path')
+        .sort('_slice')
+    )
+
+    slice_paths: List[str] = []
+    n_clonotypes = [0] * len(track_filters)
+    for slice_key, paths in slice_inputs.iter_rows():
+        aggregated_df = (
+            pl.scan_parquet(paths)
+            .group_by(group_cols)
+            .agg(pl.col('abundance').sum().alias('abundance'))
+            .collect()
+        )
+        for path in paths:
+            os.remove(path)
+
+        track_elements = aggregated_df.select([c for c in ('elementId', 'antigen') if c in group_cols]).unique()
+        for i, track_filter in enumerate(track_filters):
+            rows = track_elements if track_filter is None else track_elements.filter(track_filter)
+            n_clonotypes[i] += rows.get_column('elementId').n_unique()
+        del track_elements
+
+        slice_paths.append(os.path.join(scratch_dir, f'aggregated_{slice_key}.arrow'))
+        aggregated_df.write_ipc(slice_paths[-1])
+        del aggregated_df
+    return slice_paths, n_clonotypes
+
+
+def _stream_enrichment_outputs(
+    enrichment_parts: List[str],
+    n_rows: int,
+    condition_order: List[str],
+    enrichment_threshold: float,
+    control_enabled: bool,
+    label_expr: pl.Expr,
+    element_ids: pl.Series,
+    enrichment_csv: str,
+    bubble_csv: str,
+    top_enriched_csv: str,
+    top_10_csv: Optional[str],
+    highest_enrichment_csv: Optional[str],
+    top_n_bubble: int,
+    top_n_enriched: int,
+    min_enrichment: float,
+    engine: str,
+    float32: bool,
+    all_comparisons: bool,
+    profiler: StageProfiler = NULL_PROFILER
+) -> Dict:
+    """
+    Streaming counterpart of labelling the enrichment table and calling
+    _process_outputs, with the same output files.
+
+    enrichment_parts are Arrow IPC files holding the n_rows rows of the
+    enrichment table (with _max_freq), in elementId order. A first pass gets
+    the EnrichmentQuality percentiles, a second pass adds the quality and
+    labels and the highest enrichment rows per part, written next to the
+    parts. The enrichment and highest enrichment tables are then streamed to
+    their outputs with sink_*, and the top clonotype outputs are built from
+    the top rows only. Those two large tables are returned as lazy scans of
+    the written files.
+    """
+    def scratch_path(name: str, part_path: str) -> str:
+        return os.path.join(os.path.dirname(part_path), f'{name}_{os.path.basename(part_path)}')
+
+    profiler.start("quality_classification")
+    thresholds = _quality_thresholds(pl.scan_ipc(enrichment_parts), enrichment_threshold)
+
+    # Pass 2: quality, labels and the highest enrichment rows of each part
+    labelled_parts = [scratch_path('labelled', path) for path in enrichment_parts]
+    highest_parts = [scratch_path('highest', path) for path in enrichment_parts]
+    enrichment_cols: List[str] = []
+    for i, path in enumerate(enrichment_parts):
+        part = pl.read_ipc(path, memory_map=False)
+        os.remove(path)
+        part = _label_enrichment_table(
+            _with_enrichment_quality(part, thresholds, control_enabled), label_expr
+        )
+        enrichment_cols = [col for col in part.columns if col.startswith('Enrichment ')]
+        if highest_enrichment_csv and enrichment_cols:
+            _create_highest_enrichment(
+                part, enrichment_cols, condition_order, engine, float32, all_comparisons
+            ).write_ipc(highest_parts[i])
+        part.write_ipc(labelled_parts[i])
+        del part
+    profiler.stop(rows=n_rows)
+
+    profiler.start("write_enrichment")
+    enrichment_lf = pl.scan_ipc(labelled_parts)
+    sink_table(_decode_element_ids(enrichment_lf, element_ids), enrichment_csv)
+    profiler.stop(rows=n_rows)
+
+    # The top clonotype outputs only read the rows of the top clonotypes. One
+    # row more than the largest top N keeps the row order of their joins as on
+    # the whole table (a join follows its larger side)
+    top_n = max(top_n_bubble, top_n_enriched, 10 if top_10_csv else 0) + 1
+    profiler.start("top_rows")
+    top_ids = (
+        enrichment_lf
+        .select(
+            (pl.col('MaxPositiveEnrichment') >= min_enrichment).alias('_passes'),
+            'MaxPositiveEnrichment', 'elementId'
+        )
+        .sort(['_passes', 'MaxPositiveEnrichment', 'elementId'], descending=[True, True, False])
+        .head(top_n)
+        .collect()
+        .get_column('elementId')
     )
+    top_rows = enrichment_lf.filter(pl.col('elementId').is_in(top_ids.implode())).collect()
+    profiler.stop(rows=top_rows.height)
+    # Without comparison columns _process_outputs writes the empty highest enrichment table
+    stream_highest = bool(highest_enrichment_csv and enrichment_cols)
+    outputs = _process_outputs(
+        top_rows, condition_order, bubble_csv, top_enriched_csv, top_10_csv,
+        None if stream_highest else highest_enrichment_csv,
+        top_n_bubble, top_n_enriched, min_enrichment, element_ids, engine, float32, all_comparisons,
+        profiler
+    )
+    if stream_highest:
+        profiler.start("write_highest_enrichment")
+        sink_table(_decode_element_ids(
+            pl.scan_ipc(highest_parts).sort(['Enrichment', 'elementId'], descending=[True, False]),
+            element_ids
+        ), highest_enrichment_csv)
+        outputs['highest_enrichment'] = scan_table(highest_enrichment_csv)
+        profiler.stop()
+    for path in labelled_parts + highest_parts:
+        if os.path.exists(path):
+            os.remove(path)
+
+    outputs['enrichment'] = scan_table(enrichment_csv)
+    return outputs
+
+
+def _export_comparison_pairs(
+    export_comparisons: Optional[List[List[str]]],
+    condition_order: List[str]
+) -> List[Tuple[str, str]]:
+    """
+    (numerator, denominator) conditions of the requested export comparisons.
+    Comparison columns only exist for a later condition of condition_order
+    vs an earlier one, so any other pair is an error rather than a missing
+    column.
+    """
+    position = {condition: i for i, condition in enumerate(condition_order)}
+    pairs = []
+    for comparison in export_comparisons or []:
+        if not isinstance(comparison, (list, tuple)) or len(comparison) != 2:
+            raise ValueError(f"Export comparisons must be [numerator, denominator] pairs, got {comparison!r}")
+        numerator, denominator = (str(condition) for condition in comparison)
+        for condition in (numerator, denominator):
+            if condition not in position:
+                raise ValueError(
+                    f"Unknown condition {condition!r} in export comparison {comparison!r}; "
+                    f"the conditions are {condition_order}")
+        if position[numerator] <= position[denominator]:
+            raise ValueError(
+                f"Export comparison {comparison!r} is not supported: the numerator must come after "
+                f"the denominator in the condition order {condition_order}")
+        pairs.append((numerator, denominator))
+    return pairs
+
+
+def _comparison_pairs(
+    condition_order: List[str],
+    comparisons: Optional[List[Tuple[str, str]]] = None
+) -> List[Tuple[int, int]]:
+    """
+    (numerator, denominator) index pairs of the comparison columns, in column
+    order: numerator i, denominator j < i. With `comparisons`, only the listed
+    (numerator, denominator) condition pairs are kept.
+    """
+    pairs = [(num_i, den_j) for num_i in range(1, len(condition_order)) for den_j in range(num_i)]
+    if comparisons is not None:
+        requested = set(comparisons)
+        pairs = [(num_i, den_j) for num_i, den_j in pairs
+                 if (condition_order[num_i], condition_order[den_j]) in requested]
+    return pairs
 
 
 def _calculate_enrichments_vectorized(
     pivot_df: pl.DataFrame,
-    condition_order: List[str]
+    condition_order: List[str],
+    engine: str = "polars",
+    float32: bool = False,
+    comparisons: Optional[List[Tuple[str, str]]] = None
 ) -> pl.DataFrame:
     """
     Calculate enrichments using vectorized operations for better performance.
+
+    By default every comparison column is materialized. With `comparisons`
+    (a list of (numerator, denominator) conditions) only those columns are,
+    and MaxPositiveEnrichment comes from a prefix-minimum scan over the
+    conditions (see _best_comparison_scan) instead of from all columns; its
+    values are the same. The sparse engine computes the columns as the
+    polars engine does and always takes MaxPositiveEnrichment from the scan.
     """
+    if engine == "numpy":
+        return _calculate_enrichments_numpy(pivot_df, condition_order, float32, comparisons)
+
     # Calculate all pairwise enrichments efficiently
     enrichment_exprs = []
     freq_exprs = []
@@ -836,31 +1824,35 @@ def _calculate_enrichments_vectorized(
         freq_exprs.append(pl.col(f'freq_{condition}').alias(
             f'Frequency {condition}'))
 
-    for num_i in range(1, len(condition_order)):
-        for den_j in range(num_i):
-            numerator = condition_order[num_i]
-            denominator = condition_order[den_j]
-            enrichment_col_name = f'Enrichment {numerator} vs {denominator}'
-            enrichment_col_names.append(enrichment_col_name)
+    for num_i, den_j in _comparison_pairs(condition_order, comparisons):
+        numerator = condition_order[num_i]
+        denominator = condition_order[den_j]
+        enrichment_col_name = f'Enrichment {numerator} vs {denominator}'
+        enrichment_col_names.append(enrichment_col_name)
 
-            # Calculate enrichment: only when both numerator and denominator are non-zero
-            num_freq_expr = pl.col(f'freq_{numerator}')
-            den_freq_expr = pl.col(f'freq_{denominator}')
+        # Calculate enrichment: only when both numerator and denominator are non-zero
+        num_freq_expr = pl.col(f'freq_{numerator}')
+        den_freq_expr = pl.col(f'freq_{denominator}')
 
-            enrichment_expr = (
-                pl.when((num_freq_expr > 0) & (den_freq_expr > 0))
-                .then((num_freq_expr / den_freq_expr).log(2))
-                .otherwise(None)
-                .alias(enrichment_col_name)
-            )
+        enrichment_expr = (
+            pl.when((num_freq_expr > 0) & (den_freq_expr > 0))
+            .then((num_freq_expr / den_freq_expr).log(2))
+            .otherwise(None)
+            .alias(enrichment_col_name)
+        )
 
-            enrichment_exprs.append(enrichment_expr)
+        enrichment_exprs.append(enrichment_expr)
 
     # Add frequency and enrichment columns first
     result_df = pivot_df.with_columns(freq_exprs + enrichment_exprs)
 
-    # Now calculate max positive enrichment to match original pandas behavior
-    if enrichment_col_names:
+    has_max = len(condition_order) > 1
+    if has_max and (comparisons is not None or engine == "sparse"):
+        # Scan the frequency columns one at a time rather than all comparisons
+        result_df = result_df.with_columns(_max_positive_enrichment(
+            _frequency_values(pivot_df.get_column(f'freq_{c}')) for c in condition_order
+        ))
+    elif has_max:
         # Match original pandas behavior: clip negative values to 0, then find max
         max_pos_enrich_expr = pl.concat_list([
             pl.when(pl.col(col).is_null()).then(
@@ -874,7 +1866,7 @@ def _calculate_enrichments_vectorized(
     freq_col_names = [
         f'Frequency {condition}' for condition in condition_order]
     result_cols = freq_col_names + enrichment_col_names
-    if enrichment_col_names:  # Only add MaxPositiveEnrichment if we have enrichment columns
+    if has_max:  # Only add MaxPositiveEnrichment if there are comparisons
         result_cols.append('MaxPositiveEnrichment')
     
     # Safely include elementId if it exists in the input
@@ -884,6 +1876,152 @@ def _calculate_enrichments_vectorized(
     return result_df.select(result_cols)
 
 
+def _frequency_values(freq: pl.Series) -> np.ndarray:
+    """Frequency column as an array; non-positive (null) frequencies are NaN."""
+    values = freq.to_numpy()
+    return np.where(values > 0, values, np.nan)
+
+
+def _max_positive_enrichment(freq_columns: Iterable[np.ndarray]) -> pl.Series:
+    """
+    MaxPositiveEnrichment from the frequency columns (see _frequency_values),
+    in condition order: the log of the best frequency ratio, computed as in
+    the comparison columns, clipped at 0.
+    """
+    _, _, best_ratio = _best_comparison_scan(freq_columns, ratio=True)
+    return (
+        pl.Series('_best_ratio', best_ratio, nan_to_null=True).log(2)
+        .clip(lower_bound=0).fill_null(0).alias('MaxPositiveEnrichment')
+    )
+
+
+def _frequency_matrix(frame: pl.DataFrame, columns: List[str], dtype=np.float64) -> np.ndarray:
+    """N x K matrix of the given frequency columns; non-positive (null) frequencies are NaN."""
+    matrix = np.full((frame.height, len(columns)), np.nan, dtype=dtype, order='F')
+    for i, column in enumerate(columns):
+        freq = frame.get_column(column).to_numpy()
+        np.copyto(matrix[:, i], freq, where=freq > 0, casting='same_kind')
+    return matrix
+
+
+def _log2_frequency_matrix(frame: pl.DataFrame, columns: List[str], dtype=np.float64) -> np.ndarray:
+    """N x K matrix of log2 frequencies; non-positive (null) frequencies are NaN."""
+    log_freq = np.full((frame.height, len(columns)), np.nan, dtype=dtype, order='F')
+    for i, column in enumerate(columns):
+        freq = frame.get_column(column).to_numpy()
+        np.log2(freq, out=log_freq[:, i], where=freq > 0)
+    return log_freq
+
+
+def _best_comparison_scan(
+    values,
+    ratio: bool = False
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Highest comparison of every row in O(K): for numerator i the best
+    denominator j < i is the one with the lowest value so far, so a running
+    (prefix) minimum replaces the K*(K-1)/2 pairwise comparisons.
+
+    `values` holds log2 frequencies (comparison = difference) or, with
+    ratio=True, frequencies (comparison = ratio); NaN marks a null frequency.
+    It is an N x K matrix or an iterable of the K columns, which lets callers
+    produce one column at a time. Returns numerator and denominator indices
+    (-1 where no comparison is defined) and the best difference or ratio
+    (NaN where undefined). Ties go to the first comparison in column order.
+    """
+    if isinstance(values, np.ndarray):
+        if values.shape[1] == 0:
+            return (np.full(values.shape[0], -1, dtype=np.int64), np.full(values.shape[0], -1, dtype=np.int64),
+                    np.full(values.shape[0], np.nan, dtype=values.dtype))
+        values = values.T
+    columns = iter(values)
+
+    run_min = np.array(next(columns))
+    n_rows = len(run_min)
+    best = np.full(n_rows, np.nan, dtype=run_min.dtype)
+    best_num = np.full(n_rows, -1, dtype=np.int64)
+    best_den = np.full(n_rows, -1, dtype=np.int64)
+
+    run_arg = np.zeros(n_rows, dtype=np.int64)
+    with np.errstate(invalid='ignore'):
+        for i, current in enumerate(columns, start=1):
+            candidate = current / run_min if ratio else current - run_min
+            improved = (candidate > best) | (np.isnan(best) & ~np.isnan(candidate))
+            best[improved] = candidate[improved]
+            best_num[improved] = i
+            best_den[improved] = run_arg[improved]
+
+            lower = (current < run_min) | (np.isnan(run_min) & ~np.isnan(current))
+            run_min[lower] = current[lower]
+            run_arg[lower] = i
+    return best_num, best_den, best
+
+
+def _calculate_enrichments_numpy(
+    pivot_df: pl.DataFrame,
+    condition_order: List[str],
+    float32: bool = False,
+    comparisons: Optional[List[Tuple[str, str]]] = None
+) -> pl.DataFrame:
+    """
+    Same output as the polars engine of _calculate_enrichments_vectorized,
+    computed on a dense N x K matrix of log2 frequencies: every log is taken
+    once per condition and each comparison is a difference of two columns,
+    built by broadcasting one numerator column against all its denominators.
+
+    log2(a) - log2(b) differs from log2(a / b) only by rounding, within
+    1e-12 (absolute) in float64. With float32 storage the log2 frequencies,
+    enrichments and MaxPositiveEnrichment take half the memory and agree with
+    the float64 results within 1e-5 (absolute). Either way, values tied
+    under one engine (equal count ratios are common at low abundance) may
+    differ in the last digits under the other, so tied rows can be ordered
+    differently and values sitting on a threshold (e.g. the EnrichmentQuality
+    quantiles) may be classified differently.
+    """
+    dtype = np.float32 if float32 else np.float64
+    n_conditions = len(condition_order)
+    n_rows = pivot_df.height
+
+    log_freq = _log2_frequency_matrix(pivot_df, [f'freq_{c}' for c in condition_order], dtype)
+
+    pairs = _comparison_pairs(condition_order, comparisons)
+    enrichment_col_names = [
+        f'Enrichment {condition_order[num_i]} vs {condition_order[den_j]}' for num_i, den_j in pairs
+    ]
+    enrichments = np.empty((n_rows, len(pairs)), dtype=dtype, order='F')
+    max_positive = np.zeros(n_rows, dtype=dtype)
+    if comparisons is None:
+        # Comparison columns in the order numerator i, denominator j < i
+        offset = 0
+        for num_i in range(1, n_conditions):
+            block = enrichments[:, offset:offset + num_i]
+            np.subtract(log_freq[:, num_i:num_i + 1], log_freq[:, :num_i], out=block)
+            # Nulls and negative values count as 0 for the maximum
+            np.fmax(max_positive, np.fmax.reduce(block, axis=1), out=max_positive)
+            offset += num_i
+    else:
+        for k, (num_i, den_j) in enumerate(pairs):
+            np.subtract(log_freq[:, num_i], log_freq[:, den_j], out=enrichments[:, k])
+        _, _, best = _best_comparison_scan(log_freq)
+        np.fmax(max_positive, best, out=max_positive)
+
+    result_cols = []
+    if 'elementId' in pivot_df.collect_schema().names():
+        result_cols.append(pivot_df.get_column('elementId'))
+    result_cols += [
+        pivot_df.get_column(f'freq_{condition}').alias(f'Frequency {condition}')
+        for condition in condition_order
+    ]
+    result_cols += [
+        pl.Series(name, enrichments[:, k], nan_to_null=True)
+        for k, name in enumerate(enrichment_col_names)
+    ]
+    if n_conditions > 1:
+        result_cols.append(pl.Series('MaxPositiveEnrichment', max_positive))
+
+    return pl.DataFrame(result_cols)
+
+
 def _process_outputs(
     enrichment_results: pl.DataFrame,
     condition_order: List[str],
@@ -893,50 +2031,67 @@ def _process_outputs(
     highest_enrichment_csv: Optional[str],
     top_n_bubble: int,
     top_n_enriched: int,
-    min_enrichment: float
-) -> None:
+    min_enrichment: float,
+    element_ids: Optional[pl.Series] = None,
+    engine: str = "polars",
+    float32: bool = False,
+    all_comparisons: bool = True,
+    profiler: StageProfiler = NULL_PROFILER
+) -> Dict[str, pl.DataFrame]:
     """
-    Process and save output files efficiently.
+    Process and save output files efficiently. Returns the written frames.
+    Each output is a stage of the profiler (write_<output>).
+
+    When element_ids is given, enrichment_results carries encoded elementIds
+    (see _encode_element_ids) and outputs are decoded before being written.
+    Without all_comparisons, enrichment_results holds only some comparison
+    columns; the outputs needing all of them compute what they use.
     """
+    outputs: Dict[str, pl.DataFrame] = {}
+    decode = (lambda df: _decode_element_ids(df, element_ids)) if element_ids is not None else (lambda df: df)
     # Process enrichment data for detailed output
     enrichment_cols = [
         col for col in enrichment_results.collect_schema().names() if col.startswith('Enrichment ')]
 
     if enrichment_cols:
-        # Create detailed enrichment table efficiently
-        enrichment_detailed = _create_detailed_enrichment_table(
-            enrichment_results, enrichment_cols, condition_order
-        )
-
         # Save highest enrichment if requested
         if highest_enrichment_csv:
-            highest_enrichment = (
-                enrichment_detailed
-                .filter(pl.col('Enrichment').is_not_null())
-                .group_by(['elementId', 'Label'])
-                .agg(pl.all().sort_by(['Enrichment', 'elementId'], descending=[True, False]).first())
-                .sort(['Enrichment', 'elementId'], descending=[True, False])
-            )
-            highest_enrichment.write_csv(highest_enrichment_csv)
+            profiler.start("write_highest_enrichment")
+            highest_enrichment = decode(_create_highest_enrichment(
+                enrichment_results, enrichment_cols, condition_order, engine, float32, all_comparisons
+            ))
+            write_table(highest_enrichment, highest_enrichment_csv)
+            outputs['highest_enrichment'] = highest_enrichment
+            profiler.stop(rows=highest_enrichment.height)
 
         # Process bubble data
-        bubble_data = _create_bubble_data(
-            enrichment_results, top_n_bubble, min_enrichment
-        )
-        bubble_data.write_csv(bubble_csv)
+        profiler.start("write_bubble")
+        bubble_data = decode(_create_bubble_data(
+            enrichment_results, top_n_bubble, min_enrichment,
+            None if all_comparisons else condition_order, engine, float32
+        ))
+        write_table(bubble_data, bubble_csv)
+        outputs['bubble'] = bubble_data
+        profiler.stop(rows=bubble_data.height)
 
         # Process top enriched data
-        top_enriched_data = _create_top_enriched_data(
+        profiler.start("write_top_enriched")
+        top_enriched_data = decode(_create_top_enriched_data(
             enrichment_results, condition_order, min_enrichment, top_n_enriched
-        )
-        top_enriched_data.write_csv(top_enriched_csv)
+        ))
+        write_table(top_enriched_data, top_enriched_csv)
+        outputs['top_enriched'] = top_enriched_data
+        profiler.stop(rows=top_enriched_data.height)
 
         # Process top 20 data if requested
         if top_10_csv:
-            top_10_data = _create_top_enriched_data(
+            profiler.start("write_top_10")
+            top_10_data = decode(_create_top_enriched_data(
                 enrichment_results, condition_order, min_enrichment, 10
-            )
-            top_10_data.write_csv(top_10_csv)
+            ))
+            write_table(top_10_data, top_10_csv)
+            outputs['top_10'] = top_10_data
+            profiler.stop(rows=top_10_data.height)
     else:
         # Create empty outputs if no enrichment columns
         
@@ -946,7 +2101,8 @@ def _process_outputs(
             'Frequency_Numerator', 'MaxPositiveEnrichment', 
             'Binding Specificity', 'MaxNegControlEnrichment', 'PresentInNegControl', 'EnrichmentQuality'
         ]
-        pl.DataFrame(schema=bubble_cols).write_csv(bubble_csv)
+        outputs['bubble'] = pl.DataFrame(schema=bubble_cols)
+        write_table(outputs['bubble'], bubble_csv)
 
         # Top enriched needs specific columns
         top_enriched_cols = [
@@ -954,10 +2110,12 @@ def _process_outputs(
             'Binding Specificity', 'MaxNegControlEnrichment', 'PresentInNegControl',
             'EnrichmentQuality', 'MaxPositiveEnrichment'
         ]
-        pl.DataFrame(schema=top_enriched_cols).write_csv(top_enriched_csv)
+        outputs['top_enriched'] = pl.DataFrame(schema=top_enriched_cols)
+        write_table(outputs['top_enriched'], top_enriched_csv)
         
         if top_10_csv:
-            pl.DataFrame(schema=top_enriched_cols).write_csv(top_10_csv)
+            outputs['top_10'] = pl.DataFrame(schema=top_enriched_cols)
+            write_table(outputs['top_10'], top_10_csv)
             
         if highest_enrichment_csv:
             highest_cols = [
@@ -966,7 +2124,38 @@ def _process_outputs(
                 'Overall Log2FC', 'MaxPositiveEnrichment', 
                 'MaxNegControlEnrichment', 'PresentInNegControl', 'Binding Specificity', 'EnrichmentQuality'
             ]
-            pl.DataFrame(schema=highest_cols).write_csv(highest_enrichment_csv)
+            outputs['highest_enrichment'] = pl.DataFrame(schema=highest_cols)
+            write_table(outputs['highest_enrichment'], highest_enrichment_csv)
+
+    return outputs
+
+def _create_highest_enrichment(
+    enrichment_results: pl.DataFrame,
+    enrichment_cols: List[str],
+    condition_order: List[str],
+    engine: str = "polars",
+    float32: bool = False,
+    all_comparisons: bool = True
+) -> pl.DataFrame:
+    """
+    Highest enrichment row per clonotype, sorted by enrichment. Every row
+    only depends on its own clonotype's row of enrichment_results.
+    """
+    if not all_comparisons:
+        return _create_highest_enrichment_scan(enrichment_results, condition_order, engine, float32)
+
+    # Create detailed enrichment table efficiently
+    enrichment_detailed = _create_detailed_enrichment_table(
+        enrichment_results, enrichment_cols, condition_order
+    )
+    return (
+        enrichment_detailed
+        .filter(pl.col('Enrichment').is_not_null())
+        .group_by(['elementId', 'Label'])
+        .agg(pl.all().sort_by(['Enrichment', 'elementId'], descending=[True, False]).first())
+        .sort(['Enrichment', 'elementId'], descending=[True, False])
+    )
+
 
 def _create_detailed_enrichment_table(
     enrichment_results: pl.DataFrame,
@@ -1036,13 +2225,71 @@ def _create_detailed_enrichment_table(
     return result
 
 
+def _create_highest_enrichment_scan(
+    enrichment_results: pl.DataFrame,
+    condition_order: List[str],
+    engine: str = "polars",
+    float32: bool = False
+) -> pl.DataFrame:
+    """
+    Highest enrichment per clonotype from the frequency columns alone: same
+    table as grouping _create_detailed_enrichment_table by clonotype, with the
+    best comparison found by _best_comparison_scan in O(K) per clonotype.
+    Between comparisons with equal enrichment the first in column order wins.
+    """
+    extra_cols = []
+    for col in ['Overall Log2FC', 'Binding Specificity', 'EnrichmentQuality', 'MaxNegControlEnrichment', 'PresentInNegControl']:
+        if col in enrichment_results.columns:
+            extra_cols.append(col)
+
+    freq_cols = [f'Frequency {cond}' for cond in condition_order]
+    if engine == "numpy":
+        dtype = np.float32 if float32 else np.float64
+        best_num, best_den, best = _best_comparison_scan(
+            _log2_frequency_matrix(enrichment_results, freq_cols, dtype))
+        enrichment = pl.Series('Enrichment', best, nan_to_null=True)
+    else:
+        # Same division and log as the comparison columns
+        best_num, best_den, best_ratio = _best_comparison_scan(
+            _frequency_matrix(enrichment_results, freq_cols), ratio=True)
+        enrichment = pl.Series('Enrichment', best_ratio, nan_to_null=True).log(2)
+
+    defined = best_num >= 0
+    rows = np.flatnonzero(defined)
+    conditions = np.array(condition_order, dtype=object)
+    numerators = conditions[best_num[defined]]
+    denominators = conditions[best_den[defined]]
+    freq_numerator = enrichment_results.select(freq_cols).to_numpy()[rows, best_num[defined]]
+
+    highest = enrichment_results.filter(pl.Series(defined)).select(['elementId', 'Label'] + extra_cols)
+    return (
+        highest.with_columns(
+            pl.Series('Comparison', [f'{n} vs {d}' for n, d in zip(numerators, denominators)], dtype=pl.Utf8),
+            pl.Series('Numerator', numerators, dtype=pl.Utf8),
+            pl.Series('Denominator', denominators, dtype=pl.Utf8),
+            enrichment.filter(pl.Series(defined)),
+            pl.Series('Frequency_Numerator', freq_numerator, dtype=pl.Float64),
+        )
+        .filter(pl.col('Enrichment').is_not_null())
+        .select(['elementId', 'Label', 'Comparison', 'Numerator', 'Denominator', 'Enrichment',
+                 'Frequency_Numerator'] + extra_cols)
+        .sort(['Enrichment', 'elementId'], descending=[True, False])
+    )
+
+
 def _create_bubble_data(
     enrichment_results: pl.DataFrame,
     top_n_bubble: int,
-    min_enrichment: float
+    min_enrichment: float,
+    condition_order: Optional[List[str]] = None,
+    engine: str = "polars",
+    float32: bool = False
 ) -> pl.DataFrame:
     """
     Create bubble plot data efficiently.
+
+    With condition_order, enrichment_results holds only some comparison
+    columns and all of them are computed for the top clonotypes here.
     """
     # Filter by minimum enrichment
     max_col = 'MaxPositiveEnrichment'
@@ -1073,6 +2320,17 @@ def _create_bubble_data(
     bubble_data = filtered_data.join(
         top_clonotypes, on='elementId', how='inner')
 
+    if condition_order is not None:
+        all_enrichments = _calculate_enrichments_vectorized(
+            bubble_data.select([pl.col(f'Frequency {c}').alias(f'freq_{c}') for c in condition_order]),
+            condition_order, engine, float32
+        )
+        bubble_data = bubble_data.select(
+            [col for col in bubble_data.columns if not col.startswith('Enrichment ')]
+        ).hstack(all_enrichments.select(
+            [col for col in all_enrichments.columns if col.startswith('Enrichment ')]
+        ))
+
     # Create bubble data efficiently
     enrichment_cols = [
         col for col in bubble_data.collect_schema().names() if col.startswith('Enrichment ')]
@@ -1082,39 +2340,53 @@ def _create_bubble_data(
     for col in ['Binding Specificity', 'MaxNegControlEnrichment', 'PresentInNegControl', 'EnrichmentQuality']:
         if col in bubble_data.columns:
             extra_cols.append(col)
-            
-    bubble_rows = []
 
-    for row in bubble_data.iter_rows(named=True):
-        element_id = row['elementId']
-        label = row['Label']
-        max_val = row[max_col]
-        
-        # Prepare extra data
-        extra_data = {col: row[col] for col in extra_cols}
-
-        for col in enrichment_cols:
-            enrich_val = row[col]
-            if enrich_val is not None and enrich_val > 0:
-                # Parse comparison
-                comparison = col.replace('Enrichment ', '')
-                numerator, denominator = comparison.split(' vs ')
-                freq_val = row.get(f'Frequency {numerator}', None)
-
-                row_data = {
-                    'elementId': element_id,
-                    'Label': label,
-                    'Numerator': numerator,
-                    'Denominator': denominator,
-                    'Enrichment': enrich_val,
-                    'Frequency_Numerator': freq_val,
-                    max_col: max_val
-                }
-                row_data.update(extra_data)
-                bubble_rows.append(row_data)
-
-    if bubble_rows:
-        return pl.DataFrame(bubble_rows)
+    # Parse numerator and denominator once per comparison column
+    comparisons = []
+    for col in enrichment_cols:
+        numerator, denominator = col.replace('Enrichment ', '').split(' vs ')
+        comparisons.append((col, numerator, denominator))
+    comparison_meta = pl.DataFrame(
+        {
+            'Comparison': [col for col, _, _ in comparisons],
+            '_comparison_index': list(range(len(comparisons))),
+            'Numerator': [numerator for _, numerator, _ in comparisons],
+            'Denominator': [denominator for _, _, denominator in comparisons],
+        },
+        schema_overrides={'_comparison_index': pl.UInt32},
+    )
+
+    # Frequency of each condition in long form, to look up the numerator's
+    numerators = dict.fromkeys(numerator for _, numerator, _ in comparisons)
+    freq_cols = [
+        f'Frequency {numerator}' for numerator in numerators
+        if f'Frequency {numerator}' in bubble_data.columns]
+    bubble_data = bubble_data.with_row_index('_row')
+    freq_long = (
+        bubble_data
+        .select(['_row'] + freq_cols)
+        .unpivot(index='_row', on=freq_cols, variable_name='Numerator', value_name='Frequency_Numerator')
+        .with_columns(pl.col('Numerator').str.replace('Frequency ', ''))
+    )
+
+    # One row per (clonotype, comparison) with positive enrichment, in the
+    # order of the clonotype rows and then of the comparison columns
+    bubble_long = (
+        bubble_data
+        .select(['_row', 'elementId', 'Label', max_col] + extra_cols + enrichment_cols)
+        .unpivot(index=['_row', 'elementId', 'Label', max_col] + extra_cols,
+                 on=enrichment_cols, variable_name='Comparison', value_name='Enrichment')
+        .filter(pl.col('Enrichment') > 0)
+        .join(comparison_meta, on='Comparison', how='left')
+        .join(freq_long, on=['_row', 'Numerator'], how='left')
+        .sort(['_row', '_comparison_index'])
+    )
+
+    if bubble_long.height > 0:
+        return bubble_long.select(
+            ['elementId', 'Label', 'Numerator', 'Denominator', 'Enrichment',
+             pl.col('Frequency_Numerator').cast(pl.Float64), max_col] + extra_cols
+        )
     else:
         schema = {
             'elementId': pl.Utf8, 'Label': pl.Utf8, 'Numerator': pl.Utf8,
@@ -1217,13 +2489,10 @@ def _create_top_enriched_data(
     )
 
 
-if __name__ == "__main__":
-    import argparse
-
-    parser = argparse.ArgumentParser(
-        description="Optimized Hybrid Enrichment Analysis")
-    parser.add_argument("--input_data", required=True,
-                        help="Path to the combined input CSV file. Expected columns: sampleId, elementId, abundance, downsampledAbundance, and condition.")
+def add_analysis_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the analysis options. Shared with the fused pipeline entry point.
+    """
     parser.add_argument("--conditions", type=str, required=True)
     parser.add_argument("--enrichment", required=True)
     parser.add_argument("--bubble", required=True)
@@ -1271,17 +2540,41 @@ if __name__ == "__main__":
                         help="Frequency threshold for single condition negative control filtering")
     parser.add_argument("--current_target", type=str, required=False,
                         help="The current target antigen for this iteration")
+    parser.add_argument("--targets", type=str, required=False,
+                        help="JSON list of target antigens to analyze in one run (instead of --current_target); "
+                             "every output path must contain '{target}'")
     parser.add_argument("--sequenced_library_enabled", action="store_true",
                         help="Enable usage of the selected sequenced library sample's condition as base condition for enrichment")
     parser.add_argument("--sequenced_library_antigen", type=str, required=False,
                         help="Antigen column value identifying library samples (used as base condition when enabled)")
     parser.add_argument("--exclude_sequenced_library", action="store_true",
                         help="Exclude library from the Shared (all conditions) filter requirement")
-
-    args = parser.parse_args()
-
-    hybrid_enrichment_analysis(
-        input_data_csv=args.input_data,
+    parser.add_argument("--engine", choices=enrichment_engines, default="polars",
+                        help="Enrichment engine: per-comparison polars expressions, a NumPy log2 frequency "
+                             "matrix (equal within 1e-12), or polars expressions over sparse clonotype x "
+                             "condition counts (same output as polars)")
+    parser.add_argument("--materialize_comparisons", choices=comparison_modes, default="all",
+                        help="'all' writes every pairwise comparison column; 'consumed' writes only each "
+                             "condition vs the baseline plus --export_comparisons (O(K) per clonotype)")
+    parser.add_argument("--export_comparisons", type=str, required=False,
+                        help="JSON list of [numerator, denominator] condition pairs to materialize in 'consumed' "
+                             "mode (e.g. [[\"R3\", \"R1\"]]); the numerator must be a later condition "
+                             "than the denominator")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Spill the input to disk and process it one slice of the clonotypes at a time, "
+                             "from the aggregation to the enrichment table (bounded memory)")
+    parser.add_argument("--streaming_memory_mb", type=float, default=2048,
+                        help="Memory budget in MiB of one clonotype slice with --streaming")
+    parser.add_argument("--float32", action="store_true",
+                        help="Store log2 frequencies and enrichments as float32 (numpy engine only; "
+                             "halves their memory, equal within 1e-5)")
+
+
+def analysis_kwargs(args: argparse.Namespace) -> Dict:
+    """
+    Map parsed analysis options to hybrid_enrichment_analysis keyword arguments.
+    """
+    return dict(
         condition_order=json.loads(args.conditions),
         enrichment_csv=args.enrichment,
         bubble_csv=args.bubble,
@@ -1311,5 +2604,35 @@ if __name__ == "__main__":
         current_target=args.current_target,
         sequenced_library_enabled=args.sequenced_library_enabled,
         sequenced_library_antigen=args.sequenced_library_antigen,
-        exclude_sequenced_library=args.exclude_sequenced_library
+        exclude_sequenced_library=args.exclude_sequenced_library,
+        engine=args.engine,
+        float32=args.float32,
+        materialize_comparisons=args.materialize_comparisons,
+        export_comparisons=json.loads(args.export_comparisons) if args.export_comparisons else None,
+        targets=json.loads(args.targets) if args.targets else None,
+        streaming=args.streaming,
+        streaming_memory_mb=args.streaming_memory_mb
     )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Optimized Hybrid Enrichment Analysis")
+    parser.add_argument("--input_data", required=True,
+                        help="Path to the combined input table (.csv, .parquet or .arrow). Expected columns: sampleId, elementId, abundance, downsampledAbundance, and condition.")
+    parser.add_argument("--annotation_stats", required=False,
+                        help="Optional JSON output with the annotation values (min, max, median, mean, cutoff, "
+                             "overall75Percentile) of every enrichment column, keyed by column name")
+    add_profile_argument(parser)
+    add_analysis_arguments(parser)
+
+    args = parser.parse_args()
+
+    profiler = StageProfiler("enrichment", args.profile)
+    hybrid_enrichment_analysis(input_data_csv=args.input_data, annotation_stats_json=args.annotation_stats,
+                               profiler=profiler, **analysis_kwargs(args))
+    profiler.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,80 +3,115 @@ import numpy as np
 import argparse
 import os
 
-def process_enrichment(input_file, output_dir='.', enrichment_column='Enrichment',
-                       overall_column='Overall Log2FC'):
+from profiling import NULL_PROFILER, StageProfiler, add_profile_argument
+from table_io import read_table
+
+# Annotation value key -> file written by process_enrichment
+ANNOTATION_FILES = {
+    'min': 'enrichment_min.txt',
+    'max': 'enrichment_max.txt',
+    'median': 'enrichment_median.txt',
+    'mean': 'enrichment_mean.txt',
+    'cutoff': 'enrichment_75.txt',
+    'overall75Percentile': 'overall_75.txt',
+}
+
+
+def _format_value(value):
+    return "NaN" if value is None else f"{value:.2f}"
+
+
+def annotation_stats(df, enrichment_columns, overall_column='Overall Log2FC'):
     """
-    Process enrichment data using polars for better performance.
+    Annotation values of several enrichment columns of one table (eager or
+    lazy), aggregated in a single pass. Returns {column: {key: value}} with
+    the keys of ANNOTATION_FILES and the values formatted as in the files;
+    an empty table (or an all-null column) gives "NaN".
     """
-    os.makedirs(output_dir, exist_ok=True)
-    
-    df = pl.read_csv(input_file)
-    if df.is_empty():
-        df = None  # Mark as empty
-
-    if df is None:
-        nan_value = "NaN"
-        output_files = {
-            'enrichment_min.txt': nan_value,
-            'enrichment_max.txt': nan_value,
-            'enrichment_median.txt': nan_value,
-            'enrichment_mean.txt': nan_value,
-            'enrichment_75.txt': nan_value,
-            'overall_75.txt': nan_value
-        }
-    else:
-        # Extract the 'Enrichment' column and calculate statistics
-        enrichment_stats = df.select([
-            pl.col(enrichment_column).min().alias('min'),
-            pl.col(enrichment_column).max().alias('max'),
-            pl.col(enrichment_column).median().alias('median'),
-            pl.col(enrichment_column).mean().alias('mean'),
-            pl.col(enrichment_column).quantile(0.75).alias('p75')
-        ])
-
-        # Get the values from the result
-        enrichment_min = enrichment_stats['min'][0]
-        enrichment_max = enrichment_stats['max'][0]
-        enrichment_median = enrichment_stats['median'][0]
-        enrichment_mean = enrichment_stats['mean'][0]
-        enrichment_75 = enrichment_stats['p75'][0]
-
-        # For the 75th percentile, output 1 if the value is less than or equal to 1
-        enrichment_75_out = enrichment_75 if enrichment_75 > 1 else 1
-
-        # Write results to txt files
-        output_files = {
-            'enrichment_min.txt': f"{enrichment_min:.2f}",
-            'enrichment_max.txt': f"{enrichment_max:.2f}",
-            'enrichment_median.txt': f"{enrichment_median:.2f}",
-            'enrichment_mean.txt': f"{enrichment_mean:.2f}",
-            'enrichment_75.txt': f"{enrichment_75_out:.2f}" 
-        }
+    df = df.lazy()
+    names = set(df.collect_schema().names())
+
+    def column_expr(column):
+        # Columns of an empty table are not required
+        return pl.col(column) if column in names else pl.lit(None, dtype=pl.Float64)
 
-        # Calculate p75 for Overall Log2FC
-        overall_p75 = df.select(pl.col(overall_column).quantile(0.75))[0, 0]
-        # Use same logic as for Enrichment p75
-        overall_p75_out = overall_p75 if overall_p75 > 1 else 1
-        output_files['overall_75.txt'] = f"{overall_p75_out:.2f}"
+    stats = df.select(
+        [pl.len().alias('rows'), column_expr(overall_column).quantile(0.75).alias('overall_p75')] + [
+            expr
+            for i, column in enumerate(enrichment_columns)
+            for expr in (
+                column_expr(column).min().alias(f'min_{i}'),
+                column_expr(column).max().alias(f'max_{i}'),
+                column_expr(column).median().alias(f'median_{i}'),
+                column_expr(column).mean().alias(f'mean_{i}'),
+                column_expr(column).quantile(0.75).alias(f'p75_{i}'),
+            )
+        ]
+    ).collect().row(0, named=True)
 
+    if stats['rows'] == 0:
+        return {column: {key: "NaN" for key in ANNOTATION_FILES} for column in enrichment_columns}
+    for column in [overall_column] + list(enrichment_columns):
+        if column not in names:
+            raise pl.exceptions.ColumnNotFoundError(column)
 
-    for filename, content in output_files.items():
+    # For the 75th percentiles, output 1 if the value is less than or equal to 1
+    overall_p75 = stats['overall_p75']
+    overall_75 = _format_value(overall_p75 if overall_p75 is None or overall_p75 > 1 else 1)
+    values = {}
+    for i, column in enumerate(enrichment_columns):
+        p75 = stats[f'p75_{i}']
+        values[column] = {
+            'min': _format_value(stats[f'min_{i}']),
+            'max': _format_value(stats[f'max_{i}']),
+            'median': _format_value(stats[f'median_{i}']),
+            'mean': _format_value(stats[f'mean_{i}']),
+            'cutoff': _format_value(p75 if p75 is None or p75 > 1 else 1),
+            'overall75Percentile': overall_75,
+        }
+    return values
+
+
+def write_annotation_files(values, output_dir='.'):
+    """Write the annotation values of one column (see annotation_stats) as text files."""
+    os.makedirs(output_dir, exist_ok=True)
+    for key, filename in ANNOTATION_FILES.items():
         output_path = os.path.join(output_dir, filename)
         with open(output_path, 'w') as f:
-            f.write(content)
+            f.write(values[key])
         print(f"Written {filename} to {output_path}")
 
+
+def process_enrichment(input_file, output_dir='.', enrichment_column='Enrichment',
+                       overall_column='Overall Log2FC', profiler=NULL_PROFILER):
+    """
+    Process enrichment data using polars for better performance.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    with profiler.stage("ingestion") as stage:
+        df = read_table(input_file)
+        stage["rows"] = df.height
+    with profiler.stage("annotation_stats"):
+        values = annotation_stats(df, [enrichment_column], overall_column)[enrichment_column]
+    with profiler.stage("write_annotations"):
+        write_annotation_files(values, output_dir)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Process enrichment data from a CSV file.')
     parser.add_argument('input_file', help='Path to the input CSV file containing enrichment data')
     parser.add_argument('--enrichment-column', default='Enrichment', help='Label of the enrichment column')
     parser.add_argument('--output-dir', '-o', default='.',
                       help='Directory to save output files (default: current directory)')
+    add_profile_argument(parser)
     
     args = parser.parse_args()
     
+    profiler = StageProfiler("enrichment_annotations", args.profile)
     try:
-        process_enrichment(args.input_file, args.output_dir, args.enrichment_column)
+        process_enrichment(args.input_file, args.output_dir, args.enrichment_column, profiler=profiler)
+        profiler.finish()
     except FileNotFoundError:
         print(f"Error: Input file '{args.input_file}' not found.")
         exit(1)
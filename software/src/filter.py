@@ -1,29 +1,159 @@
+import json
+import os
+
 import polars as pl
 
+from profiling import NULL_PROFILER, StageProfiler, add_profile_argument
+from table_io import scan_table, sink_table, write_table
+
+# Characters percent-encoded in condition file names: path separators, the
+# characters some file systems reserve and '%' itself, so encoding is reversible
+UNSAFE_FILE_NAME_CHARS = frozenset('/\\%:*?"<>|')
+
+
+def condition_file_name(condition):
+    """
+    Condition name made safe to use in a file name: unsafe characters (see
+    UNSAFE_FILE_NAME_CHARS) and control characters are percent-encoded as in
+    Hive partition paths, and so are names made only of dots ('.', '..'), so
+    a name cannot leave the directory of the output pattern. Distinct names
+    give distinct file names.
+    """
+    if condition and set(condition) == {'.'}:
+        return '%2E' * len(condition)
+    return ''.join(
+        ''.join(f'%{byte:02X}' for byte in char.encode('utf-8'))
+        if char in UNSAFE_FILE_NAME_CHARS or ord(char) < 32 or ord(char) == 127 else char
+        for char in condition
+    )
+
 
 def filter_by_condition(
     enrichment_file,
-    condition
+    condition,
+    output_file="filtered.csv",
+    profiler=NULL_PROFILER
 ):
     """
     Filter enrichment data by condition using polars for better performance.
+    The table is scanned lazily, so only the rows of the condition are loaded.
     """
-    enrichment_df = pl.read_csv(enrichment_file)
-    enrichment_df = enrichment_df.filter(pl.col("Condition").cast(pl.Utf8) == condition)
+    with profiler.stage("filter", condition=condition):
+        enrichment_df = scan_table(enrichment_file)
+        enrichment_df = enrichment_df.filter(pl.col("Condition").cast(pl.Utf8) == condition)
+
+        sink_table(enrichment_df, output_file)
+
+
+def filter_by_conditions(
+    enrichment_file,
+    conditions=None,
+    output_pattern="filtered_{condition}.csv",
+    partitioned_output=None,
+    columns=None,
+    profiler=NULL_PROFILER
+):
+    """
+    Split enrichment data into one table per condition with a single scan.
+
+    Only the rows of the given conditions (all conditions when None) and,
+    when given, the listed columns are read: the filter and the projection
+    are pushed down to the scan. Each condition is written to output_pattern
+    with '{condition}' replaced by its name, encoded with condition_file_name
+    (a requested condition without rows gives a table with the header only)
+    or, with partitioned_output, to a Hive-partitioned Parquet dataset
+    (partitioned_output/Condition=<escaped name>/). Returns the written paths
+    keyed by condition: the files, or the partition directories as reported
+    by the Parquet writer.
+    """
+    if partitioned_output is None and '{condition}' not in output_pattern:
+        raise ValueError(f"Output pattern must contain '{{condition}}': {output_pattern}")
+
+    profiler.start("ingestion")
+    enrichment_df = scan_table(enrichment_file)
+    if columns is not None:
+        enrichment_df = enrichment_df.select(
+            ["Condition"] + [col for col in columns if col != "Condition"])
+    if conditions is not None:
+        conditions = [str(condition) for condition in conditions]
+        enrichment_df = enrichment_df.filter(pl.col("Condition").cast(pl.Utf8).is_in(conditions))
+    enrichment_df = enrichment_df.collect()
+    profiler.stop(rows=enrichment_df.height)
+
+    if partitioned_output is not None:
+        os.makedirs(partitioned_output, exist_ok=True)
+        partitions = []
+        with profiler.stage("write_partitions"):
+            enrichment_df.lazy().sink_parquet(
+                pl.PartitionByKey(partitioned_output, by="Condition", include_key=True,
+                                  finish_callback=partitions.append),
+                mkdir=True,
+            )
+        # Partition directories as written (the key values are escaped in the
+        # paths); rows without a condition are not returned
+        written = (
+            partitions[0]
+            .select(pl.col("keys").struct.field("Condition").cast(pl.Utf8), "path")
+            .drop_nulls("Condition")
+        )
+        return {condition: os.path.dirname(path) for condition, path in written.iter_rows()}
+
+    # Partitions are sliced from the loaded rows one at a time, so at most one is copied
+    condition_key = enrichment_df.get_column("Condition").cast(pl.Utf8)
+    if conditions is None:
+        conditions = condition_key.drop_nulls().unique(maintain_order=True).to_list()
+    outputs = {}
+    for condition in conditions:
+        output_file = output_pattern.replace('{condition}', condition_file_name(condition))
+        with profiler.stage("write_output", condition=condition) as stage:
+            condition_df = enrichment_df.filter(condition_key == condition)
+            write_table(condition_df, output_file)
+            stage["rows"] = condition_df.height
+        del condition_df
+        outputs[condition] = output_file
+    return outputs
 
-    enrichment_df.write_csv("filtered.csv")
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Hybrid Enrichment Analysis - Filter by Condition")
     parser.add_argument("--enrichment_file", required=True)
-    parser.add_argument("--condition", required=True)
-    
+    selection = parser.add_mutually_exclusive_group(required=True)
+    selection.add_argument("--condition",
+                           help="Single condition to write to --output")
+    selection.add_argument("--conditions", type=str,
+                           help="JSON list of conditions to write, one table each, in one scan")
+    selection.add_argument("--all_conditions", action="store_true",
+                           help="Write every condition, one table each, in one scan")
+    parser.add_argument("--output", default="filtered.csv",
+                        help="Output path with --condition (.csv, .parquet or .arrow)")
+    parser.add_argument("--output_pattern", default="filtered_{condition}.csv",
+                        help="Per-condition output path with '{condition}' (--conditions/--all_conditions)")
+    parser.add_argument("--partitioned_output", required=False,
+                        help="Write a Hive-partitioned Parquet dataset to this directory instead "
+                             "of one file per condition (--conditions/--all_conditions)")
+    parser.add_argument("--columns", type=str, required=False,
+                        help="JSON list of columns to keep (--conditions/--all_conditions; Condition is always kept)")
+    add_profile_argument(parser)
+
     args = parser.parse_args()
 
-    filter_by_condition(
-        enrichment_file=args.enrichment_file,
-        condition=args.condition
-        
-    )
+    profiler = StageProfiler("filter", args.profile)
+    if args.condition is not None:
+        filter_by_condition(
+            enrichment_file=args.enrichment_file,
+            condition=args.condition,
+            output_file=args.output,
+            profiler=profiler
+        )
+    else:
+        filter_by_conditions(
+            enrichment_file=args.enrichment_file,
+            conditions=json.loads(args.conditions) if args.conditions else None,
+            output_pattern=args.output_pattern,
+            partitioned_output=args.partitioned_output,
+            columns=json.loads(args.columns) if args.columns else None,
+            profiler=profiler
+        )
+    profiler.finish()
@@ -0,0 +1,155 @@
+"""
+Fused enrichment pipeline: downsample -> enrich -> annotate -> max frequency.
+
+Runs the chain the workflow otherwise launches as separate processes
+(`downsampling`, `calculate-enrichment`, `calculate-annotations` per column
+and, for cluster input, a second `downsampling` plus
+`clonotype-max-frequency`) in a single process. Intermediate frames are passed
+between the stages in memory instead of being written and re-parsed, and the
+output files are the same as those of the individual scripts:
+
+  - enrichment outputs      : the paths given by the enrichment.py options
+  - annotation statistics   : enrichment_*.txt / overall_75.txt for the main
+                              (highest enrichment) column in --annotations_dir,
+                              and for each --annotation_comparisons entry in
+                              --annotations_dir/comparison_<index>
+  - clonotype MaxFrequency  : --clonotype_max_frequency (cluster mode)
+  - downsampled table       : --downsampled_output (optional; the cluster
+                              table with --cluster_mapping)
+
+Cluster mode either downsamples a separate --clonotype_input_data table for
+MaxFrequency or, with --cluster_mapping, takes the clonotype-level table as
+--input_data: it is downsampled once, MaxFrequency is computed from it and
+the enrichment runs on its rollup to clusters (see
+downsampling.rollup_to_clusters), so cluster and clonotype frequencies come
+from the same draw.
+
+With --targets every target antigen is analyzed from one downsampled table;
+all per-target output paths (including --annotations_dir) must then contain
+'{target}', as for enrichment.py.
+"""
+import argparse
+import json
+import os
+
+import polars as pl
+
+from clonotype_max_frequency import max_frequency
+from downsampling import downsample_table, downsampling_file, parse_params, rollup_to_clusters, sampler_engines
+from enrichment import add_analysis_arguments, analysis_kwargs, hybrid_enrichment_analysis
+from enrichment_annotations import annotation_stats, process_enrichment, write_annotation_files
+from profiling import StageProfiler, add_profile_argument
+from table_io import read_table, write_table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fused downsampling, enrichment, annotation and max-frequency pipeline")
+    parser.add_argument("--input_data", required=True,
+                        help="Clone table before downsampling (.csv, .parquet or .arrow). "
+                             "Expected columns: sampleId, elementId, abundance, condition, [antigen].")
+    parser.add_argument("--downsampling", default=downsampling_file,
+                        help="Downsampling parameters JSON")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes used to downsample samples in parallel")
+    parser.add_argument("--sampler", choices=sampler_engines, default="auto",
+                        help="Hypergeometric sampler engine (default: chosen per sample)")
+    parser.add_argument("--downsampled_output", required=False,
+                        help="Optional path to also save the downsampled table")
+    parser.add_argument("--annotations_dir", default=".",
+                        help="Directory for the annotation statistics of the highest enrichment column")
+    parser.add_argument("--annotation_comparisons", type=str, required=False,
+                        help="JSON list of comparisons (e.g. \"R2 vs R1\") to compute annotation statistics for")
+    parser.add_argument("--clonotype_input_data", required=False,
+                        help="Clonotype-level clone table (cluster input); enables MaxFrequency")
+    parser.add_argument("--cluster_mapping", required=False,
+                        help="Clonotype to cluster table (elementId, clusterId); --input_data is then the "
+                             "clonotype-level table, downsampled once for both clusters and clonotypes")
+    parser.add_argument("--clonotype_max_frequency", required=False,
+                        help="Output path for the per-clonotype MaxFrequency table")
+    add_profile_argument(parser)
+    add_analysis_arguments(parser)
+
+    args = parser.parse_args()
+    if args.cluster_mapping and args.clonotype_input_data:
+        parser.error("--cluster_mapping and --clonotype_input_data are mutually exclusive")
+    targets = json.loads(args.targets) if args.targets else None
+    if targets is not None:
+        for path in (args.annotations_dir, args.clonotype_max_frequency):
+            if path is not None and '{target}' not in path:
+                parser.error(f"with --targets, output paths must contain '{{target}}': {path}")
+
+    def target_path(path, target):
+        return path if targets is None else path.replace('{target}', str(target))
+
+    profiler = StageProfiler("pipeline", args.profile)
+
+    def write_max_frequency(clonotype_downsampled):
+        profiler.start("max_frequency")
+        condition_order = [str(c) for c in json.loads(args.conditions)]
+        clonotype_downsampled = clonotype_downsampled.with_columns(pl.col("condition").cast(pl.Utf8))
+        engine = "sparse" if args.engine == "sparse" else "long"
+        if targets is None:
+            max_frequencies = {args.current_target: max_frequency(
+                clonotype_downsampled, condition_order, args.current_target, engine)}
+        else:
+            # One pass over the clonotype table for all targets
+            max_frequencies = max_frequency(clonotype_downsampled, condition_order, engine=engine,
+                                            targets=targets)
+        for target, frequencies in max_frequencies.items():
+            write_table(frequencies, target_path(args.clonotype_max_frequency, target))
+        profiler.stop(rows=sum(frequencies.height for frequencies in max_frequencies.values()))
+
+    def downsample_input(path):
+        profiler.start("ingestion", table=path)
+        input_data = read_table(path)
+        profiler.stop(rows=input_data.height)
+        profiler.start("downsampling", table=path)
+        downsampled = downsample_table(input_data, downsampling_params,
+                                       workers=args.workers, engine=args.sampler)
+        profiler.stop(rows=downsampled.height)
+        return downsampled
+
+    downsampling_params = parse_params(args.downsampling)
+
+    downsampled = downsample_input(args.input_data)
+    if args.cluster_mapping:
+        # One clonotype-level draw: MaxFrequency from it, enrichment on its cluster rollup
+        if args.clonotype_max_frequency:
+            write_max_frequency(downsampled)
+        profiler.start("cluster_rollup")
+        downsampled = rollup_to_clusters(downsampled, read_table(args.cluster_mapping))
+        profiler.stop(rows=downsampled.height)
+    if args.downsampled_output:
+        with profiler.stage("write_downsampled"):
+            write_table(downsampled, args.downsampled_output)
+
+    results = hybrid_enrichment_analysis(input_data_csv=downsampled, profiler=profiler, **analysis_kwargs(args))
+    del downsampled
+    if targets is None:
+        results = {args.current_target: results}
+
+    comparisons = json.loads(args.annotation_comparisons) if args.annotation_comparisons else []
+    for target, outputs in results.items():
+        annotations_dir = target_path(args.annotations_dir, target)
+        if target is not None:
+            profiler.tag(target=target)
+        if 'highest_enrichment' in outputs:
+            process_enrichment(outputs['highest_enrichment'], annotations_dir, 'Enrichment', profiler=profiler)
+
+        # All comparison columns are aggregated in one pass over the enrichment table
+        columns = [f"Enrichment {comparison}" for comparison in comparisons]
+        if columns:
+            with profiler.stage("comparison_annotations"):
+                stats = annotation_stats(outputs['enrichment'], columns)
+                for i, column in enumerate(columns):
+                    write_annotation_files(stats[column], os.path.join(annotations_dir, f"comparison_{i}"))
+    profiler.tag()
+
+    if args.clonotype_input_data and args.clonotype_max_frequency:
+        write_max_frequency(downsample_input(args.clonotype_input_data))
+    profiler.finish()
+
+
+if __name__ == "__main__":
+    main()
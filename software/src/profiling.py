@@ -0,0 +1,167 @@
+"""
+Per-stage profiling of the scripts (the shared --profile option).
+
+A StageProfiler records, for each named stage of a run, the wall time, the
+CPU time (of the process and of its reaped worker processes), the number of
+rows the stage produced and the peak RSS. The report is a JSON file:
+
+    {
+      "script": "enrichment",
+      "complete": true,
+      "running": null,
+      "stages": [
+        {"name": "aggregation", "wall_s": 1.2, "cpu_s": 1.1, "rows": 123456, "peak_rss_mb": 850.3},
+        {"name": "enrichment", "target": "T1", ...},
+        ...
+      ],
+      "total": {"wall_s": 9.8, "cpu_s": 9.1, "peak_rss_mb": 1210.7}
+    }
+
+The report is rewritten when a stage starts and when it ends, so a run that
+is killed (for example by the OOM killer) still leaves a report with the
+finished stages and the stage that was running.
+
+On Linux the peak RSS is per stage: the kernel's high-water mark is reset at
+the start of each stage (/proc/self/clear_refs) and read at its end; the
+total keeps the peak of the whole run. Because of the reset, the process's
+own ru_maxrss only covers the stages since the last reset when profiling.
+Elsewhere every stage reports the peak of the run so far. The memory of
+worker processes is not included.
+"""
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+
+def add_profile_argument(parser):
+    """Add the --profile option. Shared by all scripts."""
+    parser.add_argument("--profile", required=False,
+                        help="Optional JSON output with the wall time, CPU time, row count and peak RSS "
+                             "of each processing stage")
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _high_water_bytes():
+    """Peak RSS since the last reset (Linux) or of the whole process."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+def _reset_high_water():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class StageProfiler:
+    """
+    Stage timings and memory of one run, written to path (see the module
+    docstring). Without a path nothing is measured or written, so the
+    profiler can be passed around unconditionally.
+
+    Stages do not nest: start() ends the running stage, if any.
+    """
+
+    def __init__(self, script, path=None):
+        self.script = script
+        self.path = path
+        self.stages = []
+        self._running = None
+        self._tags = {}
+        self._peak_bytes = 0
+        self._run_start = (time.perf_counter(), _cpu_seconds())
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def tag(self, **tags):
+        """Details stored with every stage started from now on (e.g. target=...)."""
+        self._tags = tags
+
+    def start(self, name, **details):
+        """Start a stage; details are stored with it."""
+        if not self.enabled:
+            return
+        if self._running is not None:
+            self.stop()
+        self._peak_bytes = max(self._peak_bytes, _high_water_bytes())
+        _reset_high_water()
+        self._running = ({"name": name, **self._tags, **details}, time.perf_counter(), _cpu_seconds())
+        self._write(complete=False)
+
+    def stop(self, rows=None):
+        """End the running stage, with the number of rows it produced when given."""
+        if not self.enabled or self._running is None:
+            return
+        record, wall_start, cpu_start = self._running
+        self._running = None
+        record["wall_s"] = round(time.perf_counter() - wall_start, 4)
+        record["cpu_s"] = round(_cpu_seconds() - cpu_start, 4)
+        if rows is not None:
+            record["rows"] = int(rows)
+        peak_bytes = _high_water_bytes()
+        self._peak_bytes = max(self._peak_bytes, peak_bytes)
+        record["peak_rss_mb"] = round(peak_bytes / 2**20, 1)
+        self.stages.append(record)
+        self._write(complete=False)
+
+    @contextmanager
+    def stage(self, name, **details):
+        """
+        Context manager form of start()/stop(); the yielded dict takes the
+        row count as stage['rows'].
+        """
+        self.start(name, **details)
+        result = {}
+        yield result
+        self.stop(result.get("rows"))
+
+    def finish(self):
+        """End the running stage and write the final report."""
+        if not self.enabled:
+            return
+        self.stop()
+        self._write(complete=True)
+        print(f"Written profile to {self.path}")
+
+    def _write(self, complete):
+        self._peak_bytes = max(self._peak_bytes, _high_water_bytes())
+        wall_start, cpu_start = self._run_start
+        report = {
+            "script": self.script,
+            "complete": complete,
+            "running": self._running[0] if self._running is not None else None,
+            "stages": self.stages,
+            "total": {
+                "wall_s": round(time.perf_counter() - wall_start, 4),
+                "cpu_s": round(_cpu_seconds() - cpu_start, 4),
+                "peak_rss_mb": round(self._peak_bytes / 2**20, 1),
+            },
+        }
+        # Replaced atomically, so a killed run never leaves a truncated report
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(report, f, indent=2)
+        os.replace(temp_path, self.path)
+
+
+# Disabled profiler, the default of the functions taking one
+NULL_PROFILER = StageProfiler(None)
@@ -0,0 +1,196 @@
+"""
+Resource sizing advisor for the workflow's exec steps.
+
+Reads the clone table handed to `downsampling` (sampleId, elementId,
+abundance, condition, [antigen]) in one streaming pass over its small key
+columns (row counts of Parquet input come from the metadata) and estimates
+the peak memory of the downstream steps from its row, sample, condition,
+antigen and element counts with a linear cost model (COST_MODEL), calibrated
+with benchmarks/calibrate_sizing.py on measured runs of the scripts.
+
+The output is a JSON file the workflow uses to request resources per exec:
+
+    {
+      "table": {"rows": ..., "samples": ..., "maxSampleRows": ..., "maxAntigenRows": ...,
+                "conditions": ..., "antigens": ..., "elements": ...},
+      "steps": {
+        "downsampling": {"peakMb": 812.4, "mem": "2GiB", "cpu": 8},
+        "enrichment": {...},
+        "clonotypeMaxFrequency": {...}
+      }
+    }
+
+The requested memory is the estimate times a headroom factor, rounded up to
+a whole GiB and kept between the step's minimum (see STEPS), or --min_mem_gib
+when larger, and --max_mem_gib.
+"""
+import argparse
+import json
+import math
+
+import polars as pl
+
+from downsampling import sampler_max_bytes
+from table_io import scan_table
+
+# Peak RSS model per step, in MB: base_mb plus the per-unit bytes of each
+# table feature (see step_features). Fitted with benchmarks/calibrate_sizing.py
+# (see there for the grid, the held-out checks and the arguments of the runs,
+# those of the workflow templates) as an upper envelope of the measured runs
+# with a margin for larger inputs; downsampling is the single-process part,
+# without the sampler (see sampler_peak_mb)
+COST_MODEL = {
+    "downsampling": {"base_mb": 103.6, "row": 321.6},
+    "enrichment": {"base_mb": 233.7, "row": 332.7, "element_condition": 8.4, "element_comparison": 309.3},
+    "clonotype_max_frequency": {"base_mb": 124.2, "antigen_row": 245.5, "element": 62.2},
+}
+
+# Memory of one downsampling worker process: the interpreter with numpy and
+# polars loaded (measured ~57 MB), plus, for its largest sample, the pickled
+# abundance vector, the nonzero index and values, the result and its pickled
+# copy (8 bytes per row each) and the sampler's temporary memory
+WORKER_BASE_MB = 64.0
+WORKER_SAMPLE_ROW_BYTES = 48.0
+
+# Exec steps of the workflow: output key, cost model step, requested CPUs
+# (downsampling requests one CPU per worker process) and the smallest memory
+# request in GiB. The minimum covers what the model does not see: the
+# runtime environment of the exec and, for the steps that read the whole
+# table, allocator and page cache slack on small inputs
+STEPS = [
+    ("downsampling", "downsampling", None, 2),
+    ("enrichment", "enrichment", 8, 4),
+    ("clonotypeMaxFrequency", "clonotype_max_frequency", 1, 1),
+]
+
+headroom = 1.5
+min_mem_gib = 1
+max_mem_gib = 128
+
+
+def table_stats(path):
+    """
+    Row, sample, condition, antigen and element counts of a clone table, and
+    the rows of its largest sample and of its largest antigen (all rows
+    without an antigen column). The number of elements is an approximation
+    (HyperLogLog), so that only the sample-level key columns are ever held in
+    memory.
+    """
+    lf = scan_table(path, schema_overrides={"condition": pl.Utf8})
+    has_antigen = "antigen" in lf.collect_schema().names()
+    sample_keys = ["condition"] + (["antigen"] if has_antigen else [])
+    samples_query = lf.group_by("sampleId").agg(
+        [pl.len().alias("rows")] + [pl.col(key).first() for key in sample_keys])
+    elements_query = lf.select(pl.col("elementId").approx_n_unique().alias("elements"))
+    samples, elements = pl.collect_all([samples_query, elements_query], engine="streaming")
+
+    # The largest antigen bounds the rows of any one target, all a step
+    # running per target (clonotype max frequency) reads
+    antigen_rows = samples.group_by(pl.col("antigen") if has_antigen else pl.lit(0)).agg(pl.col("rows").sum())
+    return {
+        "rows": int(samples.get_column("rows").sum()),
+        "samples": samples.height,
+        "maxSampleRows": int(samples.get_column("rows").max() or 0),
+        "maxAntigenRows": int(antigen_rows.get_column("rows").max() or 0),
+        "conditions": samples.get_column("condition").n_unique() if samples.height else 0,
+        "antigens": samples.get_column("antigen").n_unique() if has_antigen and samples.height else 0,
+        "elements": int(elements.item()) if samples.height else 0,
+    }
+
+
+def step_features(stats):
+    """Features of the cost model from the table counts."""
+    conditions = max(stats["conditions"], 1)
+    return {
+        "row": stats["rows"],
+        # Rows of the target a per-target step reads (at most the largest antigen's)
+        "antigen_row": stats["maxAntigenRows"],
+        "element": stats["elements"],
+        # Pivot of the target track: one frequency column per condition
+        "element_condition": stats["elements"] * conditions,
+        # Pairwise enrichment columns of the enrichment table
+        "element_comparison": stats["elements"] * conditions * (conditions - 1) // 2,
+    }
+
+
+def worker_peak_mb(sample_rows):
+    """Peak RSS in MB of a downsampling worker for a sample of sample_rows rows."""
+    # The sampler engine follows the sample's reads and depth, which the table
+    # counts do not give: take the largest temporary memory of any engine the
+    # "auto" choice can make (see downsampling.choose_sampler_engine)
+    return WORKER_BASE_MB + (WORKER_SAMPLE_ROW_BYTES * sample_rows + sampler_max_bytes(sample_rows)) / 2**20
+
+
+def sampler_peak_mb(sample_rows, workers=1):
+    """
+    Memory in MB the downsampling samplers add to the single-process model:
+    that of the worker processes or, with one worker, the largest sample's
+    sampler memory in the process itself.
+    """
+    if workers > 1:
+        return workers * worker_peak_mb(sample_rows)
+    return sampler_max_bytes(sample_rows) / 2**20
+
+
+def model_peak_mb(step, stats):
+    """Peak RSS in MB of a step (COST_MODEL key) from its linear model alone."""
+    model = COST_MODEL[step]
+    features = step_features(stats)
+    return model["base_mb"] + sum(
+        coefficient * features[name] / 2**20 for name, coefficient in model.items() if name != "base_mb")
+
+
+def estimate_peak_mb(step, stats, workers=1):
+    """Estimated peak RSS in MB of a step (COST_MODEL key) for the table counts."""
+    peak_mb = model_peak_mb(step, stats)
+    if step == "downsampling":
+        peak_mb += sampler_peak_mb(stats["maxSampleRows"], workers)
+    return peak_mb
+
+
+def memory_request(peak_mb, headroom=headroom, min_gib=min_mem_gib, max_gib=max_mem_gib):
+    """Exec memory request ("<n>GiB") for an estimated peak."""
+    gib = math.ceil(peak_mb * headroom / 1024)
+    return f"{min(max(gib, min_gib), max_gib)}GiB"
+
+
+def advise(path, workers=8, headroom=headroom, min_gib=min_mem_gib, max_gib=max_mem_gib):
+    """Table counts and the resources of every step (see the module docstring)."""
+    stats = table_stats(path)
+    steps = {}
+    for key, step, cpu, step_min_gib in STEPS:
+        if step == "downsampling":
+            peak_mb, cpu = estimate_peak_mb(step, stats, workers), workers
+        else:
+            peak_mb = estimate_peak_mb(step, stats)
+        steps[key] = {
+            "peakMb": round(peak_mb, 1),
+            "mem": memory_request(peak_mb, headroom, max(min_gib, step_min_gib), max_gib),
+            "cpu": cpu,
+        }
+    return {"table": stats, "steps": steps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate the resources of the workflow steps from the clone table")
+    parser.add_argument("--input", required=True,
+                        help="Clone table before downsampling (.csv, .parquet or .arrow)")
+    parser.add_argument("--output", required=True,
+                        help="Output JSON with the table counts and the resources per step")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Worker processes (and CPUs) of the downsampling step")
+    parser.add_argument("--headroom", type=float, default=headroom,
+                        help="Requested memory as a multiple of the estimated peak")
+    parser.add_argument("--min_mem_gib", type=int, default=min_mem_gib,
+                        help="Smallest memory request of any step (on top of the per-step minimums)")
+    parser.add_argument("--max_mem_gib", type=int, default=max_mem_gib)
+    args = parser.parse_args()
+
+    advice = advise(args.input, args.workers, args.headroom, args.min_mem_gib, args.max_mem_gib)
+    with open(args.output, "w") as f:
+        json.dump(advice, f, indent=2)
+    print(f"Written resource estimates to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
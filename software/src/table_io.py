@@ -0,0 +1,88 @@
+"""
+Format-aware readers and writers for the tables the scripts exchange.
+
+The format is picked from the file extension, so existing CSV hand-offs keep
+working and intermediate tables can be switched to a binary columnar format
+just by renaming them:
+
+    .parquet, .pq            -> Parquet
+    .arrow, .ipc, .feather   -> Arrow IPC (memory-mapped, zero-copy reads)
+    anything else            -> CSV
+
+Binary formats carry their own typed schema; `schema_overrides` is applied to
+them as a cast so callers get the same column types as from CSV. Readers also
+accept an in-memory DataFrame/LazyFrame in place of a path, which lets the
+fused pipeline hand frames from one stage to the next without a file.
+"""
+import os
+
+import polars as pl
+
+PARQUET_EXTENSIONS = {".parquet", ".pq"}
+IPC_EXTENSIONS = {".arrow", ".ipc", ".feather"}
+
+
+def table_format(path):
+    """Return 'parquet', 'ipc' or 'csv' for the given file path."""
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension in PARQUET_EXTENSIONS:
+        return "parquet"
+    if extension in IPC_EXTENSIONS:
+        return "ipc"
+    return "csv"
+
+
+def _cast_overrides(frame, schema_overrides, names):
+    if not schema_overrides:
+        return frame
+    casts = [pl.col(name).cast(dtype) for name, dtype in schema_overrides.items() if name in names]
+    return frame.with_columns(casts) if casts else frame
+
+
+def scan_table(path, schema_overrides=None):
+    """Lazily scan a table in any supported format (or wrap a frame)."""
+    if isinstance(path, (pl.DataFrame, pl.LazyFrame)):
+        lf = path.lazy()
+        return _cast_overrides(lf, schema_overrides, lf.collect_schema().names())
+    fmt = table_format(path)
+    if fmt == "csv":
+        return pl.scan_csv(path, schema_overrides=schema_overrides)
+    lf = pl.scan_parquet(path) if fmt == "parquet" else pl.scan_ipc(path, memory_map=True)
+    return _cast_overrides(lf, schema_overrides, lf.collect_schema().names())
+
+
+def read_table(path, schema_overrides=None):
+    """Eagerly read a table in any supported format (or take a frame)."""
+    if isinstance(path, (pl.DataFrame, pl.LazyFrame)):
+        df = path.collect() if isinstance(path, pl.LazyFrame) else path
+        return _cast_overrides(df, schema_overrides, df.columns)
+    fmt = table_format(path)
+    if fmt == "csv":
+        return pl.read_csv(path, schema_overrides=schema_overrides)
+    if fmt == "parquet":
+        df = pl.read_parquet(path, memory_map=True)
+    else:
+        df = pl.read_ipc(path, memory_map=True)
+    return _cast_overrides(df, schema_overrides, df.columns)
+
+
+def write_table(df, path):
+    """Write a table in the format implied by the path's extension."""
+    fmt = table_format(path)
+    if fmt == "parquet":
+        df.write_parquet(path)
+    elif fmt == "ipc":
+        df.write_ipc(path)
+    else:
+        df.write_csv(path)
+
+
+def sink_table(lf, path):
+    """Stream a lazy frame to a file in the format implied by its extension."""
+    fmt = table_format(path)
+    if fmt == "parquet":
+        lf.sink_parquet(path)
+    elif fmt == "ipc":
+        lf.sink_ipc(path)
+    else:
+        lf.sink_csv(path)